@@ -0,0 +1,205 @@
+"""
+Time every pipeline stage on synthetic inputs and write a JSON report.
+
+Each stage runs as its own process, like in the shell pipeline, and is
+measured for wall time, CPU time and peak resident memory. Reports of two
+commits can be compared with --compare.
+
+Usage:
+    python bench/run_benchmarks.py -s tiny small -o bench_report.json
+    python bench/run_benchmarks.py -s small --compare old_report.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN = os.path.join(REPO, 'bin')
+
+
+def bin_script(name):
+    return os.path.join(BIN, name)
+
+
+def load_expr_cmd(fnames, out):
+    code = ('import sys; sys.path.insert(0, {!r}); '
+            'from diff_expr import load_expr; '
+            'print(len(load_expr({!r})))').format(BIN, fnames['expr'])
+    return [ sys.executable, '-c', code ]
+
+
+# Stages in pipeline order: name and a function from input and output
+# file names to the command to run. Standard output of a stage goes to
+# out[<name>].
+STAGES = [
+    ('peak_merge', lambda f, out: [
+        sys.executable, bin_script('peak_merge.py'), '-p', '0.75',
+        '-i', f['peaks'], '-o', out['merged'],
+        '-o1', out['reads'], '-o2', out['heights'],
+    ]),
+    ('gtf_to_tss', lambda f, out: [
+        sys.executable, bin_script('gtf_to_tss.py'), f['gtf'],
+    ]),
+    ('peak_to_rsid', lambda f, out: [
+        sys.executable, bin_script('peak_to_rsid.py'),
+        f['dbsnp'], out['reads'],
+    ]),
+    ('peak_to_rsid_stream', lambda f, out: [
+        sys.executable, bin_script('peak_to_rsid.py'), '--stream',
+        f['dbsnp'], out['reads'],
+    ]),
+    ('load_expr', load_expr_cmd),
+    ('correlate_peak_expr', lambda f, out: [
+        sys.executable, bin_script('correlate_peak_expr.py'),
+        out['gtf_to_tss'], out['reads'], f['expr'], f['pops_named'],
+    ]),
+    ('continental_variance', lambda f, out: [
+        sys.executable, bin_script('continental_variance.py'), out['reads'],
+    ]),
+    ('outlier_european', lambda f, out: [
+        sys.executable, bin_script('outlier_european.py'), out['reads'],
+        'yri',
+    ]),
+    ('diff_expr_concord_perm', lambda f, out: [
+        sys.executable, bin_script('diff_expr_concord_perm.py'),
+        f['expr'], f['pops_contrast'], '10', '7',
+    ]),
+]
+
+
+def run_stage(cmd, stdout_fname):
+    """Run cmd, returning its wall time, CPU time and peak RSS."""
+    with open(stdout_fname, 'w') as stdout, \
+         open(stdout_fname + '.err', 'w') as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr,
+                                cwd=REPO)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'wall_s': round(wall, 4),
+        'cpu_s': round(usage.ru_utime + usage.ru_stime, 4),
+        # ru_maxrss is in kilobytes on Linux.
+        'max_rss_mb': round(usage.ru_maxrss / 1024., 2),
+        'returncode': proc.returncode,
+    }
+
+
+def inputs_for(workdir, scale, seed):
+    dirname = os.path.join(workdir, '{}-{}'.format(scale, seed))
+    marker = os.path.join(dirname, '.complete')
+    if os.path.exists(marker):
+        with open(marker) as f:
+            return json.load(f)
+    sys.stderr.write('Generating {} inputs in {}\n'.format(scale, dirname))
+    fnames = synthetic.generate(dirname, scale, seed)
+    with open(marker, 'w') as f:
+        json.dump(fnames, f)
+    return fnames
+
+
+def run_scale(workdir, scale, seed, stages):
+    fnames = inputs_for(workdir, scale, seed)
+    outdir = os.path.join(workdir, '{}-{}-out'.format(scale, seed))
+    os.makedirs(outdir, exist_ok=True)
+    out = {
+        'merged': os.path.join(outdir, 'merged_peaks.bed'),
+        'reads': os.path.join(outdir, 'pop_peak_reads.txt'),
+        'heights': os.path.join(outdir, 'pop_peak_heights.txt'),
+    }
+    for name, _ in STAGES:
+        out[name] = os.path.join(outdir, name + '.out')
+
+    results = []
+    for name, make_cmd in STAGES:
+        if stages and name not in stages:
+            continue
+        result = run_stage(make_cmd(fnames, out), out[name])
+        result.update({ 'scale': scale, 'stage': name })
+        results.append(result)
+        sys.stderr.write('{:>8} {:<24} {:>9.3f} s {:>9.1f} MB{}\n'.format(
+            scale, name, result['wall_s'], result['max_rss_mb'],
+            '' if result['returncode'] == 0 else
+            '  FAILED, see {}.err'.format(out[name])
+        ))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            [ 'git', 'rev-parse', 'HEAD' ], cwd=REPO,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Print wall time and memory ratios of report against baseline."""
+    base = { (r['scale'], r['stage']): r for r in baseline['results'] }
+    print('{:<8} {:<24} {:>10} {:>10} {:>7} {:>10} {:>10}'.format(
+        'scale', 'stage', 'base_s', 'new_s', 'ratio', 'base_mb', 'new_mb'
+    ))
+    for r in report['results']:
+        b = base.get((r['scale'], r['stage']))
+        if b is None:
+            continue
+        print('{:<8} {:<24} {:>10.3f} {:>10.3f} {:>7.2f} {:>10.1f} {:>10.1f}'
+              .format(r['scale'], r['stage'], b['wall_s'], r['wall_s'],
+                      r['wall_s'] / max(b['wall_s'], 1e-9),
+                      b['max_rss_mb'], r['max_rss_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--scales', nargs='+', default=[ 'small' ],
+                        choices=sorted(synthetic.SCALES),
+                        help='Input scales to run (default: small).')
+    parser.add_argument('--stages', nargs='+',
+                        choices=[ name for name, _ in STAGES ],
+                        help='Only run these stages (default: all).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-w', '--workdir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'atac-diverge-bench'),
+                        help='Where synthetic inputs are generated and '
+                             'cached.')
+    parser.add_argument('-o', '--output', default='bench_report.json',
+                        help='JSON report (default: bench_report.json).')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='Compare against an earlier JSON report.')
+    args = parser.parse_args(argv)
+
+    results = []
+    for scale in args.scales:
+        results += run_scale(args.workdir, scale, args.seed, args.stages)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Startup time of the bin/atac-diverge subcommands.
+
+Reports the median time to import the script of every subcommand, runs
+the light subcommands of bin/commands.py end to end on tiny synthetic
+inputs and runs `--help' of the other subcommands, which only import
+numpy and what their argument parsing needs. Exits with status 1 if a
+light subcommand takes longer than the budget, 100 ms by default; the
+--help times are reported only.
+
+Usage:
+    python bench/startup.py
+    python bench/startup.py -r 20 --budget-ms 80 -o startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from run_benchmarks import BIN, REPO, inputs_for
+
+sys.path.insert(0, BIN)
+from commands import COMMANDS
+
+DISPATCHER = os.path.join(BIN, 'atac-diverge')
+
+
+def light_runs(fnames, outdir):
+    """Commands running each light subcommand on tiny inputs."""
+    return {
+        'gtf-to-tss': [ 'gtf-to-tss', fnames['gtf'] ],
+        'gene-annot': [ 'gene-annot', os.path.join(outdir, 'annot.db'),
+                        '--gtf', fnames['gtf'],
+                        '--gene-set', 'genes', fnames['genes'] ],
+        'expr-index': [ 'expr-index', fnames['expr'], '--bgzip',
+                        os.path.join(outdir, 'expr.txt.bgz') ],
+        'query-server': [ 'query-server', '--help' ],
+    }
+
+
+def median_time(cmd, repeats):
+    """Median wall time of cmd in seconds, None if it fails."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        returncode = subprocess.call(cmd, cwd=REPO,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if returncode != 0:
+            return None
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--repeats', type=int, default=10,
+                        help='Runs per command (default: 10).')
+    parser.add_argument('--budget-ms', type=float, default=100.,
+                        help='Budget of the light subcommands (default: 100).')
+    parser.add_argument('-w', '--workdir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'atac-diverge-bench'),
+                        help='Where synthetic inputs are generated and '
+                             'cached.')
+    parser.add_argument('-o', '--output', help='Also write a JSON report.')
+    args = parser.parse_args(argv)
+
+    fnames = inputs_for(args.workdir, 'tiny', 0)
+    outdir = os.path.join(args.workdir, 'startup-out')
+    os.makedirs(outdir, exist_ok=True)
+    runs = light_runs(fnames, outdir)
+
+    results = []
+    baseline = median_time([ sys.executable, '-c', 'pass' ], args.repeats)
+    results.append(('python', 'interpreter', baseline))
+    results.append(('atac-diverge', 'dispatch', median_time(
+        [ sys.executable, DISPATCHER, '--help' ], args.repeats
+    )))
+    for command, module, light, _ in COMMANDS:
+        code = 'import sys; sys.path.insert(0, {!r}); import {}'.format(
+            BIN, module
+        )
+        results.append((command, 'import', median_time(
+            [ sys.executable, '-c', code ], args.repeats
+        )))
+        if light:
+            results.append((command, 'run', median_time(
+                [ sys.executable, DISPATCHER ] + runs[command], args.repeats
+            )))
+        else:
+            results.append((command, 'help', median_time(
+                [ sys.executable, DISPATCHER, command, '--help' ],
+                args.repeats
+            )))
+
+    budget = args.budget_ms / 1000.
+    over = []
+    print('{:<24} {:<12} {:>10}'.format('command', 'measure', 'median_ms'))
+    for command, measure, seconds in results:
+        checked = measure == 'dispatch' or measure == 'run'
+        if checked and (seconds is None or seconds > budget):
+            over.append(command)
+        print('{:<24} {:<12} {:>10}{}'.format(
+            command, measure,
+            'failed' if seconds is None else '{:.1f}'.format(seconds * 1000),
+            '  over budget' if command in over and checked else ''
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'budget_ms': args.budget_ms,
+                'repeats': args.repeats,
+                'results': [
+                    { 'command': command, 'measure': measure,
+                      'median_ms': None if seconds is None
+                      else round(seconds * 1000, 2) }
+                    for command, measure, seconds in results
+                ],
+            }, f, indent=2)
+
+    if over:
+        sys.stderr.write('Over the {:.0f} ms budget: {}\n'.format(
+            args.budget_ms, ', '.join(over)
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
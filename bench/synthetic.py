@@ -0,0 +1,206 @@
+"""
+Deterministic synthetic inputs for the benchmarks.
+
+Every generator takes a numpy RandomState, so the same seed and scale
+always produce byte-identical files. Formats follow the real inputs:
+
+    peaks:  MACS-style peaks of all ten populations in one sorted BED,
+            chrom, start, end, <POP>_<name>, n_reads, ., fold_change,
+            log10p, height (data/peaks/all_peaks_sorted.bed.gz)
+    expr:   GEUVADIS-shaped RPKM matrix, gzipped, a '#' comment, a header
+            of sample IDs and one versioned ENSG ID per row
+    dbsnp:  chrom, position, rsID, sorted by `sort -k1,1 -k2,2n'
+    gtf:    GENCODE-style transcript and start_codon records
+    pops:   population JSONs in the conf/ format, with every sample
+            listed twice
+"""
+import gzip
+import io
+import json
+import numpy as np
+import os
+
+POPS = sorted([
+    'ASW', 'CEU', 'CHB', 'ESN', 'FIN',
+    'GWD', 'IBS', 'LWK', 'TSI', 'YRI'
+])
+GEUVADIS_POPS = [ 'CEU', 'FIN', 'GBR', 'TSI', 'YRI' ]
+AFR_POPS = [ 'YRI' ]
+
+# Sorted with `sort -k1,1', like the real inputs.
+CHROMS = sorted([ str(c) for c in range(1, 23) ])
+
+# Parameters per scale.
+SCALES = {
+    'tiny': dict(n_sites=500, n_genes=300, n_samples=50,
+                 n_snps=20000, n_chroms=2),
+    'small': dict(n_sites=5000, n_genes=2000, n_samples=100,
+                  n_snps=200000, n_chroms=4),
+    'medium': dict(n_sites=50000, n_genes=20000, n_samples=462,
+                   n_snps=2000000, n_chroms=22),
+    'large': dict(n_sites=250000, n_genes=56000, n_samples=462,
+                  n_snps=10000000, n_chroms=22),
+}
+
+CHROM_LEN = 50000000
+
+
+def gzip_text(fname):
+    # Fixed mtime so gzip headers do not change between runs.
+    return io.TextIOWrapper(gzip.GzipFile(fname, 'wb', mtime=0))
+
+
+def gene_ids(n_genes):
+    return [ 'ENSG{:011d}'.format(i) for i in range(n_genes) ]
+
+
+def sample_ids(n_samples):
+    return [ 'NA{:05d}'.format(i) for i in range(n_samples) ]
+
+
+def write_peaks(fname, rs, n_sites, n_chroms):
+    """Write peaks of all populations, clustered around shared sites."""
+    chroms = CHROMS[:n_chroms]
+    rows = []
+    for chrom in chroms:
+        n = n_sites // n_chroms
+        sites = np.sort(rs.randint(0, CHROM_LEN, size=n))
+        for pop in POPS:
+            has_peak = rs.rand(n) < 0.4
+            starts = sites[has_peak] + \
+                rs.randint(-40, 40, size=has_peak.sum())
+            starts = np.maximum(starts, 0)
+            ends = starts + rs.randint(150, 800, size=len(starts))
+            n_reads = rs.randint(5, 300, size=len(starts))
+            fold = rs.uniform(1, 20, size=len(starts)).round(5)
+            l10p = rs.uniform(2, 50, size=len(starts)).round(5)
+            height = rs.uniform(1, 90, size=len(starts)).round(5)
+            for i in range(len(starts)):
+                rows.append((
+                    'chr' + chrom, int(starts[i]), int(ends[i]),
+                    '{}_peak{}'.format(pop, i), int(n_reads[i]), '.',
+                    float(fold[i]), float(l10p[i]), float(height[i])
+                ))
+    rows.sort(key=lambda row: (row[0], row[1]))
+    with gzip_text(fname) as f:
+        for row in rows:
+            f.write('\t'.join([ str(field) for field in row ]) + '\n')
+
+
+def write_expr(fname, rs, n_genes, n_samples):
+    """Write a gzipped GEUVADIS-style RPKM matrix."""
+    samples = sample_ids(n_samples)
+    with gzip_text(fname) as f:
+        f.write('# Synthetic RPKM\n')
+        f.write('TargetID\t' + '\t'.join(samples) + '\n')
+        for gene in gene_ids(n_genes):
+            scale = rs.exponential(10.)
+            values = rs.exponential(scale, size=n_samples)
+            f.write('{}.1\t'.format(gene) +
+                    '\t'.join([ '{:.4f}'.format(v) for v in values ]) + '\n')
+
+
+def write_dbsnp(fname, rs, n_snps, n_chroms):
+    """Write a sorted dbSNP-style BED of chrom, position, rsID."""
+    chroms = CHROMS[:n_chroms]
+    rsid = 0
+    with open(fname, 'w') as f:
+        for chrom in chroms:
+            positions = np.unique(rs.randint(0, CHROM_LEN,
+                                             size=n_snps // n_chroms))
+            lines = []
+            for pos in positions.tolist():
+                rsid += 1
+                lines.append('chr{}\t{}\trs{}\n'.format(chrom, pos, rsid))
+            f.write(''.join(lines))
+
+
+def write_gtf(fname, rs, n_genes, n_chroms):
+    """Write GENCODE-style protein coding transcripts and start codons."""
+    chroms = CHROMS[:n_chroms]
+    genes = gene_ids(n_genes)
+    with open(fname, 'w') as f:
+        f.write('##description: synthetic annotation\n')
+        for i, gene in enumerate(genes):
+            chrom = chroms[i % len(chroms)]
+            start = int(rs.randint(0, CHROM_LEN - 200000))
+            end = start + int(rs.randint(1000, 100000))
+            strand = '+' if rs.rand() < 0.5 else '-'
+            meta = 'gene_id "{}"; gene_name "GENE{}";'.format(gene, i)
+            for t in range(int(rs.randint(1, 4))):
+                tx_start = start + int(rs.randint(0, 200))
+                tx_end = end - int(rs.randint(0, 200))
+                f.write('\t'.join([
+                    'chr' + chrom, 'protein_coding', 'transcript',
+                    str(tx_start), str(tx_end), '.', strand, '.', meta
+                ]) + '\n')
+                codon = tx_start + 100 if strand == '+' else tx_end - 102
+                f.write('\t'.join([
+                    'chr' + chrom, 'protein_coding', 'start_codon',
+                    str(codon), str(codon + 2), '.', strand, '0', meta
+                ]) + '\n')
+
+
+def write_pops(named_fname, contrast_fname, rs, n_samples):
+    """Write population JSONs in the conf/ formats.
+
+    named_fname gets conf/geuvadis_pops.json style population names,
+    contrast_fname gets conf/geuvadis_afr_eur.json style "0" (AFR) and
+    "1" (EUR) groups.
+    """
+    samples = sample_ids(n_samples)
+    labels = rs.randint(0, len(GEUVADIS_POPS), size=n_samples)
+    named = { pop: [] for pop in GEUVADIS_POPS }
+    for sample, label in zip(samples, labels.tolist()):
+        named[GEUVADIS_POPS[label]] += [ sample, sample ]
+    contrast = { '0': [], '1': [] }
+    for pop in GEUVADIS_POPS:
+        contrast['0' if pop in AFR_POPS else '1'] += named[pop]
+    with open(named_fname, 'w') as f:
+        json.dump(named, f, indent=4)
+    with open(contrast_fname, 'w') as f:
+        json.dump(contrast, f, indent=4)
+
+
+def write_gene_list(fname, rs, n_genes, n_list=10):
+    genes = gene_ids(n_genes)
+    with open(fname, 'w') as f:
+        for idx in sorted(rs.choice(n_genes, size=n_list, replace=False)):
+            f.write(genes[idx] + '\n')
+
+
+def generate(dirname, scale, seed=0):
+    """Write every synthetic input for scale into dirname.
+
+    :returns: A dict from input name to file name.
+    """
+    params = SCALES[scale]
+    os.makedirs(dirname, exist_ok=True)
+    fnames = {
+        'peaks': os.path.join(dirname, 'all_peaks_sorted.bed.gz'),
+        'expr': os.path.join(dirname, 'expr.txt.gz'),
+        'dbsnp': os.path.join(dirname, 'dbsnp.bed'),
+        'gtf': os.path.join(dirname, 'annotation.gtf'),
+        'pops_named': os.path.join(dirname, 'pops.json'),
+        'pops_contrast': os.path.join(dirname, 'afr_eur.json'),
+        'genes': os.path.join(dirname, 'genes.txt'),
+    }
+    # Separate streams so changing one generator leaves the others as is.
+    write_peaks(fnames['peaks'], np.random.RandomState(seed),
+                params['n_sites'], params['n_chroms'])
+    write_expr(fnames['expr'], np.random.RandomState(seed + 1),
+               params['n_genes'], params['n_samples'])
+    write_dbsnp(fnames['dbsnp'], np.random.RandomState(seed + 2),
+                params['n_snps'], params['n_chroms'])
+    write_gtf(fnames['gtf'], np.random.RandomState(seed + 3),
+              params['n_genes'], params['n_chroms'])
+    write_pops(fnames['pops_named'], fnames['pops_contrast'],
+               np.random.RandomState(seed + 4), params['n_samples'])
+    write_gene_list(fnames['genes'], np.random.RandomState(seed + 5),
+                    params['n_genes'])
+    return fnames
+
+
+if __name__ == '__main__':
+    import sys
+    generate(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'small')
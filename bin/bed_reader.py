@@ -0,0 +1,158 @@
+"""
+Chunked reader for BED-like files that yields typed NumPy column batches.
+
+Large byte buffers are split into lines and fields once, then each column
+declared in the schema is converted with a single NumPy cast per chunk.
+Chromosome names are normalized (leading 'chr' removed) once per distinct
+name in a chunk rather than once per line.
+
+Usage:
+    from bed_reader import Column, read_bed
+    schema = [ Column('chrom', 0, str), Column('pos', 1, int),
+               Column('rsid', 2, str) ]
+    for chunk in read_bed('snps.bed', schema):
+        chunk['pos']  # np.int64 array
+"""
+from collections import namedtuple
+import numpy as np
+
+import membudget
+from threaded_gzip import open_threaded
+
+# Bytes read from the input per chunk, less under a memory budget.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# A column of the schema: output name, 0-based field index and type, one
+# of str, int or float.
+Column = namedtuple('Column', [ 'name', 'index', 'dtype' ])
+
+_NP_TYPES = { str: str, int: np.int64, float: np.float64 }
+
+
+def normalize_chroms(chroms):
+    """Remove a leading 'chr' from an array of chromosome names."""
+    names, inverse = np.unique(chroms, return_inverse=True)
+    names = np.array([
+        name[len('chr'):] if name.startswith('chr') else name
+        for name in names.tolist()
+    ], dtype=str)
+    return names[inverse.reshape(-1)] if len(names) else chroms
+
+
+def iter_chunks(source, chunk_size=None):
+    """Yield byte buffers of source that each end on a line boundary.
+
+    :source: A file name or an open file handle, text or binary. Gzip
+             files are decompressed with threaded_gzip.
+    """
+    if chunk_size is None:
+        chunk_size = membudget.chunk_size(CHUNK_SIZE)
+    close = False
+    if isinstance(source, str):
+        source = open_threaded(source, 'rb')
+        close = True
+
+    if hasattr(source, 'chunks'):
+        # ThreadedGzipFile already splits on line boundaries.
+        chunks = source.chunks()
+    else:
+        def read():
+            while True:
+                data = source.read(chunk_size)
+                if not data:
+                    break
+                yield data if isinstance(data, bytes) else data.encode()
+        chunks = read()
+
+    try:
+        rest = b''
+        for data in chunks:
+            if rest:
+                data = rest + data
+            split = data.rfind(b'\n') + 1
+            if split == 0:
+                rest = data
+                continue
+            rest = data[split:]
+            yield data[:split]
+        if rest:
+            yield rest
+    finally:
+        if close:
+            source.close()
+
+
+def split_fields(buf, sep=b'\t', delims=b'', comment=None):
+    """Split a byte buffer into a list of per-line field lists."""
+    if b'\r' in buf:
+        buf = buf.replace(b'\r', b'')
+    if delims:
+        # Treat extra delimiters, e.g. ':' and '-' in 'chr1:100-200', as
+        # field separators.
+        buf = buf.translate(bytes.maketrans(
+            delims, (sep or b' ') * len(delims)
+        ))
+    lines = buf.split(b'\n')
+    if comment is not None and (buf.startswith(comment) or
+                                b'\n' + comment in buf):
+        lines = [ line for line in lines
+                  if line and not line.startswith(comment) ]
+    else:
+        lines = [ line for line in lines if line ]
+    if sep is None:
+        return [ line.split() for line in lines ]
+    return [ line.split(sep) for line in lines ]
+
+
+def read_bed(source, columns, rest=None, sep=b'\t', chrom='chrom',
+             delims=b'', comment=None, chunk_size=None):
+    """Parse a BED-like file into typed column batches.
+
+    :source:     A file name or open file handle, see iter_chunks().
+    :columns:    A list of Column tuples to extract.
+    :rest:       Optional Column whose index is the first of the trailing
+                 fields to return together as a 2-D array.
+    :sep:        Field separator, None to split on any whitespace.
+    :chrom:      Name of the column to normalize with normalize_chroms(),
+                 None to leave chromosome names as they are.
+    :delims:     Extra bytes to treat as field separators.
+    :comment:    Skip lines starting with these bytes.
+    :chunk_size: Bytes to read per chunk, see membudget.chunk_size().
+    :yields:     A dict from column name to NumPy array, per chunk.
+    """
+    for buf in iter_chunks(source, chunk_size):
+        rows = split_fields(buf, sep, delims, comment)
+        if not rows:
+            continue
+
+        try:
+            table = np.array(rows, dtype=bytes)
+            if table.ndim != 2:
+                raise ValueError
+        except ValueError:
+            # Ragged rows, fall back to building columns one at a time.
+            table = None
+
+        batch = {}
+        for name, index, dtype in columns:
+            if table is not None:
+                col = table[:, index]
+            else:
+                col = np.array([ row[index] for row in rows ], dtype=bytes)
+            batch[name] = col.astype(_NP_TYPES[dtype])
+
+        if rest is not None:
+            name, index, dtype = rest
+            if table is not None:
+                batch[name] = table[:, index:].astype(_NP_TYPES[dtype])
+            else:
+                batch[name] = [
+                    np.array(row[index:], dtype=bytes)
+                    .astype(_NP_TYPES[dtype])
+                    for row in rows
+                ]
+
+        if chrom is not None and chrom in batch:
+            batch[chrom] = normalize_chroms(batch[chrom])
+
+        yield batch
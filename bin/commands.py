@@ -0,0 +1,99 @@
+"""
+Subcommands of bin/atac-diverge, one per pipeline script.
+
+A subcommand runs its script as __main__ with the remaining arguments,
+exactly as `python bin/<script>.py' would. Nothing is imported until a
+subcommand is chosen, so each run only pays for the imports of its own
+script. Light subcommands are those whose scripts do not import numpy or
+scipy, bench/startup.py checks that they start within its time budget.
+
+Usage:
+    bin/atac-diverge --help
+    bin/atac-diverge gtf-to-tss data/annotation.gtf > target/tss.txt
+    bin/atac-diverge diff-expr expr.txt.gz conf/afr_eur.json genes.txt
+"""
+import os
+import runpy
+import sys
+
+# Subcommand, script module, light and summary, in pipeline order.
+COMMANDS = [
+    ('peak-merge', 'peak_merge', False,
+     'Merge population peaks and write per-population signal.'),
+    ('gtf-to-tss', 'gtf_to_tss', True,
+     'Extract protein coding TSSs from a GTF annotation.'),
+    ('gene-annot', 'gene_annot', True,
+     'Build the gene annotation store from a GTF.'),
+    ('peak-to-rsid', 'peak_to_rsid', False,
+     'Map each peak to the closest unused dbSNP variant near its middle.'),
+    ('ensid-to-pop-peaks', 'ensid_to_pop_peaks', False,
+     'Peak signal of a population near the TSSs of genes.'),
+    ('expr-index', 'expr_index', True,
+     'Build the gene row index of an expression table.'),
+    ('diff-expr', 'diff_expr', False,
+     'Differential expression of genes between two populations.'),
+    ('diff-expr-batch', 'diff_expr_batch', False,
+     'diff-expr over many expression file and config pairs.'),
+    ('diff-expr-concord-perm', 'diff_expr_concord_perm', False,
+     'Permutation null of differential expression concordance.'),
+    ('gene-set-expr', 'gene_set_expr', False,
+     'Expression fold change of a gene set against a background.'),
+    ('correlate-peak-expr', 'correlate_peak_expr', False,
+     'Correlate peak signal with the expression of nearby genes.'),
+    ('continental-variance', 'continental_variance', False,
+     'Peaks differing between African and European populations.'),
+    ('outlier-european', 'outlier_european', False,
+     'Peaks where a population is an outlier among Europeans.'),
+    ('gene-accessibility', 'gene_accessibility', False,
+     'Genes x populations matrix of accessibility around TSSs.'),
+    ('query-server', 'query_server', True,
+     'Serve expression, dbSNP, TSS and peak lookups over HTTP.'),
+]
+
+PROG = 'atac-diverge'
+
+
+def command_module(name):
+    """Return the script module of a subcommand, None if unknown."""
+    name = name.replace('_', '-')
+    for command, module, _, _ in COMMANDS:
+        if command == name:
+            return module
+    return None
+
+
+def usage():
+    lines = [ 'usage: {} <command> [args ...]'.format(PROG), '',
+              'Commands (`{} <command> --help\' for their arguments):'
+              .format(PROG) ]
+    for command, _, _, summary in COMMANDS:
+        lines.append('  {:<24}{}'.format(command, summary))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in [ '-h', '--help', 'help' ]:
+        sys.stdout.write(usage())
+        return 0
+
+    module = command_module(argv[0])
+    if module is None:
+        sys.stderr.write('{}: unknown command {}\n\n{}'.format(
+            PROG, argv[0], usage()
+        ))
+        return 2
+
+    # The scripts import each other from bin/.
+    bin_dir = os.path.dirname(os.path.abspath(__file__))
+    if not bin_dir in sys.path:
+        sys.path.insert(0, bin_dir)
+    # Scripts read sys.argv themselves, run_module() sets argv[0] to the
+    # script's path.
+    sys.argv = argv
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,41 @@
-from peak_merge import ALL_POPS
+from itertools import zip_longest
 
-AFRO_POPS = sorted([ 'ESN', 'GWD', 'LWK', 'YRI'])
-EURO_POPS = sorted([ 'CEU', 'FIN', 'IBS', 'TSI'])
+from populations import ALL_POPS, AFRO_POPS, EURO_POPS
+
+def parse_peak(line):
+    base_idx = 3
+    fields = line.rstrip().split('\t')
+    chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+
+    pop_to_val = {}
+    for i, pop in enumerate(ALL_POPS):
+        pop_to_val[pop] = float(fields[base_idx + i])
+
+    return (chrom, start, end), pop_to_val
 
 def iter_peaks(infile):
     for line in infile:
-        base_idx = 3
-        fields = line.rstrip().split('\t')
-        chrom, start, end = fields[0], int(fields[1]), int(fields[2])
-        
-        pop_to_val = {}
-        for i, pop in enumerate(ALL_POPS):
-            pop_to_val[pop] = float(fields[base_idx + i])
-            
-        yield (chrom, start, end), pop_to_val
+        yield parse_peak(line)
+
+def iter_aligned_lines(infiles):
+    # Yield a tuple with a line of every file, of pop_peak_<type>.txt files
+    # written together by peak_merge.py.
+    for lines in zip_longest(*infiles):
+        if None in lines:
+            raise Exception('Signal files have different numbers of peaks')
+        yield lines
+
+def aligned_chrom(lines):
+    return lines[0].split('\t', 1)[0]
 
+def iter_peak_sets(line_sets):
+    # Same as iter_peaks() over tuples of aligned lines, yielding the
+    # coordinates and a pop_to_val per signal file.
+    for lines in line_sets:
+        peaks = [ parse_peak(line) for line in lines ]
+        coords = peaks[0][0]
+        for other, _ in peaks[1:]:
+            if other != coords:
+                raise Exception('Signal files are not aligned at {}:{}-{}'
+                                .format(*coords))
+        yield coords, [ pop_to_val for _, pop_to_val in peaks ]
@@ -1,41 +1,181 @@
-from numpy import mean
-from scipy.stats import ttest_ind
-from statsmodels.stats.multitest import multipletests
-from subprocess import check_output
-import sys
+import argparse
+from contextlib import ExitStack
+from functools import partial
+from itertools import combinations
+import numpy as np
 
-from compare_pops import EURO_POPS, AFRO_POPS, iter_peaks
+from compare_pops import (EURO_POPS, AFRO_POPS, aligned_chrom,
+                          iter_aligned_lines, iter_peak_sets)
+import instrument
+import partition
+from multitest import METHODS, StreamingCorrection, format_record
+import shard_exec
+
+TESTS = [ 'ttest', 'welch', 'ranksum', 'permutation' ]
+
+# Relative tolerance of null statistics counted as ties of the observed
+# one.
+TIE_TOL = 1e-9
+
+def label_splits(n_a, n_b):
+    # Group A membership of every split of n_a + n_b samples into groups
+    # of n_a and n_b, one split per row, the observed split first. With
+    # equal groups a split and its mirror image have opposite statistics,
+    # so only the splits with the first sample in A are kept, 35 for 4
+    # against 4.
+    n = n_a + n_b
+    splits = []
+    for group_a in combinations(range(n), n_a):
+        if n_a == n_b and group_a[0] != 0:
+            break
+        split = np.zeros(n, dtype=bool)
+        split[list(group_a)] = True
+        splits.append(split)
+    return np.array(splits)
+
+def exact_p_values(values, n_a):
+    # Two-sided p-values of the difference between the mean of the first
+    # n_a columns and of the rest, against every split of the columns.
+    splits = label_splits(n_a, values.shape[1] - n_a)
+    weights = np.where(splits, 1. / n_a, -1. / (values.shape[1] - n_a))
+    null = np.abs(values @ weights.T)
+    observed = null[:, :1]
+    return np.mean(null >= observed * (1 - TIE_TOL), axis=1)
+
+def divergence_p_values(vals_afr, vals_eur, test='ttest'):
+    """P-values of the divergence of every peak between two groups.
+
+    :vals_afr: A peaks x populations array.
+    :vals_eur: A peaks x populations array.
+    :test:     'ttest' and 'welch' for Student's and Welch's t-test,
+               'ranksum' for an exact rank-sum (Mann-Whitney) test and
+               'permutation' for an exact test of the difference of means
+               over every split of the populations, ties resolved
+               conservatively. The exact tests cannot go below one over
+               the number of distinct splits.
+    """
+    # scipy takes most of the startup time, so it is only imported by the
+    # tests that use it.
+    if test in [ 'ttest', 'welch' ]:
+        from scipy.stats import ttest_ind
+        return ttest_ind(vals_afr, vals_eur, axis=1,
+                         equal_var=test == 'ttest')[1]
+
+    values = np.hstack([ vals_afr, vals_eur ])
+    if test == 'ranksum':
+        # Rank-sum differences, with mid-ranks for ties, are the same
+        # statistic up to scale.
+        from scipy.stats import rankdata
+        values = rankdata(values, axis=1)
+    elif test != 'permutation':
+        raise ValueError('Unknown test {}'.format(test))
+    return exact_p_values(values, vals_afr.shape[1])
+
+def test_peaks(line_sets, test='ttest'):
+    # Test a shard of aligned peak lines at once, returning a list of
+    # (p-value, record) pairs per signal file.
+    coords, vals_afr, vals_eur = [], [], []
+    for coord, pop_to_vals in iter_peak_sets(line_sets):
+        coords.append(coord)
+        vals_afr.append([ [ pop_to_val[p] for p in AFRO_POPS ]
+                          for pop_to_val in pop_to_vals ])
+        vals_eur.append([ [ pop_to_val[p] for p in EURO_POPS ]
+                          for pop_to_val in pop_to_vals ])
+    if not coords:
+        return []
+    # Peaks x signal types x populations.
+    vals_afr = np.array(vals_afr)
+    vals_eur = np.array(vals_eur)
+    return [ test_signal(coords, vals_afr[:, s], vals_eur[:, s], test)
+             for s in range(vals_afr.shape[1]) ]
+
+def test_signal(coords, vals_afr, vals_eur, test):
+    with instrument.phase('stats'):
+        p_vals = divergence_p_values(vals_afr, vals_eur, test)
+    instrument.count('scipy_calls')
+
+    results = []
+    for (chrom, start, end), p, afr, eur, mean_afr, mean_eur in zip(
+            coords, p_vals.tolist(), vals_afr.tolist(), vals_eur.tolist(),
+            vals_afr.mean(axis=1).tolist(), vals_eur.mean(axis=1).tolist()
+    ):
+        record = [
+            chrom, start, end,
+            p, mean_afr, mean_eur
+        ]
+        record += afr + eur
+        results.append((p, format_record(record)))
+    return results
 
 if __name__ == '__main__':
-    infile_name = sys.argv[1]
-    
-    p_vals = []
-    records = []
-    with open(infile_name, 'r') as infile:
-        for (chrom, start, end), pop_to_val in iter_peaks(infile):
-            vals_afr = [
-                pop_to_val[p] for p in AFRO_POPS
-            ]
-            vals_eur = [
-                pop_to_val[p] for p in EURO_POPS
-            ]
-
-            t, p = ttest_ind(vals_afr, vals_eur)
-            p_vals.append(p)
-
-            record = [
-                chrom, start, end,
-                p, mean(vals_afr), mean(vals_eur)
-            ]
-            record += vals_afr + vals_eur
-            records.append(record)
-
-    reject, _, _, _ = multipletests(
-        p_vals, alpha=0.05,
-        #method='fdr_bh'
-        method='bonferroni'
+    instrument.setup('continental_variance')
+    parser = argparse.ArgumentParser(
+        description=('Peaks with different signal in African and European '
+                     'populations, Bonferroni corrected by default.')
     )
+    parser.add_argument('infile_names', nargs='+',
+                        help=('Population peak signal files with the same '
+                              'peaks, such as pop_peak_reads.txt and '
+                              'pop_peak_heights.txt.'))
+    parser.add_argument('-o', '--output', action='append',
+                        help=('Output of each signal file, in order '
+                              '(default: stdout for a single file).'))
+    parser.add_argument('-t', '--test', choices=TESTS, default='ttest',
+                        help=('Test of each peak, Student\'s t-test by '
+                              'default.'))
+    parser.add_argument('-m', '--method', choices=METHODS,
+                        default='bonferroni',
+                        help=('Multiple-testing correction (default: '
+                              'bonferroni). The exact tests cannot go below '
+                              'a p-value of 1/35, which only fdr_bh can '
+                              'reject.'))
+    parser.add_argument('--all', action='store_true',
+                        help=('Write every peak with its p-value, not only '
+                              'the rejected ones, for ranking.'))
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Processes testing shards of the peaks.')
+    shard_exec.add_arguments(parser)
+    partition.add_arguments(parser)
+    args = parser.parse_args()
+    outputs = args.output or []
+    if outputs and len(outputs) != len(args.infile_names) or \
+       not outputs and len(args.infile_names) > 1:
+        parser.error('Give an -o output per signal file')
+    if args.partition and not outputs:
+        parser.error('--partition needs -o outputs')
+    if args.rsids and not args.partition:
+        parser.error('--rsids needs a --partition')
+    
+    # Every signal type is corrected on its own, as in separate runs.
+    corrections = [
+        StreamingCorrection(args.method, alpha=0.05)
+        for _ in args.infile_names
+    ]
+    with ExitStack() as stack, instrument.phase('scan'):
+        infiles = [ stack.enter_context(open(infile_name, 'r'))
+                    for infile_name in args.infile_names ]
+        shards = shard_exec.shard_items(iter_aligned_lines(infiles),
+                                        args.shard_by, args.block_size,
+                                        key=aligned_chrom)
+        shard_exec.correct_shard_sets(
+            shard_exec.map_shards(partial(test_peaks, test=args.test),
+                                  shards, args.workers),
+            corrections
+        )
+
+    instrument.count('peaks_tested', sum(map(len, corrections)))
 
-    for p in range(len(p_vals)):
-        if reject[p]:
-            print('\t'.join([ str(f) for f in records[p] ]))
+    with instrument.phase('write'):
+        if args.rsids:
+            from peak_to_rsid import load_snps
+            snps = load_snps(args.rsids)
+        else:
+            snps = None
+        for s, correction in enumerate(corrections):
+            writer = partition.PartitionWriter(
+                outputs[s] if outputs else None, args.partition, snps
+            )
+            for record, p, reject in correction.results():
+                if reject or args.all:
+                    writer.write(record)
+            writer.close()
@@ -1,42 +1,41 @@
 #!/usr/bin/bash
 
-TYPE=reads
+TYPES=(reads heights)
+WORKERS=${WORKERS:-$(nproc)}
+# Optional memory budget, such as 16G, see bin/membudget.py.
+BUDGET=${MEMORY_BUDGET:+--memory-budget $MEMORY_BUDGET}
 
-if [ ! -e target/pop_peak_"$TYPE".txt ]
+if [ ! -e target/pop_peak_reads.txt ]
 then
     bin/main.sh
 fi
 
 echo `date`" | Finding peaks with continental divergence..."
-python bin/continental_variance.py target/pop_peak_"$TYPE".txt \
-       > target/continental_variance/"$TYPE".txt
-
-echo `date`" | Separating divergence into African and European biased..."
-awk '$5 > $6' target/continental_variance/"$TYPE".txt \
-    > target/continental_variance/"$TYPE"_biased_afr.txt
-awk '$5 < $6' target/continental_variance/"$TYPE".txt \
-    > target/continental_variance/"$TYPE"_biased_eur.txt
-
-echo `date`" | Mapping peaks to rsIDs..."
-CONTINENTS=(afr eur)
-for CONTINENT in ${CONTINENTS[@]}
-do
-    python bin/peak_to_rsid.py \
-           depict/data/trityper_CEU_hg19/SNPMappings.txt \
-           target/continental_variance/"$TYPE"_biased_"$CONTINENT".txt \
-           > target/continental_variance/"$TYPE"_biased_"$CONTINENT"_rsids.txt &
-done
-wait
+# The same run separates the divergence into African and European
+# biased peaks, <type>_biased_<continent>.txt, and maps those to rsIDs,
+# <type>_biased_<continent>_rsids.txt.
+python bin/continental_variance.py \
+       target/pop_peak_reads.txt target/pop_peak_heights.txt \
+       -o target/continental_variance/reads.txt \
+       -o target/continental_variance/heights.txt \
+       --partition biased_afr:'$5 > $6' \
+       --partition biased_eur:'$5 < $6' \
+       --rsids depict/data/trityper_CEU_hg19/SNPMappings.txt \
+       -w $WORKERS $BUDGET
 
 echo `date`" | Running DEPICT..."
-for CONTINENT in ${CONTINENTS[@]}
+CONTINENTS=(afr eur)
+for TYPE in ${TYPES[@]}
 do
-    cut -f1 target/continental_variance/"$TYPE"_biased_"$CONTINENT"_rsids.txt \
-        > depict/testfiles/"$TYPE"_biased_"$CONTINENT"_rsids.txt
-    (
-        cd depict;
-        ./depict.py "$TYPE"_biased_"$CONTINENT" continental_variance
-    ) &
+    for CONTINENT in ${CONTINENTS[@]}
+    do
+        cut -f1 target/continental_variance/"$TYPE"_biased_"$CONTINENT"_rsids.txt \
+            > depict/testfiles/"$TYPE"_biased_"$CONTINENT"_rsids.txt
+        (
+            cd depict;
+            ./depict.py "$TYPE"_biased_"$CONTINENT" continental_variance
+        ) &
+    done
 done
 wait
 
@@ -1,33 +1,57 @@
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from itertools import chain, islice
 import json
+from multiprocessing import Pool
 import numpy as np
-from scipy.stats import spearmanr, pearsonr
-from statsmodels.stats.multitest import multipletests
 import sys
 
-from diff_expr import load_expr
-from peak_merge import ALL_POPS
+from bed_reader import Column, read_bed
+import instrument
+from interval_index import load_gene_intervals
+import membudget
+from multitest import StreamingCorrection
 from peak_to_rsid import search_closest
+from populations import ALL_POPS, GEUVADIS_POPS
+import shard_exec
+import shared_arrays
 
-GEUVADIS_POPS = [ 'CEU', 'FIN', 'TSI', 'YRI' ]
 EXPR_AGG = np.mean # np.median
-CORR_TYPE = pearsonr
+CORR_TYPE = 'pearsonr' # 'spearmanr', from scipy.stats
 P_VAL_CUTOFF = 0.05
 MULTI_TEST_METHOD = 'fdr_bh'
 DIST_CUTOFF = 50000
 
+# Peak-gene pairs scored per task of the permutation null.
+PERM_CHUNK_PAIRS = 2000
+# Permutations per matrix product, bounding memory to about
+# PERM_CHUNK_PAIRS * PERM_BLOCK * populations floats.
+PERM_BLOCK = 500
+# Peaks queried at a time with --overlap.
+OVERLAP_BATCH = 10000
+
+PEAK_COLUMNS = [
+    Column('chrom', 0, str),
+    Column('start', 1, int),
+    Column('end', 2, int),
+]
+PEAK_POPS = Column('pops', 3, float)
+
 def load_tsss(tss_fname):
+    from gene_annot import iter_tss_rows
+
     tsss = {}
-    with open(tss_fname, 'r') as tss_file:
-        for line in tss_file:
-            fields = line.rstrip().split()
-            chrom = fields[0]
-            tss = int(fields[4])
-            ensid = fields[5]
-            symbol = fields[6]
-
-            if not chrom in tsss:
-                tsss[chrom] = []
-            tsss[chrom].append((tss, (ensid, symbol)))
+    for fields in iter_tss_rows(tss_fname):
+        chrom = fields[0]
+        tss = int(fields[4])
+        ensid = fields[5]
+        symbol = fields[6]
+
+        if not chrom in tsss:
+            tsss[chrom] = []
+        tsss[chrom].append((tss, (ensid, symbol)))
 
     # Sort for binary search.
     for chrom in tsss:
@@ -35,68 +59,133 @@ def load_tsss(tss_fname):
             
     return tsss
 
-def peak_to_tss(tsss, peak_fname):
-    with open(peak_fname, 'r') as peak_file:
-        for line in peak_file:
-            fields = line.rstrip().split('\t')
-            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
-            pops = [ float(f) for f in fields[3:] ]
-            if chrom.startswith('chr'):
-                chrom = chrom[len('chr'):]
+def iter_peaks(peak_fname):
+    for batch in read_bed(peak_fname, PEAK_COLUMNS, rest=PEAK_POPS):
+        yield from zip(batch['chrom'].tolist(), batch['start'].tolist(),
+                       batch['end'].tolist(),
+                       [ pops.tolist() for pops in batch['pops'] ])
+
+def tss_near(chrom_tsss, middle):
+    # Search for TSS that is closest to the middle of the peak.
+    closest, closest_idx = search_closest(middle, chrom_tsss)
+    assert(closest != None)
+    assert(closest == chrom_tsss[closest_idx])
+
+    # Forward search for TSSs within distance cutoff.
+    tss_idx = closest_idx
+    while tss_idx < len(chrom_tsss) and \
+          chrom_tsss[tss_idx][0] - middle <= DIST_CUTOFF:
+        ensid, symbol = chrom_tsss[tss_idx][1]
+        yield chrom_tsss[tss_idx][0], ensid, symbol
+        tss_idx += 1
+
+    # Backward search.
+    tss_idx = closest_idx - 1
+    while tss_idx >= 0 and \
+          middle - chrom_tsss[tss_idx][0] <= DIST_CUTOFF:
+        ensid, symbol = chrom_tsss[tss_idx][1]
+        yield chrom_tsss[tss_idx][0], ensid, symbol
+        tss_idx -= 1
+
+def peak_to_tss(tsss, peaks):
+    for chrom, start, end, pops in peaks:
+        middle = (start + end) / 2
+        for tss_pos, ensid, symbol in tss_near(tsss[chrom], middle):
+            yield chrom, start, end, pops, tss_pos, ensid, symbol
+
+def peak_to_tss_windows(tsss, peaks, windows):
+    # Pairs of peaks with every TSS within the largest window of the middle
+    # of the peak, found with a range query on the sorted TSS positions.
+    max_window = max(windows)
+    positions = {}
+    for chrom, start, end, pops in peaks:
+        if not chrom in tsss:
+            continue
+        if not chrom in positions:
+            positions[chrom] = [ tss[0] for tss in tsss[chrom] ]
+        middle = (start + end) / 2
+        lo = bisect_left(positions[chrom], middle - max_window)
+        hi = bisect_right(positions[chrom], middle + max_window)
+        for tss_pos, (ensid, symbol) in tsss[chrom][lo:hi]:
+            yield chrom, start, end, pops, tss_pos, ensid, symbol
+
+def peak_to_gene_overlap(index, peaks):
+    # Pairs of peaks with the genes whose interval in index overlaps the
+    # peak, queried a batch of peaks at a time. A gene with several
+    # overlapping transcripts is paired once, through the TSS closest to
+    # the middle of the peak.
+    peaks = iter(peaks)
+    while True:
+        batch = list(islice(peaks, OVERLAP_BATCH))
+        if not batch:
+            break
+        chroms = np.array([ peak[0] for peak in batch ], dtype=str)
+        starts = np.array([ peak[1] for peak in batch ], dtype=np.int64)
+        ends = np.array([ peak[2] for peak in batch ], dtype=np.int64)
+        peak_hits = [ [] for _ in range(len(chroms)) ]
+        for chrom in np.unique(chroms).tolist():
+            if not chrom in index:
+                continue
+            rows = np.flatnonzero(chroms == chrom)
+            query, hits = index[chrom].overlap(starts[rows], ends[rows])
+            for row, hit in zip(rows[query].tolist(), hits.tolist()):
+                peak_hits[row].append(index[chrom].values[hit])
+
+        for row, hits in enumerate(peak_hits):
+            if not hits:
+                continue
+            chrom, start, end = batch[row][:3]
             middle = (start + end) / 2
+            closest = {}
+            for tss_pos, ensid, symbol in hits:
+                if not ensid in closest or \
+                   abs(tss_pos - middle) < abs(closest[ensid][0] - middle):
+                    closest[ensid] = (tss_pos, symbol)
+            pops = batch[row][3]
+            for ensid, (tss_pos, symbol) in closest.items():
+                yield chrom, start, end, pops, tss_pos, ensid, symbol
+
+def smallest_window(distance, windows):
+    # Smallest of the sorted windows containing a TSS at distance.
+    return windows[bisect_left(windows, abs(distance))]
 
-            # Search for TSS that is closest to the middle of the peak.
-            closest, closest_idx = search_closest(middle, tsss[chrom])
-            assert(closest != None)
-            assert(closest == tsss[chrom][closest_idx])
-            closest_pos = closest[0]
-            ensid = closest[1][0]
-            symbol = closest[1][1]
-
-            # Forward search for TSSs within distance cutoff.
-            tss_idx = closest_idx
-            while tss_idx < len(tsss[chrom]) and \
-                  tsss[chrom][tss_idx][0] - middle <= DIST_CUTOFF:
-                ensid, symbol = tsss[chrom][tss_idx][1]
-                yield (chrom, start, end, pops,
-                       tsss[chrom][tss_idx][0], ensid, symbol)
-                tss_idx += 1
-
-            # Backward search.
-            tss_idx = closest_idx - 1
-            while tss_idx >= 0 and \
-                  middle - tsss[chrom][tss_idx][0] <= DIST_CUTOFF:
-                ensid, symbol = tsss[chrom][tss_idx][1]
-                yield (chrom, start, end, pops,
-                       tsss[chrom][tss_idx][0], ensid, symbol)
-                tss_idx -= 1
+def remote_peak_to_tss(client, tss_fname, expr_fname, pops, peak_fname,
+                       gene_to_expr):
+    # Same pairs as peak_to_tss(), with TSSs and expression fetched from a
+    # query server in batches of peaks. Expression of the genes in a batch
+    # is added to gene_to_expr before the batch is yielded.
+    from query_server import BATCH_SIZE
+
+    samples = sorted(set(sum([ pops[pop] for pop in GEUVADIS_POPS ], [])))
+    peaks = iter_peaks(peak_fname)
+    while True:
+        batch = list(islice(peaks, BATCH_SIZE))
+        if not batch:
+            break
+        nears = client.tss_within(
+            tss_fname, [ peak[:3] for peak in batch ]
+        )
+        ensids = set([ tss[1] for near in nears for tss in near ])
+        gene_to_expr.update(client.gene_expr(
+            expr_fname, ensids - set(gene_to_expr), samples
+        ))
+        for (chrom, start, end, peak_pops), near in zip(batch, nears):
+            for tss_pos, ensid, symbol in near:
+                yield chrom, start, end, peak_pops, tss_pos, ensid, symbol
 
 def pop_expr(gene_expr, pops, pop_name):
     return [ float(gene_expr[indiv])
              for indiv in pops[pop_name]
              if indiv in gene_expr ]
                 
-if __name__ == '__main__':
-    tss_fname = sys.argv[1]
-    peak_fname = sys.argv[2]
-    expr_fname = sys.argv[3]
-    pops_fname = sys.argv[4]
-
-    tsss = load_tsss(tss_fname)
-
-    with open(pops_fname, 'r') as pops_file:
-        pops = json.loads(pops_file.read())
-
-    gene_to_expr = load_expr(expr_fname)
-
-    pop_to_idx = {}
-    for pop_name in GEUVADIS_POPS:
-        pop_to_idx[pop_name] = ALL_POPS.index(pop_name)
-
-    p_vals = []
-    records = []
+def correlate(pairs, gene_to_expr, pops, pop_to_idx):
+    # Yield the p-value and record of every pair with a defined
+    # correlation.
+    from scipy import stats
+    corr = getattr(stats, CORR_TYPE)
     for (chrom, start, end, pop_peaks,
-         tss_pos, ensid, symbol) in peak_to_tss(tsss, peak_fname):
+         tss_pos, ensid, symbol) in pairs:
+        instrument.count('pairs')
         
         if not ensid in gene_to_expr:
             continue
@@ -115,17 +204,257 @@ if __name__ == '__main__':
            all(x == 0 for x in expr_values):
             continue
 
-        rho, p = CORR_TYPE(peak_scores, expr_values)
-        p_vals.append(p)
-        records.append([
+        with instrument.phase('stats'):
+            rho, p = corr(peak_scores, expr_values)
+        instrument.count('scipy_calls')
+        yield p, [
             chrom, start, end, tss_pos, ensid, symbol, rho, p
-        ] + peak_scores + expr_values)
+        ] + peak_scores + expr_values
+
+def correlate_shard(peaks):
+    # Pair and correlate a shard of peaks with the scan state of this
+    # process.
+    state = shard_exec.STATE
+    pairs = state['pair_peaks'](peaks)
+    return list(correlate(pairs, state['gene_to_expr'], state['pops'],
+                          state['pop_to_idx']))
+
+def assignment_matrix(labels, n_pops):
+    # Samples x (permutations * populations) matrix whose product with an
+    # expression matrix gives the mean of each population per permutation.
+    n_perms, n_samples = labels.shape
+    onehot = (labels[:, :, None] == np.arange(n_pops)).astype(float)
+    onehot /= onehot.sum(axis=1, keepdims=True)
+    return onehot.transpose(1, 0, 2).reshape(n_samples, n_perms * n_pops)
 
-    reject, _, _, _ = multipletests(
-        p_vals, alpha=P_VAL_CUTOFF,
-        method=MULTI_TEST_METHOD
+def pearson_last_axis(x, y):
+    # Pearson correlation along the last axis, broadcasting x against y.
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (x * y).sum(axis=-1) / np.sqrt(
+            (x * x).sum(axis=-1) * (y * y).sum(axis=-1)
+        )
+
+def corr_last_axis(x, y):
+    # Correlation of CORR_TYPE along the last axis, Spearman's being
+    # Pearson's of the ranks.
+    if CORR_TYPE == 'spearmanr':
+        from scipy.stats import rankdata
+        x = rankdata(x, axis=-1)
+        y = rankdata(y, axis=-1)
+    return pearson_last_axis(x, y)
+
+def count_null_exceed(task):
+    # Count, for pairs start to stop, the permutations whose correlation is
+    # at least as extreme as the observed one.
+    start, stop = task
+    arrays = shared_arrays.ARRAYS
+    labels, perm_labels = arrays['labels'], arrays['perm_labels']
+    n_pops = int(labels.max()) + 1
+
+    genes, inverse = np.unique(arrays['gene_idx'][start:stop],
+                               return_inverse=True)
+    expr = arrays['expr'][genes]
+    scores = arrays['peak_scores'][start:stop]
+
+    means = expr.dot(assignment_matrix(labels[None, :], n_pops))
+    observed = np.abs(corr_last_axis(scores, means[inverse]))
+
+    exceed = np.zeros(stop - start, dtype=int)
+    for first in range(0, len(perm_labels), PERM_BLOCK):
+        block = perm_labels[first:first + PERM_BLOCK]
+        means = expr.dot(assignment_matrix(block, n_pops)).reshape(
+            len(genes), len(block), n_pops
+        )
+        null = np.abs(corr_last_axis(scores[:, None, :], means[inverse]))
+        # Relative tolerance, so ties with the observed grouping count.
+        exceed += np.sum(null >= observed[:, None] * (1 - 1e-12), axis=1)
+    exceed = exceed.astype(float)
+    exceed[np.isnan(observed)] = np.nan
+    return start, exceed
+
+def permutation_p_values(records, gene_to_expr, pops, n_perms, seed=None,
+                         n_workers=1):
+    """Empirical p-values of the correlations of records, a list or a
+    membudget.SpillList.
+
+    Samples are shuffled between the GEUVADIS_POPS populations n_perms
+    times, keeping population sizes. Population means of every shuffle
+    are computed as matrix products and correlated, by CORR_TYPE, with
+    the peak signal of each pair, PERM_CHUNK_PAIRS pairs at a time.
+    Samples listed more than once count once.
+
+    :returns: An array of two-sided p-values, (exceeding + 1) / (n + 1),
+              NaN where the observed correlation is undefined.
+    """
+    assert(EXPR_AGG is np.mean)
+    assert(CORR_TYPE in [ 'pearsonr', 'spearmanr' ])
+
+    # Distinct samples with expression, labeled with their population.
+    some_expr = next(iter(gene_to_expr.values()), {})
+    sample_to_label = {}
+    for label, pop_name in enumerate(GEUVADIS_POPS):
+        for indiv in pops[pop_name]:
+            if indiv in some_expr and not indiv in sample_to_label:
+                sample_to_label[indiv] = label
+    samples = sorted(sample_to_label)
+    labels = np.array([ sample_to_label[indiv] for indiv in samples ],
+                      dtype=np.int8)
+
+    rand = np.random.RandomState(seed)
+    perm_labels = np.array([ rand.permutation(labels)
+                             for _ in range(n_perms) ], dtype=np.int8)
+
+    ensids = sorted(set([ record[4] for record in records ]))
+    ensid_to_idx = { ensid: idx for idx, ensid in enumerate(ensids) }
+    n_pops = len(GEUVADIS_POPS)
+    arrays = {
+        'labels': labels,
+        'perm_labels': perm_labels.reshape(n_perms, len(samples)),
+        'expr': np.array([
+            [ float(gene_to_expr[ensid][indiv]) for indiv in samples ]
+            for ensid in ensids
+        ]).reshape(len(ensids), len(samples)),
+        'gene_idx': np.array([ ensid_to_idx[record[4]]
+                               for record in records ], dtype=int),
+        'peak_scores': np.array([ record[8:8 + n_pops]
+                                  for record in records ],
+                                dtype=float).reshape(len(records), n_pops),
+    }
+    tasks = [ (start, min(start + PERM_CHUNK_PAIRS, len(records)))
+              for start in range(0, len(records), PERM_CHUNK_PAIRS) ]
+
+    exceed = np.zeros(len(records))
+    if n_workers > 1:
+        with shared_arrays.publish(arrays) as shared:
+            with Pool(n_workers, initializer=shared_arrays.init_worker,
+                      initargs=(shared.spec,)) as pool:
+                for start, counts in pool.imap_unordered(count_null_exceed,
+                                                         tasks):
+                    exceed[start:start + len(counts)] = counts
+    else:
+        shared_arrays.ARRAYS.update(arrays)
+        for start, counts in map(count_null_exceed, tasks):
+            exceed[start:start + len(counts)] = counts
+    instrument.count('permutations', n_perms)
+    return (exceed + 1) / (n_perms + 1)
+
+if __name__ == '__main__':
+    instrument.setup('correlate_peak_expr')
+    parser = argparse.ArgumentParser(
+        description=('Correlate population peak signal with the expression '
+                     'of genes with a TSS near the peak.')
     )
+    parser.add_argument('tss_fname',
+                        help=('Output of gtf_to_tss.py or a gene_annot.py '
+                              'store.'))
+    parser.add_argument('peak_fname', help='Population peak signal file.')
+    parser.add_argument('expr_fname')
+    parser.add_argument('pops_fname',
+                        help='JSON from population name to samples.')
+    parser.add_argument('--windows', type=int, nargs='+', metavar='BP',
+                        help=('Pair peaks with TSSs within the largest of '
+                              'these distances and append the signed '
+                              'distance and the smallest window containing '
+                              'it (default: {} bp, no extra columns).'
+                              .format(DIST_CUTOFF)))
+    parser.add_argument('--overlap', choices=[ 'body', 'promoter' ],
+                        help=('Pair peaks with the genes whose body or '
+                              'promoter overlaps them, instead of by '
+                              'distance to the TSS.'))
+    parser.add_argument('--permutations', type=int, default=0, metavar='N',
+                        help=('Also append an empirical p-value from N '
+                              'shuffles of samples between populations.'))
+    parser.add_argument('--seed', type=int,
+                        help='Random seed of the permutations.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help=('Processes correlating shards of the peaks '
+                              'and scoring the permutations.'))
+    shard_exec.add_arguments(parser)
+    parser.add_argument('--server', metavar='URL',
+                        help=('Fetch TSSs and expression from a running '
+                              'query_server.py.'))
+    args = parser.parse_args()
+    if args.windows and args.server:
+        parser.error('--windows is not supported with --server')
+    if args.overlap and (args.windows or args.server):
+        parser.error('--overlap is not supported with --windows or --server')
+
+    with instrument.phase('parse'):
+        with open(args.pops_fname, 'r') as pops_file:
+            pops = json.loads(pops_file.read())
+
+        # Each mode imports what it uses here, --help needs none of it.
+        if args.server:
+            from query_server import QueryClient
+            gene_to_expr = {}
+        elif args.overlap:
+            from diff_expr import load_expr
+            gene_index = load_gene_intervals(args.tss_fname, args.overlap)
+            gene_to_expr = load_expr(args.expr_fname)
+        else:
+            from diff_expr import load_expr
+            tsss = load_tsss(args.tss_fname)
+            gene_to_expr = load_expr(args.expr_fname)
+
+    pop_to_idx = {}
+    for pop_name in GEUVADIS_POPS:
+        pop_to_idx[pop_name] = ALL_POPS.index(pop_name)
+
+    if args.overlap:
+        pair_peaks = partial(peak_to_gene_overlap, gene_index)
+    elif args.windows:
+        windows = sorted(args.windows)
+        pair_peaks = partial(peak_to_tss_windows, tsss, windows=windows)
+    elif not args.server:
+        pair_peaks = partial(peak_to_tss, tsss)
+
+    correction = StreamingCorrection(MULTI_TEST_METHOD, alpha=P_VAL_CUTOFF)
+    with instrument.phase('scan'):
+        if args.server:
+            pairs = remote_peak_to_tss(
+                QueryClient(args.server), args.tss_fname,
+                args.expr_fname, pops, args.peak_fname, gene_to_expr
+            )
+            results = correlate(pairs, gene_to_expr, pops, pop_to_idx)
+        else:
+            shards = shard_exec.shard_items(iter_peaks(args.peak_fname),
+                                            args.shard_by, args.block_size)
+            results = chain.from_iterable(shard_exec.map_shards(
+                correlate_shard, shards, args.workers, state={
+                    'pair_peaks': pair_peaks, 'gene_to_expr': gene_to_expr,
+                    'pops': pops, 'pop_to_idx': pop_to_idx,
+                }
+            ))
+
+        if args.permutations:
+            # The null needs every record at once, records beyond the
+            # memory budget are spilled to disk.
+            p_vals, records = array('d'), membudget.SpillList('records')
+            for p, record in results:
+                p_vals.append(p)
+                records.append(record)
+            with instrument.phase('permute'):
+                perm_p_vals = permutation_p_values(
+                    records, gene_to_expr, pops, args.permutations,
+                    seed=args.seed, n_workers=args.workers
+                )
+            results = zip(p_vals, records)
+
+        for idx, (p, record) in enumerate(results):
+            if args.windows:
+                # Filter a window W of the sweep with `$N <= W' on the
+                # window column.
+                chrom, start, end, tss_pos = record[:4]
+                distance = tss_pos - (start + end) / 2
+                record.extend([ distance,
+                                smallest_window(distance, windows) ])
+            if args.permutations:
+                record.append(perm_p_vals[idx])
+            correction.add(p, record)
 
-    for p in range(len(p_vals)):
-#        if reject[p]:
-        print('\t'.join([ str(f) for f in records[p] ]))
+    with instrument.phase('write'):
+        for record, p, reject in correction.results():
+#            if reject:
+            sys.stdout.write(record)
@@ -1,12 +1,18 @@
-import gzip
+import argparse
 import json
 import numpy as np
 import pickle
-from scipy.stats import ttest_ind
 import sys
 
+import instrument
+import membudget
+from threaded_gzip import open_threaded
+
 verbose = False
 
+# Bytes of load_expr() maps per byte of expression text.
+EXPR_EXPANSION = 15
+
 def load_col(fname, col_pos, col_type=str):
     col = []
     with open(fname, 'r') as f:
@@ -15,79 +21,277 @@ def load_col(fname, col_pos, col_type=str):
             col.append(col_type(fields[col_pos]))
     return col
 
-def load_expr(fname, gene_pos=0):
-    gene_to_expr = {}
+def iter_expr_rows(fname, gene_pos=0, genes=None):
+    """Yield the header fields, then (gene, fields) per row.
 
-    is_gzip = fname.endswith('.gz')
-    opener = gzip.open if is_gzip else open
-    with opener(fname, 'r') as expr_file:
+    Gene IDs lose their version suffix. With genes, only the rows of those
+    genes are yielded, read through the file's expr_index.py index if it
+    has a current one.
+    """
+    if genes is not None:
+        import expr_index
+        index = expr_index.open_index(fname, gene_pos)
+        if index is not None:
+            yield index.header
+            yield from index.rows(genes)
+            return
+        genes = set(genes)
+
+    with open_threaded(fname) as expr_file:
         header = None
         for line in expr_file:
-            if is_gzip:
-                line = line.decode('utf-8')
-            
             if line.startswith('#'):
                 continue
             if header == None:
                 header = line.rstrip().split()
+                yield header
                 continue
 
             fields = line.rstrip().split()
             gene = fields[gene_pos]
             if '.' in gene:
                 gene = gene.split('.')[0]
-                
-            gene_to_expr[gene] = {}
-            for pos, h in enumerate(header):
-                if pos == gene_pos:
-                    continue
-                gene_to_expr[gene][h] = fields[pos]
+            if genes is None or gene in genes:
+                yield gene, fields
+
+def load_expr(fname, gene_pos=0, genes=None):
+    """Load a map from gene to a map from sample to expression string.
+
+    :genes: Only load these genes, see iter_expr_rows().
+
+    All genes of a file that does not fit the memory budget are read
+    through its expr_index.py index on lookup instead, if it has one.
+    """
+    if genes is None and not membudget.fits(
+            'expr', membudget.file_estimate(fname, EXPR_EXPANSION)):
+        import expr_index
+        index = expr_index.open_index(fname, gene_pos)
+        if index is not None:
+            return expr_index.IndexedExpr(index, gene_pos)
+        sys.stderr.write('Warning: {} does not fit the memory budget, '
+                         'index it with expr_index.py\n'.format(fname))
+        membudget.use('expr', membudget.file_estimate(fname,
+                                                      EXPR_EXPANSION))
+
+    gene_to_expr = {}
+
+    rows = iter_expr_rows(fname, gene_pos, genes)
+    header = next(rows, None)
+    for gene, fields in rows:
+        gene_to_expr[gene] = {}
+        for pos, h in enumerate(header):
+            if pos == gene_pos:
+                continue
+            gene_to_expr[gene][h] = fields[pos]
                 
     return gene_to_expr
 
-if __name__ == '__main__':
-    expr_fname = sys.argv[1]
-    pops_fname = sys.argv[2]
-    gene_fname = sys.argv[3]
+def load_expr_matrix(fname, gene_pos=0, genes=None):
+    """Load an expression file as a float matrix.
 
-    with open('data/ensg_to_gene_symbol.pickle', 'rb') as f:
-        ensg_to_gene_symbol = pickle.load(f)
+    Genes are deduplicated on their unversioned ID like load_expr(), the
+    last row of a gene wins.
 
-    with open(pops_fname, 'r') as pops_file:
-        pops = json.loads(pops_file.read())
-        
-    genes = load_col(gene_fname, 0)
+    :genes:   Only load these genes, see iter_expr_rows().
+    :returns: A list of genes, a list of samples and a genes x samples
+              float64 matrix.
+    """
+    gene_to_row = {}
+    rows = []
+    expr_rows = iter_expr_rows(fname, gene_pos, genes)
+    header = next(expr_rows, [])
+    for gene, fields in expr_rows:
+        del fields[gene_pos]
+        if gene in gene_to_row:
+            rows[gene_to_row[gene]] = fields
+        else:
+            gene_to_row[gene] = len(rows)
+            rows.append(fields)
+
+    samples = header[:gene_pos] + header[gene_pos + 1:]
+    matrix = np.array(rows, dtype=float).reshape(len(rows), len(samples))
+    return list(gene_to_row), samples, matrix
 
-    gene_to_expr = load_expr(expr_fname)
+def pops_expr(gene_expr, pops):
+    # Expression values of each population, populations in '0', '1', ...
+    # order.
+    pops_expr = []
+    for p in range(len(pops)):
+        pop = list(set(pops[str(p)]))
+        pop_expr = []
+        for indiv in pop:
+            if indiv in gene_expr:
+                pop_expr.append(float(gene_expr[indiv]))
+        pops_expr.append(pop_expr)
+    return pops_expr
 
+def diff_expr(genes, pops, gene_to_expr):
+    """Yield gene, per-population medians and t-test p-value, per gene."""
+    # Imported here, scipy is slow to import and load_expr() users do
+    # not need it.
+    from scipy.stats import ttest_ind
     for gene in genes:
         if not gene in gene_to_expr:
             if verbose:
                 sys.stderr.write('Warning: Could not find gene {}\n'
                                  .format(gene))
             continue
-        
-        pops_expr = []
-        for p in range(len(pops)):
-            pop = list(set(pops[str(p)]))
-            pop_expr = []
-            for indiv in pop:
-                if indiv in gene_to_expr[gene]:
-                    pop_expr.append(float(gene_to_expr[gene][indiv]))
-            pops_expr.append(pop_expr)
 
+        gene_pops_expr = pops_expr(gene_to_expr[gene], pops)
+        medians = [ np.percentile(pop_expr, 50)
+                    for pop_expr in gene_pops_expr ]
+        with instrument.phase('stats'):
+            p_val = ttest_ind(gene_pops_expr[0], gene_pops_expr[1],
+                              equal_var=True)[1]
+        instrument.count('scipy_calls')
+        yield gene, medians, p_val
+
+def diff_expr_matrix(genes, pops, expr_genes, samples, expr):
+    """Same as diff_expr(), computed over all genes at once.
+
+    :expr_genes: Genes of the rows of expr.
+    :samples:    Samples of the columns of expr.
+    :returns:    Found genes, a genes x populations array of medians and
+                 an array of p-values.
+    """
+    from scipy.stats import ttest_ind
+    gene_to_row = { gene: row for row, gene in enumerate(expr_genes) }
+    found = []
+    for gene in genes:
+        if gene in gene_to_row:
+            found.append(gene)
+        elif verbose:
+            sys.stderr.write('Warning: Could not find gene {}\n'
+                             .format(gene))
+    expr = expr[[ gene_to_row[gene] for gene in found ]]
+
+    sample_idx = { sample: idx for idx, sample in enumerate(samples) }
+    blocks = [
+        expr[:, sorted([ sample_idx[indiv] for indiv in set(pops[str(p)])
+                         if indiv in sample_idx ])]
+        for p in range(len(pops))
+    ]
+    medians = np.column_stack([
+        np.median(block, axis=1) for block in blocks
+    ])
+    with instrument.phase('stats'):
+        p_vals = ttest_ind(blocks[0], blocks[1], axis=1, equal_var=True)[1]
+    instrument.count('scipy_calls')
+    return found, medians, p_vals
+
+def top_n(values, n, ascending=False):
+    """Indices of the n largest values, largest first.
+
+    With ascending, the n smallest values, smallest first. Ties keep their
+    input order and NaNs rank last.
+    """
+    values = np.asarray(values, dtype=float)
+    if ascending:
+        values = -values
+    values = np.where(np.isnan(values), -np.inf, values)
+    candidates = np.arange(len(values))
+    if n < len(values):
+        # Only order the values at least as large as the n-th largest.
+        kth = np.partition(values, len(values) - n)[len(values) - n]
+        candidates = np.flatnonzero(values >= kth)
+    order = np.argsort(-values[candidates], kind='stable')
+    return candidates[order][:n]
+
+if __name__ == '__main__':
+    instrument.setup('diff_expr')
+    parser = argparse.ArgumentParser(
+        description=('Median expression per population and t-test p-value '
+                     'of population 0 against 1, per gene.')
+    )
+    parser.add_argument('expr_fname')
+    parser.add_argument('pops_fname',
+                        help='JSON of populations "0", "1", ...')
+    parser.add_argument('gene_fname',
+                        help=('Genes in the first column, or set:NAME of '
+                              'the --annot store.'))
+    parser.add_argument('--vectorized', action='store_true',
+                        help=('Compute all genes at once as matrix '
+                              'operations.'))
+    parser.add_argument('--top', type=int, metavar='N',
+                        help=('Only write the N genes with the highest '
+                              'median in population 1, highest first.'))
+    parser.add_argument('--ascending', action='store_true',
+                        help='With --top, the lowest medians instead.')
+    parser.add_argument('--server', metavar='URL',
+                        help='Fetch expression from a running '
+                             'query_server.py.')
+    parser.add_argument('--annot', metavar='DB',
+                        help=('Symbols and gene sets from a gene_annot.py '
+                              'store instead of '
+                              'data/ensg_to_gene_symbol.pickle.'))
+    args = parser.parse_args()
+
+    with instrument.phase('parse'):
+        # The annotation store and the query server client are imported
+        # here, --help does not need them.
+        from gene_annot import GeneAnnot, load_genes
+        annot = GeneAnnot(args.annot) if args.annot else None
+
+        with open(args.pops_fname, 'r') as pops_file:
+            pops = json.loads(pops_file.read())
+            
+        genes = load_genes(args.gene_fname, annot)
+
+        if annot is not None:
+            ensg_to_gene_symbol = annot.symbols(genes)
+        else:
+            with open('data/ensg_to_gene_symbol.pickle', 'rb') as f:
+                ensg_to_gene_symbol = pickle.load(f)
+
+        if args.server:
+            from query_server import QueryClient
+            samples = sorted(set(sum(pops.values(), [])))
+            gene_to_expr = QueryClient(args.server).gene_expr(
+                args.expr_fname, genes, samples
+            )
+        elif args.vectorized:
+            expr_genes, samples, expr = load_expr_matrix(args.expr_fname,
+                                                         genes=genes)
+        else:
+            gene_to_expr = load_expr(args.expr_fname, genes=genes)
+
+        if args.vectorized and args.server:
+            expr_genes = list(gene_to_expr)
+            # Only the samples the server returned, as load_expr_matrix()
+            # only has the samples of the file's header.
+            samples = [ sample for sample in samples
+                        if all([ sample in gene_to_expr[gene]
+                                 for gene in expr_genes ]) ]
+            expr = np.array([
+                [ float(gene_to_expr[gene][sample]) for sample in samples ]
+                for gene in expr_genes
+            ]).reshape(len(expr_genes), len(samples))
+    instrument.count('genes_loaded',
+                     len(expr_genes) if args.vectorized else
+                     len(gene_to_expr))
+
+    if args.vectorized:
+        results = zip(*diff_expr_matrix(genes, pops, expr_genes, samples,
+                                        expr))
+    else:
+        results = diff_expr(genes, pops, gene_to_expr)
+
+    if args.top is not None:
+        # Rank on the fourth column, population 1's median.
+        results = list(results)
+        results = [ results[idx] for idx in top_n(
+            [ medians[1] for _, medians, _ in results ], args.top,
+            ascending=args.ascending
+        ) ]
+
+    for gene, medians, p_val in results:
         if gene in ensg_to_gene_symbol:
             symbol = ensg_to_gene_symbol[gene]
         else:
             symbol = gene
             
         sys.stdout.write('{}\t{}'.format(gene, symbol))
-        for pop_expr in pops_expr:
-            sys.stdout.write('\t{:.2f}'.format(
-                np.percentile(pop_expr, 50),
-            ))
-        sys.stdout.write('\t{}'.format(
-            ttest_ind(pops_expr[0], pops_expr[1],
-                      equal_var=True)[1]
-        ))
+        for median in medians:
+            sys.stdout.write('\t{:.2f}'.format(median))
+        sys.stdout.write('\t{}'.format(p_val))
         sys.stdout.write('\n')
@@ -5,9 +5,10 @@ cat $1 | \
     cut -f $2 \
         > diff_expr.tmp
 
+# Was `sort -k4,4g -r | head -n10', where -r does not apply to the
+# g-ordered key, so the lowest population 1 medians come first.
 python bin/diff_expr.py \
        /godot/geuvadis/expression_analysis_results/GD462.GeneQuantRPKM.50FN.samplename.resk10.txt.gz \
        conf/geuvadis_afr_eur.json \
-       diff_expr.tmp | \
-    sort -k4,4g -r | \
-    head -n10
+       --vectorized --top 10 --ascending \
+       diff_expr.tmp
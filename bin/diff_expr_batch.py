@@ -0,0 +1,118 @@
+"""
+Differential expression of one gene list over many pairs of expression
+file and population config, as with diff_expr.py --vectorized.
+
+Each expression file is parsed once and every config paired with it is
+evaluated against the same matrix. Different expression files are handled
+by separate worker processes. Output is one table with a row per
+expression file, config and gene:
+
+    expr_fname, pops_fname, gene, symbol, median per population, p-value
+
+grouped by expression file, then config, in the order first given.
+
+Usage:
+    python bin/diff_expr_batch.py genes.txt \
+        -p geuvadis.txt.gz conf/geuvadis_afr_eur.json \
+        -p gtex.txt.gz conf/gtex_afr_eur.json -w 2
+"""
+import argparse
+import json
+from multiprocessing import Pool
+import pickle
+import sys
+
+from diff_expr import diff_expr_matrix, load_expr_matrix, top_n
+import instrument
+
+def source_diff_expr(task):
+    # Evaluate every config of one expression file against one parse of
+    # it.
+    expr_fname, configs, genes, top, ascending = task
+    expr_genes, samples, expr = load_expr_matrix(expr_fname)
+
+    results = []
+    for pops_fname, pops in configs:
+        found, medians, p_vals = diff_expr_matrix(genes, pops, expr_genes,
+                                                  samples, expr)
+        if top is None:
+            order = range(len(found))
+        else:
+            order = top_n(medians[:, 1], top, ascending=ascending)
+        results.append((pops_fname, [
+            (found[idx], medians[idx].tolist(), p_vals[idx].item())
+            for idx in order
+        ]))
+    return expr_fname, results
+
+if __name__ == '__main__':
+    instrument.setup('diff_expr_batch')
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gene_fname',
+                        help=('Genes in the first column, or set:NAME of '
+                              'the --annot store.'))
+    parser.add_argument('-p', '--pair', nargs=2, action='append',
+                        required=True, metavar=('EXPR', 'POPS'),
+                        help=('Expression file and population config, may '
+                              'be repeated.'))
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Expression files parsed in parallel.')
+    parser.add_argument('--top', type=int, metavar='N',
+                        help=('Only write the N genes with the highest '
+                              'median in population 1 per pair.'))
+    parser.add_argument('--ascending', action='store_true',
+                        help='With --top, the lowest medians instead.')
+    parser.add_argument('--annot', metavar='DB',
+                        help=('Symbols and gene sets from a gene_annot.py '
+                              'store instead of '
+                              'data/ensg_to_gene_symbol.pickle.'))
+    args = parser.parse_args()
+
+    with instrument.phase('parse'):
+        from gene_annot import GeneAnnot, load_genes
+        annot = GeneAnnot(args.annot) if args.annot else None
+
+        genes = load_genes(args.gene_fname, annot)
+
+        if annot is not None:
+            ensg_to_gene_symbol = annot.symbols(genes)
+        else:
+            with open('data/ensg_to_gene_symbol.pickle', 'rb') as f:
+                ensg_to_gene_symbol = pickle.load(f)
+
+        # Group the configs by expression file, keeping the given order.
+        source_configs = {}
+        for expr_fname, pops_fname in args.pair:
+            with open(pops_fname, 'r') as pops_file:
+                pops = json.loads(pops_file.read())
+            source_configs.setdefault(expr_fname, []).append(
+                (pops_fname, pops)
+            )
+
+    tasks = [ (expr_fname, configs, genes, args.top, args.ascending)
+              for expr_fname, configs in source_configs.items() ]
+
+    with instrument.phase('stats'):
+        if args.workers > 1 and len(tasks) > 1:
+            pool = Pool(min(args.workers, len(tasks)))
+            results = pool.imap(source_diff_expr, tasks)
+        else:
+            pool = None
+            results = map(source_diff_expr, tasks)
+
+        for expr_fname, source_results in results:
+            for pops_fname, rows in source_results:
+                for gene, medians, p_val in rows:
+                    symbol = ensg_to_gene_symbol.get(gene, gene)
+                    sys.stdout.write('{}\t{}\t{}\t{}'.format(
+                        expr_fname, pops_fname, gene, symbol
+                    ))
+                    for median in medians:
+                        sys.stdout.write('\t{:.2f}'.format(median))
+                    sys.stdout.write('\t{}\n'.format(p_val))
+            instrument.count('sources')
+
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -1,43 +1,95 @@
+import argparse
 import json
+from multiprocessing import Pool
 import numpy as np
-import random
-import sys
 
-from diff_expr import load_col, load_expr
+from diff_expr import load_expr_matrix
+import instrument
+import shared_arrays
 
 N_PERMUTATIONS = 1000
 
-if __name__ == '__main__':
-    expr_fname = sys.argv[1]
-    pops_fname = sys.argv[2]
-    n_genes = int(sys.argv[3])
-    n_one_direction = int(sys.argv[4])
-
-    assert(n_one_direction <= n_genes)
-
-    with open(pops_fname, 'r') as pops_file:
-        pops = json.loads(pops_file.read())
+# Permutations per task handed to a worker.
+TASK_SIZE = 50
 
-    gene_to_expr = load_expr(expr_fname)
+def count_concordant(task):
+    # Count the permutations of n_genes random genes in which at least
+    # n_one_direction genes have a higher median in population 0.
+    n_perms, n_genes, n_one_direction, seed = task
+    arrays = shared_arrays.ARRAYS
+    expr, cols0, cols1 = arrays['expr'], arrays['cols0'], arrays['cols1']
 
+    rand = np.random.RandomState(seed)
     n = 0
-    for _ in range(N_PERMUTATIONS):
-        n_one_direction_rand = 0
-        for _ in range(n_genes):
-            gene = random.choice(list(gene_to_expr.keys()))
-
-            pops_expr = []
-            for p in range(len(pops)):
-                pop = list(set(pops[str(p)]))
-                pop_expr = []
-                for indiv in pop:
-                    if indiv in gene_to_expr[gene]:
-                        pop_expr.append(float(gene_to_expr[gene][indiv]))
-                pops_expr.append(pop_expr)
-
-            if np.median(pops_expr[0]) > np.median(pops_expr[1]):
-                n_one_direction_rand += 1
+    for _ in range(n_perms):
+        genes = rand.randint(expr.shape[0], size=n_genes)
+        sampled = expr[genes]
+        n_one_direction_rand = np.sum(
+            np.median(sampled[:, cols0], axis=1) >
+            np.median(sampled[:, cols1], axis=1)
+        )
         if n_one_direction_rand >= n_one_direction:
             n += 1
+    return n
+
+def pop_columns(samples, pop):
+    sample_idx = { sample: idx for idx, sample in enumerate(samples) }
+    return np.array(sorted([ sample_idx[indiv] for indiv in set(pop)
+                             if indiv in sample_idx ]), dtype=int)
+
+if __name__ == '__main__':
+    instrument.setup('diff_expr_concord_perm')
+    parser = argparse.ArgumentParser(
+        description=('Permutation p-value of n_one_direction out of n_genes '
+                     'genes having higher median expression in population '
+                     '0 than in population 1.')
+    )
+    parser.add_argument('expr_fname')
+    parser.add_argument('pops_fname')
+    parser.add_argument('n_genes', type=int)
+    parser.add_argument('n_one_direction', type=int)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help=('Worker processes, sharing one copy of the '
+                              'expression matrix (default: 1).'))
+    parser.add_argument('--seed', type=int,
+                        help='Random seed, for reproducible p-values.')
+    args = parser.parse_args()
+
+    assert(args.n_one_direction <= args.n_genes)
+
+    with instrument.phase('parse'):
+        with open(args.pops_fname, 'r') as pops_file:
+            pops = json.loads(pops_file.read())
+
+        genes, samples, expr = load_expr_matrix(args.expr_fname)
+
+    # One independent random stream per task, so the p-value for a seed
+    # does not depend on the number of workers.
+    seeds = np.random.SeedSequence(args.seed).generate_state(
+        -(-N_PERMUTATIONS // TASK_SIZE)
+    )
+    tasks = [
+        (min(TASK_SIZE, N_PERMUTATIONS - i * TASK_SIZE), args.n_genes,
+         args.n_one_direction, int(seed))
+        for i, seed in enumerate(seeds)
+    ]
+
+    with instrument.phase('stats'):
+        arrays = {
+            'expr': expr,
+            'cols0': pop_columns(samples, pops['0']),
+            'cols1': pop_columns(samples, pops['1']),
+        }
+        if args.workers > 1:
+            with shared_arrays.publish(arrays) as shared:
+                del expr, arrays
+                with Pool(args.workers,
+                          initializer=shared_arrays.init_worker,
+                          initargs=(shared.spec,)) as pool:
+                    n = sum(pool.imap_unordered(count_concordant, tasks))
+        else:
+            shared_arrays.ARRAYS.update(arrays)
+            n = sum(map(count_concordant, tasks))
+    instrument.count('permutations', N_PERMUTATIONS)
 
     print('p = {}'.format(n / N_PERMUTATIONS))
@@ -1,7 +1,23 @@
+import os
 import sys
 
+from bed_reader import Column, read_bed
+import instrument
+import membudget
+
 SIGNAL_TYPE = 'reads'
 
+USAGE = ('usage: ensid_to_pop_peaks.py [--server URL] ensid_fname '
+         'analysis_type population [pops_fname]\n')
+
+# `rsid chr:start-end' lines, split on ':' and '-' as well.
+RSID_MAP_COLUMNS = [
+    Column('rsid', 0, str),
+    Column('chrom', 1, str),
+    Column('start', 2, int),
+    Column('end', 3, int),
+]
+
 def load_loci(loci_fname):
     ensid_to_rsids = {}
     with open(loci_fname, 'r') as loci_file:
@@ -19,58 +35,116 @@ def load_loci(loci_fname):
 
 def load_rsid_map(rsid_map_fname):
     rsid_to_peak = {}
-    with open(rsid_map_fname, 'r') as rsid_map_file:
-        for line in rsid_map_file:
-            fields = line.rstrip().split()
-            rsid = fields[0]
-            chrom = fields[1].split(':')[0].replace('chr', '')
-            start, end = fields[1].split(':')[1].split('-')
-            start, end = int(start), int(end)
+    for batch in read_bed(rsid_map_fname, RSID_MAP_COLUMNS, sep=None,
+                          delims=b':-'):
+        for rsid, chrom, start, end in zip(
+                batch['rsid'].tolist(), batch['chrom'].tolist(),
+                batch['start'].tolist(), batch['end'].tolist()):
             assert(not rsid in rsid_to_peak)
             rsid_to_peak[rsid] = (chrom, start, end)
     return rsid_to_peak
 
-def load_pops(pops_fname):
+def load_pops(pops_fname, peaks=None):
+    """Load a map from (chrom, start, end) to population signal.
+
+    :peaks: Only keep these peaks, chromosomes without 'chr'.
+    """
+    if pops_fname.endswith('.npz'):
+        return load_pops_bundle(pops_fname, peaks=peaks)
+    if peaks is not None:
+        peaks = set(peaks)
+
     peak_to_pops = {}
     with open(pops_fname, 'r') as pops_file:
         for line in pops_file:
             fields = line.rstrip().split()
             chrom = fields[0].replace('chr', '')
             start, end = int(fields[1]), int(fields[2])
-            pops = [ float(f) for f in fields[3:] ]
             peak = (chrom, start, end)
+            if peaks is not None and not peak in peaks:
+                continue
+            pops = [ float(f) for f in fields[3:] ]
             assert(not peak in peak_to_pops)
             peak_to_pops[peak] = pops
     return peak_to_pops
 
+def load_pops_bundle(bundle_fname, signal_type=SIGNAL_TYPE, peaks=None):
+    from peak_merge import load_bundle
+
+    # Rows of the bundle are already aligned, so no parsing or joins. A
+    # bundle larger than the memory budget is mapped instead of read.
+    mmap = not membudget.fits('pops', os.path.getsize(bundle_fname))
+    bundle = load_bundle(bundle_fname, mmap=mmap)
+    chroms = [ chrom.replace('chr', '') for chrom in bundle['chrom'] ]
+    coords = zip(chroms, bundle['start'].tolist(), bundle['end'].tolist())
+    if peaks is None:
+        return dict(zip(coords, bundle[signal_type].tolist()))
+
+    # Only the rows of the peaks asked for are read from the signal.
+    peaks = set(peaks)
+    rows = [ (row, peak) for row, peak in enumerate(coords)
+             if peak in peaks ]
+    signal = bundle[signal_type][[ row for row, _ in rows ]]
+    return dict(zip([ peak for _, peak in rows ], signal.tolist()))
+
 if __name__ == '__main__':
+    instrument.setup('ensid_to_pop_peaks')
+    if len(sys.argv) > 1 and sys.argv[1] in [ '-h', '--help' ]:
+        sys.stdout.write(USAGE)
+        sys.exit(0)
+    # The query server client is only imported with --server.
+    server = None
+    if [ arg for arg in sys.argv if arg.split('=')[0] == '--server' ]:
+        from query_server import QueryClient, server_arg
+        server = server_arg()
+    if len(sys.argv) < 4:
+        sys.exit(USAGE.rstrip())
     ensid_fname = sys.argv[1]
 
     analysis_type = sys.argv[2]
     population = sys.argv[3]
 
-    with open(ensid_fname, 'r') as ensid_file:
-        ensids = ensid_file.read().rstrip().split()
-
-    loci_fname = ('depict/results/{}_{}_biased_{}_loci.txt'
-                  .format(analysis_type, SIGNAL_TYPE, population))
-    ensid_to_rsids = load_loci(loci_fname)
+    with instrument.phase('parse'):
+        with open(ensid_fname, 'r') as ensid_file:
+            ensids = ensid_file.read().rstrip().split()
 
-    rsid_map_fname = ('target/{}/{}_biased_{}_rsids.txt'
+        loci_fname = ('depict/results/{}_{}_biased_{}_loci.txt'
                       .format(analysis_type, SIGNAL_TYPE, population))
-    rsid_to_peak = load_rsid_map(rsid_map_fname)
+        ensid_to_rsids = load_loci(loci_fname)
+
+        rsid_map_fname = ('target/{}/{}_biased_{}_rsids.txt'
+                          .format(analysis_type, SIGNAL_TYPE, population))
+        rsid_to_peak = load_rsid_map(rsid_map_fname)
 
-    pops_fname = 'target/pop_peak_{}.txt'.format(SIGNAL_TYPE)
-    peak_to_pops = load_pops(pops_fname)
+        if len(sys.argv) > 4:
+            # Optional bundle written by `peak_merge.py --bundle'.
+            pops_fname = sys.argv[4]
+        else:
+            pops_fname = 'target/pop_peak_{}.txt'.format(SIGNAL_TYPE)
+        # Only the peaks of the requested genes are needed.
+        peaks = sorted(set([
+            rsid_to_peak[rsid]
+            for ensid in ensids if ensid in ensid_to_rsids
+            for rsid in ensid_to_rsids[ensid] if rsid in rsid_to_peak
+        ]))
+        if server:
+            signals = QueryClient(server).peak_signal(
+                pops_fname, peaks
+            )
+            peak_to_pops = { peak: pops for peak, pops in zip(peaks, signals)
+                             if pops is not None }
+        else:
+            peak_to_pops = load_pops(pops_fname, peaks)
 
-    for ensid in ensids:
-        rsids = ensid_to_rsids[ensid]
-        for rsid in rsids:
-            peak = rsid_to_peak[rsid]
-            pops = peak_to_pops[peak]
+    with instrument.phase('write'):
+        for ensid in ensids:
+            rsids = ensid_to_rsids[ensid]
+            for rsid in rsids:
+                peak = rsid_to_peak[rsid]
+                pops = peak_to_pops[peak]
 
-            print('{}\t{}\t{}:{}-{}\t{}'.format(
-                ensid, rsid, peak[0], peak[1], peak[2],
-                '\t'.join([ str(p) for p in pops ])
-            ))
+                print('{}\t{}\t{}:{}-{}\t{}'.format(
+                    ensid, rsid, peak[0], peak[1], peak[2],
+                    '\t'.join([ str(p) for p in pops ])
+                ))
     
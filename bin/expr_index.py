@@ -0,0 +1,317 @@
+"""
+Gene-keyed row index of expression tables, so that a short gene list can
+be fetched without parsing the whole file.
+
+The index is a sidecar, <expr file>.gidx, with the offset of the header
+row and of the row of every gene. Offsets are BGZF virtual offsets,
+(block offset << 16) | offset in the block, for bgzip-compressed files
+and byte offsets for uncompressed ones. Ordinary gzip files cannot be
+read from an offset and are recompressed to BGZF first with --bgzip.
+An index is ignored once its expression file changes.
+
+Under a memory budget, load_expr() returns an IndexedExpr for an
+indexed file that does not fit, reading the rows of genes as they are
+looked up. Uncompressed files are then memory-mapped.
+
+Usage:
+    python bin/expr_index.py expr.txt.bgz
+    python bin/expr_index.py expr.txt.gz --bgzip expr.txt.bgz
+
+    from diff_expr import load_expr
+    gene_to_expr = load_expr('expr.txt.bgz', genes=[ 'ENSG00000000003' ])
+"""
+import argparse
+from collections import OrderedDict
+from collections.abc import Mapping
+import gzip
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import instrument
+from threaded_gzip import inflate, is_bgzf, read_bgzf_block
+
+INDEX_SUFFIX = '.gidx'
+
+# Uncompressed bytes per BGZF block written by bgzip(), as bgzip does.
+BGZF_BLOCK_SIZE = 0xff00
+
+# Rows kept by IndexedExpr, genes are often looked up again soon.
+ROW_CACHE = 1024
+
+_BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+
+
+def index_fname(expr_fname):
+    return expr_fname + INDEX_SUFFIX
+
+
+def _file_stamp(fname):
+    stat = os.stat(fname)
+    return '{}\t{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _row_gene(line, gene_pos):
+    return line.split()[gene_pos].split(b'.')[0].decode()
+
+
+def _bgzf_lines(fname):
+    """Yield (virtual offset, line) of a BGZF file."""
+    with open(fname, 'rb') as raw:
+        coffset = 0
+        pending, pending_offset = b'', None
+        while True:
+            payload, block_size = read_bgzf_block(raw, coffset)
+            if payload is None:
+                break
+            data = inflate(payload)
+            pos = 0
+            while pos < len(data):
+                if not pending:
+                    pending_offset = (coffset << 16) | pos
+                newline = data.find(b'\n', pos)
+                if newline < 0:
+                    pending += data[pos:]
+                    break
+                yield pending_offset, pending + data[pos:newline + 1]
+                pending = b''
+                pos = newline + 1
+            coffset += block_size
+        if pending:
+            yield pending_offset, pending
+
+
+def _plain_lines(fname):
+    """Yield (byte offset, line) of an uncompressed file."""
+    with open(fname, 'rb') as f:
+        offset = 0
+        for line in f:
+            yield offset, line
+            offset += len(line)
+
+
+def build_index(expr_fname, gene_pos=0):
+    """Write the .gidx index of a BGZF or uncompressed expression file."""
+    if is_bgzf(expr_fname):
+        kind, lines = 'bgzf', _bgzf_lines(expr_fname)
+    else:
+        with open(expr_fname, 'rb') as f:
+            if f.read(2) == b'\x1f\x8b':
+                raise Exception('{} is gzip but not BGZF, recompress it with '
+                                '--bgzip first'.format(expr_fname))
+        kind, lines = 'plain', _plain_lines(expr_fname)
+
+    header_offset = None
+    gene_to_offset = {}
+    for offset, line in lines:
+        if line.startswith(b'#') or not line.strip():
+            continue
+        if header_offset is None:
+            header_offset = offset
+            continue
+        # The last row of a gene wins, like load_expr().
+        gene_to_offset[_row_gene(line, gene_pos)] = offset
+
+    with open(index_fname(expr_fname), 'w') as index_file:
+        index_file.write('#gidx\t{}\t{}\t{}\n'.format(
+            kind, gene_pos, _file_stamp(expr_fname)
+        ))
+        index_file.write('#header\t{}\n'.format(header_offset))
+        for gene, offset in gene_to_offset.items():
+            index_file.write('{}\t{}\n'.format(gene, offset))
+    return len(gene_to_offset)
+
+
+def _bgzf_block(data):
+    compress = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = compress.compress(data) + compress.flush()
+    # BSIZE is the total block size minus one.
+    bsize = _BGZF_HEADER.size + len(payload) + 8 - 1
+    return (_BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize) +
+            payload + struct.pack('<II', zlib.crc32(data), len(data)))
+
+
+def bgzip(src_fname, dst_fname):
+    """Recompress a gzip or plain file to BGZF, like `bgzip'."""
+    opener = gzip.open if src_fname.endswith('.gz') else open
+    with opener(src_fname, 'rb') as src, open(dst_fname, 'wb') as dst:
+        while True:
+            data = src.read(BGZF_BLOCK_SIZE)
+            if not data:
+                break
+            dst.write(_bgzf_block(data))
+        # Empty end-of-file block.
+        dst.write(_bgzf_block(b''))
+
+
+class ExprIndex(object):
+
+    """Rows of an expression file fetched through its .gidx index."""
+
+    def __init__(self, expr_fname, kind, header_offset, gene_to_offset):
+        self.expr_fname = expr_fname
+        self.kind = kind
+        self.gene_to_offset = gene_to_offset
+        self._block = (None, None, 0)
+        self._raw = None
+        with open(expr_fname, 'rb') as raw:
+            self.header = self._read_line(raw, header_offset).split()
+
+    def __getstate__(self):
+        # Files are reopened by the process the index is copied to.
+        state = dict(self.__dict__)
+        state['_block'] = (None, None, 0)
+        state['_raw'] = None
+        return state
+
+    def __contains__(self, gene):
+        return gene in self.gene_to_offset
+
+    def __len__(self):
+        return len(self.gene_to_offset)
+
+    def _read_block(self, raw, coffset):
+        # Keep the last inflated block, rows of nearby genes share it.
+        if self._block[0] != coffset:
+            payload, block_size = read_bgzf_block(raw, coffset)
+            data = None if payload is None else inflate(payload)
+            self._block = (coffset, data, block_size)
+        return self._block[1], self._block[2]
+
+    def _read_line(self, raw, offset):
+        if self.kind == 'plain':
+            if isinstance(raw, mmap.mmap):
+                end = raw.find(b'\n', offset)
+                line = raw[offset:] if end < 0 else raw[offset:end]
+                return line.rstrip(b'\r').decode()
+            raw.seek(offset)
+            return raw.readline().rstrip(b'\r\n').decode()
+
+        coffset, pos = offset >> 16, offset & 0xffff
+        parts = []
+        while True:
+            data, block_size = self._read_block(raw, coffset)
+            if data is None:
+                break
+            newline = data.find(b'\n', pos)
+            if newline >= 0:
+                parts.append(data[pos:newline])
+                break
+            parts.append(data[pos:])
+            coffset += block_size
+            pos = 0
+        return b''.join(parts).rstrip(b'\r').decode()
+
+    def rows(self, genes):
+        """Yield (gene, fields) of the genes found, in file order."""
+        offsets = sorted(set([ (self.gene_to_offset[gene], gene)
+                               for gene in genes
+                               if gene in self.gene_to_offset ]))
+        with open(self.expr_fname, 'rb') as raw:
+            for offset, gene in offsets:
+                yield gene, self._read_line(raw, offset).split()
+
+    def row(self, gene):
+        """Return the fields of the row of gene, from a file kept open.
+
+        Uncompressed files are memory-mapped, so rows are read from the
+        page cache rather than held by the process.
+        """
+        if self._raw is None:
+            raw = open(self.expr_fname, 'rb')
+            if self.kind == 'plain':
+                with raw:
+                    self._raw = mmap.mmap(raw.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+            else:
+                self._raw = raw
+        return self._read_line(self._raw, self.gene_to_offset[gene]).split()
+
+    def close(self):
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+
+
+class IndexedExpr(Mapping):
+
+    """Map from gene to a map from sample to expression string, like
+    load_expr(), reading rows through an ExprIndex as genes are looked up.
+    """
+
+    def __init__(self, index, gene_pos=0):
+        self.index = index
+        self.samples = [ (pos, h) for pos, h in enumerate(index.header)
+                         if pos != gene_pos ]
+        self._rows = OrderedDict()
+
+    def __getitem__(self, gene):
+        if gene in self._rows:
+            self._rows.move_to_end(gene)
+            return self._rows[gene]
+        if not gene in self.index:
+            raise KeyError(gene)
+        fields = self.index.row(gene)
+        expr = { h: fields[pos] for pos, h in self.samples }
+        self._rows[gene] = expr
+        if len(self._rows) > ROW_CACHE:
+            self._rows.popitem(last=False)
+        return expr
+
+    def __contains__(self, gene):
+        return gene in self.index
+
+    def __iter__(self):
+        return iter(self.index.gene_to_offset)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def open_index(expr_fname, gene_pos=0):
+    """Return the ExprIndex of expr_fname, or None without a current one."""
+    fname = index_fname(expr_fname)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'r') as index_file:
+        meta = index_file.readline().rstrip('\n').split('\t')
+        if meta[0] != '#gidx' or int(meta[2]) != gene_pos or \
+           '\t'.join(meta[3:]) != _file_stamp(expr_fname):
+            return None
+        header_offset = int(index_file.readline().rstrip().split('\t')[1])
+        gene_to_offset = {}
+        for line in index_file:
+            gene, offset = line.rstrip('\n').split('\t')
+            gene_to_offset[gene] = int(offset)
+    return ExprIndex(expr_fname, meta[1], header_offset, gene_to_offset)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('expr_fname')
+    parser.add_argument('--bgzip', metavar='OUT',
+                        help=('Recompress expr_fname to BGZF as OUT and '
+                              'index OUT.'))
+    parser.add_argument('--gene-pos', type=int, default=0,
+                        help='Column of the gene IDs (default: 0).')
+    args = parser.parse_args(argv)
+
+    expr_fname = args.expr_fname
+    if args.bgzip:
+        with instrument.phase('bgzip'):
+            bgzip(expr_fname, args.bgzip)
+        expr_fname = args.bgzip
+    with instrument.phase('scan'):
+        n_genes = build_index(expr_fname, args.gene_pos)
+    instrument.count('genes_indexed', n_genes)
+    sys.stderr.write('Indexed {} genes in {}\n'.format(
+        n_genes, index_fname(expr_fname)
+    ))
+
+
+if __name__ == '__main__':
+    instrument.setup('expr_index')
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Genes x populations matrix of peak accessibility within windows around
+each gene's TSSs.
+
+Merged peaks are placed at their middle. Per chromosome the peaks are
+sorted and the population signal is turned into prefix sums, for sums,
+and a sparse table, for maxima, so the aggregate of any window costs two
+binary searches and two array lookups, for every gene and window size.
+A gene's window spans from its first TSS minus the window to its last
+TSS plus the window.
+
+Output is a TSV with a row per gene and window,
+
+    ensid, symbol, window, one column per population
+
+or, for an output name ending in .npz, arrays genes, symbols, windows,
+pops and values (windows x genes x populations).
+
+Usage:
+    python bin/gene_accessibility.py target/tss.txt \
+        target/pop_peak_reads.txt -w 10000 50000 100000 -a sum \
+        -o target/gene_accessibility.txt
+"""
+import argparse
+import numpy as np
+import sys
+
+from bed_reader import Column, read_bed
+import instrument
+from populations import ALL_POPS
+
+PEAK_COLUMNS = [
+    Column('chrom', 0, str),
+    Column('start', 1, int),
+    Column('end', 2, int),
+]
+PEAK_POPS = Column('pops', 3, float)
+
+AGGREGATES = [ 'sum', 'max' ]
+
+
+def load_peak_signal(signal_fname, signal_type='reads'):
+    """Load peak middles and population signal, sorted per chromosome.
+
+    :signal_fname: A pop_peak_<type>.txt file, or a bundle written by
+                   `peak_merge.py --bundle', of which signal_type is used.
+    :returns:      A dict from chromosome to (middles, signal), signal a
+                   peaks x populations array.
+    """
+    chroms, middles, signal = [], [], []
+    if signal_fname.endswith('.npz'):
+        from peak_merge import load_bundle
+        bundle = load_bundle(signal_fname)
+        chroms.append(np.array([ chrom.replace('chr', '')
+                                 for chrom in bundle['chrom'] ], dtype=str))
+        middles.append((bundle['start'] + bundle['end']) / 2)
+        signal.append(np.asarray(bundle[signal_type], dtype=float))
+    else:
+        for batch in read_bed(signal_fname, PEAK_COLUMNS, rest=PEAK_POPS):
+            chroms.append(batch['chrom'])
+            middles.append((batch['start'] + batch['end']) / 2)
+            signal.append(np.array(batch['pops'], dtype=float))
+
+    n_pops = len(ALL_POPS)
+    chroms = np.concatenate(chroms) if chroms else np.zeros(0, dtype=str)
+    middles = np.concatenate(middles) if middles else np.zeros(0)
+    signal = np.concatenate(signal).reshape(-1, n_pops) if signal \
+        else np.zeros((0, n_pops))
+
+    chrom_signal = {}
+    for chrom in np.unique(chroms).tolist():
+        rows = np.flatnonzero(chroms == chrom)
+        order = rows[np.argsort(middles[rows], kind='stable')]
+        chrom_signal[chrom] = (middles[order], signal[order])
+    return chrom_signal
+
+
+def load_gene_tsss(tss_fname):
+    """Load the first and last TSS of each gene from gtf_to_tss.py output
+    or an annotation store.
+
+    :returns: A list of (ensid, symbol, chrom, first TSS, last TSS), in
+              order of first appearance.
+    """
+    from gene_annot import iter_tss_rows
+
+    genes = {}
+    for fields in iter_tss_rows(tss_fname):
+        chrom, tss, ensid, symbol = \
+            fields[0], int(fields[4]), fields[5], fields[6]
+        if ensid in genes:
+            gene = genes[ensid]
+            gene[3] = min(gene[3], tss)
+            gene[4] = max(gene[4], tss)
+        else:
+            genes[ensid] = [ ensid, symbol, chrom, tss, tss ]
+    return [ tuple(gene) for gene in genes.values() ]
+
+
+def prefix_sums(signal):
+    """Prefix sums of signal rows, with a leading row of zeros."""
+    prefix = np.zeros((len(signal) + 1, signal.shape[1]))
+    np.cumsum(signal, axis=0, out=prefix[1:])
+    return prefix
+
+
+def sparse_table(signal):
+    """Levels of maxima of signal over runs of 1, 2, 4, ... rows."""
+    table = [ signal ]
+    width = 1
+    while 2 * width <= len(signal):
+        prior = table[-1]
+        table.append(np.maximum(prior[:-width], prior[width:]))
+        width *= 2
+    return table
+
+
+def range_sums(prefix, lo, hi):
+    """Sums of rows lo to hi - 1, per range."""
+    return prefix[hi] - prefix[lo]
+
+
+def range_maxes(table, lo, hi):
+    """Maxima of rows lo to hi - 1 per range, zero for empty ranges."""
+    maxes = np.zeros((len(lo), table[0].shape[1]))
+    lengths = hi - lo
+    nonempty = lengths > 0
+    # Two overlapping runs of the largest power of two within the range.
+    levels = np.zeros(len(lo), dtype=int)
+    levels[nonempty] = np.floor(np.log2(lengths[nonempty])).astype(int)
+    for level in np.unique(levels[nonempty]).tolist():
+        rows = np.flatnonzero(nonempty & (levels == level))
+        maxes[rows] = np.maximum(table[level][lo[rows]],
+                                 table[level][hi[rows] - (1 << level)])
+    return maxes
+
+
+def gene_accessibility(genes, chrom_signal, windows, aggregate='sum'):
+    """Aggregate peak signal within each window around each gene.
+
+    :returns: A windows x genes x populations array.
+    """
+    values = np.zeros((len(windows), len(genes), len(ALL_POPS)))
+    chroms = np.array([ gene[2] for gene in genes ], dtype=str)
+    firsts = np.array([ gene[3] for gene in genes ], dtype=np.int64)
+    lasts = np.array([ gene[4] for gene in genes ], dtype=np.int64)
+
+    for chrom in np.unique(chroms).tolist():
+        if not chrom in chrom_signal:
+            continue
+        middles, signal = chrom_signal[chrom]
+        if aggregate == 'sum':
+            prefix = prefix_sums(signal)
+        else:
+            table = sparse_table(signal)
+
+        rows = np.flatnonzero(chroms == chrom)
+        for w, window in enumerate(windows):
+            lo = np.searchsorted(middles, firsts[rows] - window, side='left')
+            hi = np.searchsorted(middles, lasts[rows] + window, side='right')
+            if aggregate == 'sum':
+                values[w, rows] = range_sums(prefix, lo, hi)
+            else:
+                values[w, rows] = range_maxes(table, lo, hi)
+    return values
+
+
+def write_matrix(out_fname, genes, windows, values):
+    if out_fname.endswith('.npz'):
+        np.savez(out_fname,
+                 genes=np.array([ gene[0] for gene in genes ], dtype=str),
+                 symbols=np.array([ gene[1] for gene in genes ], dtype=str),
+                 windows=np.array(windows), pops=np.array(ALL_POPS),
+                 values=values)
+        return
+
+    out = sys.stdout if out_fname == '-' else open(out_fname, 'w')
+    try:
+        for g, gene in enumerate(genes):
+            for w, window in enumerate(windows):
+                out.write('{}\t{}\t{}\t{}\n'.format(
+                    gene[0], gene[1], window,
+                    '\t'.join([ '{:.6g}'.format(value)
+                                for value in values[w, g].tolist() ])
+                ))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    instrument.setup('gene_accessibility')
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tss_fname',
+                        help=('Output of gtf_to_tss.py or a gene_annot.py '
+                              'store.'))
+    parser.add_argument('signal_fname',
+                        help='pop_peak_<type>.txt or a peak_merge bundle.')
+    parser.add_argument('-w', '--windows', type=int, nargs='+',
+                        default=[ 50000 ], metavar='BP',
+                        help='Window sizes around the TSSs (default: 50000).')
+    parser.add_argument('-a', '--aggregate', choices=AGGREGATES,
+                        default='sum')
+    parser.add_argument('-s', '--signal', choices=[ 'reads', 'heights' ],
+                        default='reads',
+                        help='Signal of a bundle to use (default: reads).')
+    parser.add_argument('-o', '--output', default='-',
+                        help='TSV, or .npz, output (default: stdout).')
+    args = parser.parse_args()
+    instrument.set_output(args.output if args.output != '-' else None)
+
+    with instrument.phase('parse'):
+        genes = load_gene_tsss(args.tss_fname)
+        chrom_signal = load_peak_signal(args.signal_fname, args.signal)
+
+    with instrument.phase('aggregate'):
+        windows = sorted(args.windows)
+        values = gene_accessibility(genes, chrom_signal, windows,
+                                    args.aggregate)
+    instrument.count('genes', len(genes))
+
+    with instrument.phase('write'):
+        write_matrix(args.output, genes, windows, values)
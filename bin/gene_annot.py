@@ -0,0 +1,266 @@
+"""
+Gene annotation store, an indexed SQLite file built once from the GTF
+with the ENSG ID to symbol table and named gene lists.
+
+Tables:
+
+    genes        ensid, symbol, chrom, start, end, strand
+    transcripts  chrom, start, end, strand, tss, ensid, symbol, the rows
+                 of gtf_to_tss.py in the same order
+    gene_sets    name, pos, ensid
+
+A gene's coordinates span its protein coding transcripts. Symbols come
+from the symbol table where it has the gene and from the GTF otherwise,
+genes only in the symbol table have no coordinates. Queries open the
+store on first use and look genes up in batches, so a script reads only
+the rows it needs.
+
+The store can stand in for the output of gtf_to_tss.py wherever that is
+read, and for gene list files as `set:NAME' with --annot.
+
+Usage:
+    python bin/gene_annot.py target/annot.db --gtf data/annotation.gtf \
+        --symbols data/ensg_to_gene_symbol.pickle \
+        --gene-set depict depict/data/Genes.txt
+
+    from gene_annot import GeneAnnot
+    annot = GeneAnnot('target/annot.db')
+    ensg_to_symbol = annot.symbols([ 'ENSG00000161652' ])
+"""
+import argparse
+import os
+import pickle
+import sqlite3
+import sys
+
+import instrument
+from threaded_gzip import open_threaded
+
+SCHEMA = '''
+CREATE TABLE genes (
+    ensid TEXT PRIMARY KEY, symbol TEXT,
+    chrom TEXT, start INTEGER, end INTEGER, strand TEXT
+);
+CREATE TABLE transcripts (
+    chrom TEXT, start INTEGER, end INTEGER, strand TEXT, tss INTEGER,
+    ensid TEXT, symbol TEXT
+);
+CREATE INDEX transcripts_ensid ON transcripts (ensid);
+CREATE INDEX transcripts_tss ON transcripts (chrom, tss);
+CREATE TABLE gene_sets (
+    name TEXT, pos INTEGER, ensid TEXT, PRIMARY KEY (name, pos)
+);
+'''
+
+# Genes per IN (...) query, under SQLite's limit on bound parameters.
+QUERY_BATCH = 500
+
+SET_PREFIX = 'set:'
+
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def is_annot(fname):
+    """True if fname is a SQLite file, such as an annotation store."""
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+    except IOError:
+        return False
+
+
+def build(db_fname, gtf_fname=None, tss_fname=None, symbol_fname=None,
+          gene_sets=()):
+    """Write an annotation store, replacing db_fname.
+
+    :gtf_fname:    GTF annotation, parsed as by gtf_to_tss.py.
+    :tss_fname:    Output of gtf_to_tss.py, instead of gtf_fname.
+    :symbol_fname: Pickle of a dict from ENSG ID to symbol.
+    :gene_sets:    (name, file name) pairs, genes in the first column.
+    """
+    from gtf_to_tss import iter_tsss
+
+    if os.path.exists(db_fname):
+        os.remove(db_fname)
+    conn = sqlite3.connect(db_fname)
+    conn.executescript(SCHEMA)
+
+    genes = {}
+    def add_transcripts(rows):
+        for chrom, start, end, strand, tss, ensid, symbol in rows:
+            start, end, tss = int(start), int(end), int(tss)
+            if ensid in genes:
+                gene = genes[ensid]
+                gene[3] = min(gene[3], start)
+                gene[4] = max(gene[4], end)
+            else:
+                genes[ensid] = [ ensid, symbol, chrom, start, end, strand ]
+            yield chrom, start, end, strand, tss, ensid, symbol
+
+    if gtf_fname is not None:
+        with open_threaded(gtf_fname) as gtf_file:
+            conn.executemany('INSERT INTO transcripts VALUES (?,?,?,?,?,?,?)',
+                             add_transcripts(iter_tsss(gtf_file)))
+    elif tss_fname is not None:
+        with open(tss_fname, 'r') as tss_file:
+            conn.executemany('INSERT INTO transcripts VALUES (?,?,?,?,?,?,?)',
+                             add_transcripts(line.rstrip().split()
+                                             for line in tss_file))
+
+    if symbol_fname is not None:
+        with open(symbol_fname, 'rb') as f:
+            ensg_to_gene_symbol = pickle.load(f)
+        for ensid, symbol in ensg_to_gene_symbol.items():
+            if ensid in genes:
+                genes[ensid][1] = symbol
+            else:
+                genes[ensid] = [ ensid, symbol, None, None, None, None ]
+    conn.executemany('INSERT INTO genes VALUES (?,?,?,?,?,?)',
+                     genes.values())
+
+    for name, fname in gene_sets:
+        with open(fname, 'r') as f:
+            ensids = [ line.split()[0] for line in f if line.strip() ]
+        conn.executemany('INSERT INTO gene_sets VALUES (?,?,?)',
+                         [ (name, pos, ensid)
+                           for pos, ensid in enumerate(ensids) ])
+    conn.commit()
+    conn.close()
+    return len(genes)
+
+
+class GeneAnnot(object):
+
+    """Lazily opened, read-only annotation store."""
+
+    def __init__(self, db_fname):
+        self.db_fname = db_fname
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                'file:{}?mode=ro'.format(os.path.abspath(self.db_fname)),
+                uri=True, check_same_thread=False
+            )
+        return self._conn
+
+    def _lookup(self, query, ensids):
+        # Yield the rows of query for ensids, QUERY_BATCH at a time.
+        ensids = list(dict.fromkeys(ensids))
+        for first in range(0, len(ensids), QUERY_BATCH):
+            batch = ensids[first:first + QUERY_BATCH]
+            yield from self.conn.execute(
+                query.format(','.join([ '?' ] * len(batch))), batch
+            )
+
+    def symbols(self, ensids):
+        """Return a dict from ENSG ID to symbol of the ensids found."""
+        return dict(self._lookup(
+            'SELECT ensid, symbol FROM genes WHERE ensid IN ({})', ensids
+        ))
+
+    def genes(self, ensids):
+        """Return a dict from ENSG ID to (symbol, chrom, start, end,
+        strand) of the ensids found.
+        """
+        return { row[0]: row[1:] for row in self._lookup(
+            'SELECT * FROM genes WHERE ensid IN ({})', ensids
+        ) }
+
+    def transcripts(self, chrom=None):
+        """Yield the transcript rows, in gtf_to_tss.py order."""
+        if chrom is None:
+            return self.conn.execute(
+                'SELECT * FROM transcripts ORDER BY rowid'
+            )
+        return self.conn.execute(
+            'SELECT * FROM transcripts WHERE chrom = ? ORDER BY rowid',
+            (chrom,)
+        )
+
+    def gene_set(self, name):
+        """Return the genes of a named set, in the order added."""
+        ensids = [ row[0] for row in self.conn.execute(
+            'SELECT ensid FROM gene_sets WHERE name = ? ORDER BY pos',
+            (name,)
+        ) ]
+        if not ensids:
+            raise KeyError('No gene set {} in {}'.format(name, self.db_fname))
+        return ensids
+
+    def gene_set_names(self):
+        return [ row[0] for row in self.conn.execute(
+            'SELECT DISTINCT name FROM gene_sets ORDER BY name'
+        ) ]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def iter_tss_rows(tss_fname):
+    """Yield the fields of gtf_to_tss.py output, or of a store's
+    transcripts.
+    """
+    if is_annot(tss_fname):
+        annot = GeneAnnot(tss_fname)
+        try:
+            for row in annot.transcripts():
+                yield [ str(f) for f in row ]
+        finally:
+            annot.close()
+        return
+    with open(tss_fname, 'r') as tss_file:
+        for line in tss_file:
+            yield line.rstrip().split()
+
+
+def load_genes(fname, annot=None):
+    """Genes in the first column of fname, or the genes of the set NAME
+    for fname `set:NAME' with an annotation store.
+    """
+    if fname.startswith(SET_PREFIX) and annot is not None:
+        return annot.gene_set(fname[len(SET_PREFIX):])
+    with open(fname, 'r') as f:
+        return [ line.rstrip().split()[0] for line in f ]
+
+
+def annot_arg(argv=None):
+    """Remove `--annot DB' from argv, returning the store or None."""
+    argv = sys.argv if argv is None else argv
+    if not '--annot' in argv:
+        return None
+    idx = argv.index('--annot')
+    db_fname = argv[idx + 1]
+    del argv[idx:idx + 2]
+    return GeneAnnot(db_fname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db_fname', help='Store to write.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--gtf', help='GTF annotation.')
+    source.add_argument('--tss', help='Output of gtf_to_tss.py.')
+    parser.add_argument('--symbols',
+                        help='Pickle of a dict from ENSG ID to symbol.')
+    parser.add_argument('--gene-set', nargs=2, action='append', default=[],
+                        metavar=('NAME', 'FILE'),
+                        help='Named gene list, may be repeated.')
+    args = parser.parse_args(argv)
+
+    with instrument.phase('scan'):
+        n_genes = build(args.db_fname, gtf_fname=args.gtf,
+                        tss_fname=args.tss, symbol_fname=args.symbols,
+                        gene_sets=args.gene_set)
+    instrument.count('genes_written', n_genes)
+    sys.stderr.write('Wrote {} genes to {}\n'.format(n_genes, args.db_fname))
+
+
+if __name__ == '__main__':
+    instrument.setup('gene_annot')
+    sys.exit(main())
@@ -1,10 +1,12 @@
 import json
 from math import log
 import numpy as np
-from scipy.stats import ttest_ind
 import sys
 
-from diff_expr import load_col, load_expr
+import instrument
+
+USAGE = ('usage: gene_set_expr.py [--server URL] [--annot DB] expr_fname '
+         'pops_fname gene_fname [background_fname]\n')
 
 def load_fold_diffs(genes, pops, gene_to_expr):
     genes_fold_diffs = []
@@ -34,24 +36,55 @@ def load_fold_diffs(genes, pops, gene_to_expr):
     return genes_fold_diffs
 
 if __name__ == '__main__':
+    instrument.setup('gene_set_expr')
+    if len(sys.argv) > 1 and sys.argv[1] in [ '-h', '--help' ]:
+        sys.stdout.write(USAGE)
+        sys.exit(0)
+    # The query server client and the annotation store are only imported
+    # when their options are given. Gene lists can be set:NAME of a
+    # gene_annot.py store.
+    server, annot = None, None
+    if [ arg for arg in sys.argv if arg.split('=')[0] == '--server' ]:
+        from query_server import QueryClient, server_arg
+        server = server_arg()
+    if '--annot' in sys.argv:
+        from gene_annot import annot_arg
+        annot = annot_arg()
+    if len(sys.argv) < 4:
+        sys.exit(USAGE.rstrip())
     expr_fname = sys.argv[1]
     pops_fname = sys.argv[2]
     gene_fname = sys.argv[3]
-    if len(sys.argv) < 5:
-        background_fname = 'depict/data/Genes.txt'
-    else:
+    if len(sys.argv) >= 5:
         background_fname = sys.argv[4]        
+    elif annot is not None and 'depict' in annot.gene_set_names():
+        background_fname = 'set:depict'
+    else:
+        background_fname = 'depict/data/Genes.txt'
 
-    gene_to_expr = load_expr(expr_fname)
-    with open(pops_fname, 'r') as pops_file:
-        pops = json.loads(pops_file.read())
-    genes = load_col(gene_fname, 0)
-    background = load_col(background_fname, 0)
+    with instrument.phase('parse'):
+        with open(pops_fname, 'r') as pops_file:
+            pops = json.loads(pops_file.read())
+        from gene_annot import load_genes
+        try:
+            genes = load_genes(gene_fname, annot)
+            background = load_genes(background_fname, annot)
+        except KeyError as e:
+            sys.exit('gene_set_expr.py: {}'.format(e.args[0]))
+        if server:
+            samples = sorted(set(sum(pops.values(), [])))
+            gene_to_expr = QueryClient(server).gene_expr(
+                expr_fname, set(genes + background), samples
+            )
+        else:
+            from diff_expr import load_expr
+            gene_to_expr = load_expr(expr_fname, genes=genes + background)
 
-    candidate_fold_diffs = load_fold_diffs(genes,
-                                           pops, gene_to_expr)
-    background_fold_diffs = load_fold_diffs(background,
-                                            pops, gene_to_expr)
+    with instrument.phase('stats'):
+        candidate_fold_diffs = load_fold_diffs(genes,
+                                               pops, gene_to_expr)
+        background_fold_diffs = load_fold_diffs(background,
+                                                pops, gene_to_expr)
 
     for i, fd in enumerate([
             candidate_fold_diffs, background_fold_diffs
@@ -62,6 +95,7 @@ if __name__ == '__main__':
             np.percentile(fd, 50),
             np.percentile(fd, 75)
         ))
+    from scipy.stats import ttest_ind
     print('t-test p = {}'.format(
         ttest_ind(candidate_fold_diffs, background_fold_diffs,
                   equal_var=True)[1]
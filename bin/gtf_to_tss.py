@@ -1,6 +1,8 @@
-import gzip
 import sys
 
+import instrument
+from threaded_gzip import open_threaded
+
 def parse_meta(meta_str):
     meta = {}
     for elem in meta_str.rstrip(';').split(';'):
@@ -9,47 +11,53 @@ def parse_meta(meta_str):
         meta[name] = val
     return meta
 
+def iter_tsss(gtf_file):
+    """Yield chrom, start, end, strand, TSS, ENSG ID and symbol of every
+    protein coding transcript with a start codon.
+    """
+    n_lines = 0
+    for line in gtf_file:
+        n_lines += 1
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip().split('\t')
+
+        if not 'protein_coding' in fields[1]:
+            continue
+
+        if fields[2] == 'transcript':
+            chrom = fields[0].replace('chr', '')
+            start = int(fields[3])
+            end = int(fields[4])
+            strand = fields[6]
+            meta = parse_meta(fields[8])
+            ensid = meta['gene_id']
+            symbol = meta['gene_name']
+
+        elif fields[2] == 'start_codon':
+            start_codon_start = int(fields[3])
+            start_codon_end = int(fields[4])
+            if strand == '+':
+                tss = start_codon_start
+            elif strand == '-':
+                tss = start_codon_end
+            else:
+                assert(False)
+            assert(start <= tss <= end)
+
+            yield [
+                chrom, start, end, strand, tss,
+                ensid, symbol
+            ]
+    instrument.count('lines_parsed', n_lines)
+
 if __name__ == '__main__':
+    instrument.setup('gtf_to_tss')
     gtf_fname = sys.argv[1]
 
-    if gtf_fname.endswith('.gz'):
-        opener = gzip.open
-    else:
-        opener = open
-
-    with opener(gtf_fname) as gtf_file:
-        for line in gtf_file:
-            if gtf_fname.endswith('.gz'):
-                line = line.decode('utf-8')
-            if line.startswith('#'):
-                continue
-            fields = line.rstrip().split('\t')
-
-            if not 'protein_coding' in fields[1]:
-                continue
-
-            if fields[2] == 'transcript':
-                chrom = fields[0].replace('chr', '')
-                start = int(fields[3])
-                end = int(fields[4])
-                strand = fields[6]
-                meta = parse_meta(fields[8])
-                ensid = meta['gene_id']
-                symbol = meta['gene_name']
-                
-            elif fields[2] == 'start_codon':
-                start_codon_start = int(fields[3])
-                start_codon_end = int(fields[4])
-                if strand == '+':
-                    tss = start_codon_start
-                elif strand == '-':
-                    tss = start_codon_end
-                else:
-                    assert(False)
-                assert(start <= tss <= end)
-
-                ofields = [
-                    chrom, start, end, strand, tss,
-                    ensid, symbol
-                ]
-                print('\t'.join([ str(f) for f in ofields ]))
+    n_tsss = 0
+    with open_threaded(gtf_fname) as gtf_file, instrument.phase('scan'):
+        for ofields in iter_tsss(gtf_file):
+            print('\t'.join([ str(f) for f in ofields ]))
+            n_tsss += 1
+    instrument.count('tsss_emitted', n_tsss)
@@ -0,0 +1,189 @@
+"""
+Lightweight timers, counters and profiling shared by the bin/ scripts.
+
+Every script calls setup() first, which removes a `--profile' flag from the
+command line. Without the flag all functions here are no-ops. With it,
+wall and CPU time are accumulated per named phase, counters are summed,
+and at exit a JSON summary with peak RSS is written next to the outputs
+and logged through logme.
+
+    --profile                        timers, counters and peak RSS
+    --profile=cprofile               also dump cProfile stats (.prof)
+    --profile=tracemalloc            also record the top allocations
+    --profile=cprofile,tracemalloc   both
+
+setup() also sets the run's memory budget from `--memory-budget SIZE',
+see membudget.py.
+
+Usage:
+    import instrument
+    instrument.setup('continental_variance')
+    with instrument.phase('parse'):
+        ...
+    instrument.count('scipy_calls')
+"""
+import atexit
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import time
+
+import membudget
+
+ENABLED = False
+OPTIONS = set()
+
+_name = None
+_output_prefix = None
+_start = None
+_phases = {}
+_counters = {}
+_profiler = None
+
+
+class _NullPhase(object):
+
+    """Context manager used for phases when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+def setup(name, argv=None):
+    """Enable profiling if `--profile' is in argv and strip it from argv.
+
+    :name:    Name of the script, used in the summary and its file name.
+    :argv:    Argument list to search, sys.argv by default. Modified in
+              place so the script's own argument parsing is unaffected.
+    :returns: True if profiling is enabled.
+    """
+    global ENABLED, _name, _start, _profiler
+    if argv is None:
+        argv = sys.argv
+    membudget.setup(name, argv)
+
+    for arg in list(argv):
+        if arg == '--profile' or arg.startswith('--profile='):
+            argv.remove(arg)
+            ENABLED = True
+            if '=' in arg:
+                OPTIONS.update(arg.split('=', 1)[1].split(','))
+    if not ENABLED:
+        return False
+
+    _name = name
+    _start = (time.perf_counter(), time.process_time())
+    if 'tracemalloc' in OPTIONS:
+        import tracemalloc
+        tracemalloc.start()
+    if 'cprofile' in OPTIONS:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(finish)
+    return True
+
+
+def set_output(fname):
+    """Write the summary next to the output file fname.
+
+    By default the summary goes to <name>.profile.json in the working
+    directory.
+    """
+    global _output_prefix
+    if isinstance(fname, str):
+        _output_prefix = fname
+
+
+def phase(name):
+    """Context manager accumulating wall and CPU time under name.
+
+    Phases may nest, each one is timed inclusively.
+    """
+    if not ENABLED:
+        return _NULL_PHASE
+    return _timed(name)
+
+
+@contextmanager
+def _timed(name):
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        totals = _phases.setdefault(name, [ 0., 0., 0 ])
+        totals[0] += time.perf_counter() - wall
+        totals[1] += time.process_time() - cpu
+        totals[2] += 1
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in megabytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' \
+        else rss / 1024.
+
+
+def summary():
+    """Return the current profile as a dict."""
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = {
+        'script': _name,
+        'argv': sys.argv[1:],
+        'wall_s': round(wall - _start[0], 6),
+        'cpu_s': round(cpu - _start[1], 6),
+        'peak_rss_mb': round(peak_rss_mb(), 2),
+        'phases': {
+            name: { 'wall_s': round(w, 6), 'cpu_s': round(c, 6),
+                    'calls': n }
+            for name, (w, c, n) in _phases.items()
+        },
+        'counters': dict(_counters),
+    }
+    if membudget.BUDGET is not None:
+        result['memory_budget'] = membudget.summary()
+    if 'tracemalloc' in OPTIONS:
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result['tracemalloc'] = {
+                'peak_mb': round(peak / (1024. * 1024.), 2),
+                'top': [
+                    str(stat) for stat in
+                    tracemalloc.take_snapshot().statistics('lineno')[:10]
+                ],
+            }
+    return result
+
+
+def finish():
+    """Write the summary, called at exit when profiling is enabled."""
+    global ENABLED, _profiler
+    if not ENABLED:
+        return
+    prefix = _output_prefix or _name
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(prefix + '.prof')
+        _profiler = None
+
+    result = summary()
+    with open(prefix + '.profile.json', 'w') as f:
+        json.dump(result, f, indent=2)
+
+    import logme
+    logme.log('Profile of {}: {}'.format(_name, json.dumps(result)), 'info')
+    ENABLED = False
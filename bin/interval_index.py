@@ -0,0 +1,120 @@
+"""
+Per-chromosome interval index of gene bodies, promoters and TSSs from the
+output of gtf_to_tss.py, for batched overlap and within-distance queries.
+
+Intervals are kept sorted by start together with the running maximum of
+their ends. The intervals that can overlap a query [start, end] then lie
+between the first interval whose running maximum end reaches start and
+the last interval starting at or before end, two binary searches, and
+only that range is checked. All coordinates are closed intervals.
+
+Usage:
+    from interval_index import load_gene_intervals
+    index = load_gene_intervals('target/tss.txt', 'body')
+    query_idx, hit_idx = index['1'].overlap(starts, ends)
+    for q, h in zip(query_idx, hit_idx):
+        tss, ensid, symbol = index['1'].values[h]
+"""
+import numpy as np
+
+from gene_annot import iter_tss_rows
+
+# Promoter extent around the TSS, strand aware.
+PROMOTER_UPSTREAM = 2000
+PROMOTER_DOWNSTREAM = 500
+
+# Queries expanded at a time, bounding the candidate arrays.
+QUERY_CHUNK = 100000
+
+KINDS = [ 'body', 'promoter', 'tss' ]
+
+
+class IntervalIndex(object):
+
+    """Closed intervals of one chromosome with a value each."""
+
+    def __init__(self, starts, ends, values):
+        order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.values = [ values[idx] for idx in order.tolist() ]
+        self.max_ends = np.maximum.accumulate(self.ends) \
+            if len(self.ends) else self.ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlap(self, starts, ends):
+        """Find the intervals overlapping each query interval.
+
+        :starts: Query starts, an array.
+        :ends:   Query ends, an array.
+        :returns: Arrays of query indices and of interval indices, one
+                  entry per overlap, ordered by query then interval start.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        query_hits, interval_hits = [], []
+        for first in range(0, len(starts), QUERY_CHUNK):
+            q_starts = starts[first:first + QUERY_CHUNK]
+            q_ends = ends[first:first + QUERY_CHUNK]
+            lo = np.searchsorted(self.max_ends, q_starts, side='left')
+            hi = np.searchsorted(self.starts, q_ends, side='right')
+            counts = np.maximum(hi - lo, 0)
+
+            # Expand every query into its candidate range.
+            query = np.repeat(np.arange(len(q_starts)), counts)
+            offsets = np.arange(counts.sum()) - \
+                np.repeat(np.cumsum(counts) - counts, counts)
+            candidate = np.repeat(lo, counts) + offsets
+
+            hit = self.ends[candidate] >= q_starts[query]
+            query_hits.append(query[hit] + first)
+            interval_hits.append(candidate[hit])
+        if not query_hits:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(query_hits), np.concatenate(interval_hits)
+
+    def within(self, starts, ends, distance):
+        """Find the intervals within distance of each query interval."""
+        return self.overlap(np.asarray(starts) - distance,
+                            np.asarray(ends) + distance)
+
+
+def gene_interval(kind, tx_start, tx_end, strand, tss):
+    """Interval of a transcript for an index kind."""
+    if kind == 'body':
+        return tx_start, tx_end
+    if kind == 'tss':
+        return tss, tss
+    if kind == 'promoter':
+        if strand == '-':
+            return tss - PROMOTER_DOWNSTREAM, tss + PROMOTER_UPSTREAM
+        return tss - PROMOTER_UPSTREAM, tss + PROMOTER_DOWNSTREAM
+    raise ValueError('Unknown interval kind {}'.format(kind))
+
+
+def load_gene_intervals(tss_fname, kind='body'):
+    """Index the transcripts of a gtf_to_tss.py output file or store.
+
+    :kind:    'body' for transcript start to end, 'promoter' for
+              PROMOTER_UPSTREAM to PROMOTER_DOWNSTREAM bp around the TSS
+              or 'tss' for the TSS alone.
+    :returns: A dict from chromosome to IntervalIndex, with
+              (tss, ensid, symbol) values.
+    """
+    chrom_rows = {}
+    for fields in iter_tss_rows(tss_fname):
+        chrom = fields[0]
+        start, end = gene_interval(kind, int(fields[1]), int(fields[2]),
+                                   fields[3], int(fields[4]))
+        if not chrom in chrom_rows:
+            chrom_rows[chrom] = ([], [], [])
+        starts, ends, values = chrom_rows[chrom]
+        starts.append(start)
+        ends.append(end)
+        values.append((int(fields[4]), fields[5], fields[6]))
+
+    return { chrom: IntervalIndex(np.array(starts, dtype=np.int64),
+                                  np.array(ends, dtype=np.int64), values)
+             for chrom, (starts, ends, values) in chrom_rows.items() }
@@ -33,6 +33,13 @@ Logging with timestamps and optional log files.
                 lm.log('Hi', level='debug')
                    Prints: 20160223 11:46:24.969 | DEBUG --> Hi
 
+         ASYNC: lm.start_async() hands formatted messages to a background
+                writer thread through a bounded queue. The thread writes
+                them in batches, keeps log files open and flushes every
+                flush_interval seconds, on lm.flush(), and on
+                lm.stop_async() or exit. Without it, every message is
+                written synchronously.
+
 
           NOTE: Uses terminal colors and STDERR, not compatible with non-unix
                 systems
@@ -42,10 +49,16 @@ Logging with timestamps and optional log files.
 import sys
 import gzip
 import bz2
+import atexit
 import logging
+import threading
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime as dt
 
-__all__ = ['log', 'MIN_LEVEL', 'LOGFILE']
+__all__ = ['log', 'MIN_LEVEL', 'LOGFILE', 'start_async', 'stop_async',
+           'flush']
 
 ###################################
 #  Constants for printing colors  #
@@ -60,6 +73,13 @@ ENDC   = '\033[0m'
 MIN_LEVEL = 'info'
 LOGFILE   = sys.stderr
 
+# Defaults for the asynchronous writer
+FLUSH_INTERVAL = 1.0
+QUEUE_SIZE     = 10000
+BATCH_SIZE     = 1000
+
+_writer = None
+
 
 def log(message, level='info', logfile=None, also_write=None,
         min_level=None, kind=None):
@@ -109,33 +129,37 @@ def log(message, level='info', logfile=None, also_write=None,
     except KeyError:
         raise Exception('Invalid min_level {}'.format(min_level))
 
+    is_logger = isinstance(logfile, (logging.RootLogger, logging.Logger))
+
+    # Nothing below min_level is written, skip formatting entirely
+    if level < min_level and not is_logger:
+        return
+
     if level > 3:
         if also_write != -1 or also_write != 'stdout':
             also_write = 'stderr'
 
     # Attempt to handle all file types
-    if isinstance(logfile, (logging.RootLogger, logging.Logger)):
+    if is_logger:
         _logit(message, logfile, level, color=False, min_level=min_level)
     elif isinstance(logfile, str):
-        with _open_zipped(logfile, 'a') as outfile:
-            _logit(message, outfile, level, color=False, min_level=min_level)
+        _emit(message, logfile, level, color=False, min_level=min_level)
     elif str(getattr(logfile, 'name')).strip('<>') == 'stdout':
-        _logit(message, logfile, level, color=True, min_level=min_level)
+        _emit(message, logfile, level, color=True, min_level=min_level)
         stdout = True
     elif str(getattr(logfile, 'name')).strip('<>') == 'stderr':
-        _logit(message, logfile, level, color=True, min_level=min_level)
+        _emit(message, logfile, level, color=True, min_level=min_level)
         stderr = True
     elif getattr(logfile, 'closed'):
-        with _open_zipped(logfile.name, 'a') as outfile:
-            _logit(message, outfile, level, color=False, min_level=min_level)
+        _emit(message, logfile.name, level, color=False, min_level=min_level)
     else:
-        _logit(message, logfile, level, color=False, min_level=min_level)
+        _emit(message, logfile, level, color=False, min_level=min_level)
 
     # Also print to stdout or stderr if requested
     if also_write == 'stdout' and not stdout:
-        _logit(message, sys.stdout, level, color=True, min_level=min_level)
+        _emit(message, sys.stdout, level, color=True, min_level=min_level)
     elif also_write == 'stderr' and not stderr:
-        _logit(message, sys.stdout, level, color=True, min_level=min_level)
+        _emit(message, sys.stdout, level, color=True, min_level=min_level)
 
 
 def clear(infile):
@@ -143,6 +167,37 @@ def clear(infile):
     open(infile, 'w').close()
 
 
+def start_async(flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE,
+                batch_size=BATCH_SIZE):
+    """Write all further log messages from a background thread.
+
+    :flush_interval: Seconds between flushes of the log outputs.
+    :queue_size:     Messages that can be pending before log() blocks.
+    :batch_size:     Pending messages that wake the writer early.
+    """
+    global _writer
+    if _writer is None:
+        _writer = _AsyncWriter(flush_interval, queue_size, batch_size)
+        atexit.register(stop_async)
+
+
+def flush():
+    """Block until all queued messages are written, if running async.
+
+    Use before writing to a log output directly, to keep lines in order.
+    """
+    if _writer is not None:
+        _writer.sync()
+
+
+def stop_async():
+    """Write all pending messages and return to synchronous logging."""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        writer.close()
+
+
 ###############################################################################
 #                             A Logging Exception                             #
 ###############################################################################
@@ -169,26 +224,29 @@ class LoggingException(Exception):
 ###############################################################################
 
 
-def _logit(message, output, level, color=False, min_level=None):
-    """Write message to file either with color or not.
+def _emit(message, output, level, color=False, min_level=None):
+    """Write message to output, via the async writer if it is running.
 
-    output must be filehandle or logging object.
+    output must be a filehandle or a file name.
     """
-    now = dt.now()
-    timestamp = "{0}.{1:<3}".format(now.strftime("%Y%m%d %H:%M:%S"),
-                                    str(int(now.microsecond/1000)))
-
-    flag_map  = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'ERROR',
-                 5: 'CRITICAL'}
+    if _writer is not None:
+        text = _format(message, level, color=color, min_level=min_level)
+        if text is None or _writer.put(output, text):
+            return
+    if isinstance(output, str):
+        with _open_zipped(output, 'a') as outfile:
+            _logit(message, outfile, level, color=color, min_level=min_level)
+    else:
+        _logit(message, output, level, color=color, min_level=min_level)
 
-    flag = flag_map[level]
-    flag_len = len('{0} | {1} --> '.format(timestamp, flag)) - 2
 
-    if color:
-        flag = _color(flag)
+def _logit(message, output, level, color=False, min_level=None):
+    """Write message to file either with color or not.
 
+    output must be filehandle or logging object.
+    """
     if isinstance(output, (logging.RootLogger, logging.Logger)):
-        message = ' {} --> {}'.format(timestamp, message)
+        message = ' {} --> {}'.format(_timestamp(), message)
         if level == 0:
             output.debug(message)
         if level == 1:
@@ -200,20 +258,209 @@ def _logit(message, output, level, color=False, min_level=None):
         if level == 4:
             output.critical(message)
     else:
-        # Check min_level before proceeding
-        if level < min_level:
-            return
+        text = _format(message, level, color=color, min_level=min_level)
+        if text is not None:
+            output.write(text)
+
+
+def _timestamp():
+    """Return the current time as a log timestamp."""
+    now = dt.now()
+    return "{0}.{1:<3}".format(now.strftime("%Y%m%d %H:%M:%S"),
+                               str(int(now.microsecond/1000)))
+
+
+def _format(message, level, color=False, min_level=None):
+    """Return message as a log line, None if below min_level."""
+    # Check min_level before proceeding
+    if level < min_level:
+        return None
+
+    timestamp = _timestamp()
+
+    flag_map  = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'ERROR',
+                 5: 'CRITICAL'}
+
+    flag = flag_map[level]
+    flag_len = len('{0} | {1} --> '.format(timestamp, flag)) - 2
+
+    if color:
+        flag = _color(flag)
 
-        # Format multiline message
-        lines = message.split('\n')
-        if len(lines) != 1:
-            message = lines[0] + '\n'
-            lines = lines[1:]
-            for line in lines:
-                message = message + (''.ljust(flag_len, '-') + '> ' +
-                                     line + '\n')
-        output.write('{0} | {1} --> {2}\n'.format(timestamp, flag,
-                                                  str(message)))
+    # Format multiline message
+    lines = message.split('\n')
+    if len(lines) != 1:
+        message = lines[0] + '\n'
+        lines = lines[1:]
+        for line in lines:
+            message = message + (''.ljust(flag_len, '-') + '> ' +
+                                 line + '\n')
+    return '{0} | {1} --> {2}\n'.format(timestamp, flag, str(message))
+
+
+class _AsyncWriter(object):
+
+    """Background thread writing queued log lines in batches.
+
+    The thread sleeps until batch_size lines are pending or flush_interval
+    seconds have passed, so logging does not wake it for every message.
+    If a write fails the thread stops and keeps the error, waiting callers
+    are released, the lines it had not written are written synchronously
+    and log() writes synchronously from then on.
+    """
+
+    def __init__(self, flush_interval, queue_size, batch_size):
+        """Start the writer thread."""
+        self.flush_interval = flush_interval
+        self.queue_size     = queue_size
+        self.batch_size     = batch_size
+        self.pending        = deque()
+        self.wake           = threading.Event()
+        self.drained        = threading.Condition()
+        self.stopping       = False
+        self.error          = None
+        # Set once a failed thread has written what it had queued.
+        self.recovered      = threading.Event()
+        self.files          = {}
+        # Batch the thread is writing and how many of its items are done.
+        self.batch          = []
+        self.written        = 0
+        self.thread         = threading.Thread(target=self._run,
+                                               daemon=True)
+        self.thread.start()
+
+    def put(self, output, text):
+        """Queue text for output, blocking while the queue is full.
+
+        Returns False without queueing if the writer thread has failed,
+        once the lines queued before are written, so that lines stay in
+        order. The check and the append hold the lock the thread takes to
+        drain the queue, so no line is queued after its last drain.
+        """
+        with self.drained:
+            if len(self.pending) >= self.queue_size:
+                self.wake.set()
+                self.drained.wait_for(
+                    lambda: len(self.pending) < self.queue_size or
+                            self.error is not None
+                )
+            failed = self.error is not None
+            if not failed:
+                self.pending.append((output, text))
+        if failed:
+            self.recovered.wait()
+            return False
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+        return True
+
+    def sync(self):
+        """Block until everything queued so far is written and flushed,
+        or the writer thread has stopped.
+        """
+        done = threading.Event()
+        with self.drained:
+            failed = self.error is not None
+            if not failed:
+                self.pending.append((None, done))
+        if failed:
+            self.recovered.wait()
+            return
+        self.wake.set()
+        # The thread may have stopped before it saw done.
+        while not done.wait(self.flush_interval):
+            if not self.thread.is_alive():
+                break
+
+    def close(self):
+        """Write everything queued, then stop the thread."""
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        for outfile in self.files.values():
+            outfile.close()
+        self.files = {}
+
+    def _handle(self, output):
+        """Return an open handle for output, keeping log files open."""
+        if not isinstance(output, str):
+            return output
+        if output not in self.files:
+            self.files[output] = _open_zipped(output, 'a')
+        return self.files[output]
+
+    def _run(self):
+        try:
+            self._write_batches()
+        except Exception as e:
+            sys.stderr.write('logme: async writer failed, logging '
+                             'synchronously: {!r}\n'.format(e))
+            with self.drained:
+                self.error = e
+                # Release the callers waiting on the thread.
+                self.drained.notify_all()
+                unwritten = self.batch[self.written:] + list(self.pending)
+                self.pending.clear()
+            for output, text in self.batch[:self.written]:
+                if output is None:
+                    text.set()
+            self._write_synchronously(unwritten)
+            self.recovered.set()
+
+    def _write_synchronously(self, items):
+        """Write queued items one by one without the thread's handles,
+        as log() does once the thread has failed.
+        """
+        lost = 0
+        for output, text in items:
+            if output is None:
+                text.set()
+                continue
+            try:
+                if isinstance(output, str):
+                    with _open_zipped(output, 'a') as outfile:
+                        outfile.write(text)
+                else:
+                    output.write(text)
+                    output.flush()
+            except Exception:
+                lost += 1
+        if lost:
+            sys.stderr.write('logme: could not write {} queued log lines\n'
+                             .format(lost))
+
+    def _write_batches(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            stopping = self.stopping
+
+            with self.drained:
+                self.batch = list(self.pending)
+                self.written = 0
+                self.pending.clear()
+                self.drained.notify_all()
+
+            # Join consecutive lines for the same output into one write,
+            # counting the items written in case a write fails.
+            touched, synced = set(), []
+            for output, items in groupby(self.batch, key=itemgetter(0)):
+                items = list(items)
+                if output is None:
+                    synced.extend([ done for _, done in items ])
+                else:
+                    outfile = self._handle(output)
+                    outfile.write(''.join([ text for _, text in items ]))
+                    touched.add(outfile)
+                self.written += len(items)
+            for outfile in touched:
+                outfile.flush()
+            for done in synced:
+                done.set()
+            self.batch = []
+
+            if stopping and not self.pending:
+                break
 
 
 def _color(flag):
@@ -0,0 +1,400 @@
+"""
+Memory budget of a run, so that the scripts fit nodes with less memory
+than their inputs take when loaded whole.
+
+instrument.setup() removes `--memory-budget SIZE' from the command line,
+SIZE in bytes or with a K, M, G or T suffix. Without it every function
+here keeps the unbounded behavior. With it:
+
+    chunk_size()  readers read at most a CHUNK_FRACTION of the budget at
+                  a time
+    fits()        loaders and indexes keep a structure in memory only if
+                  its estimated size fits in what is left of the budget,
+                  and stream or memory-map it from disk otherwise
+    load_npz()    uncompressed .npz indexes are read or memory-mapped
+    SortedSpill   accumulators sort up to a SPILL_FRACTION of the budget
+    SpillList     in memory, then spill the run to a temporary file
+
+Every stage records the bytes it held with use(), and at exit the peak
+resident memory and the high-water mark of every stage are logged
+against the budget.
+
+Usage:
+    import membudget
+    if membudget.fits('expr', membudget.file_estimate(fname, 15)):
+        ...
+    p_vals = membudget.SortedSpill('p_values')
+"""
+from array import array
+import atexit
+import heapq
+import os
+import pickle
+import re
+import resource
+import sys
+import tempfile
+
+# Bytes of the budget, None without one.
+BUDGET = None
+
+# Share of the budget a reader may hold in one chunk, and the smallest
+# chunk worth reading.
+CHUNK_FRACTION = 1. / 64
+MIN_CHUNK_SIZE = 64 * 1024
+
+# Share of the budget an accumulator may hold before it spills a run.
+SPILL_FRACTION = 1. / 8
+
+# Size of the uncompressed text of a gzip file, per compressed byte.
+GZIP_RATIO = 4
+
+# Values read back from a spilled run at a time.
+READ_BLOCK = 64 * 1024
+
+_UNITS = { '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+           'T': 1024 ** 4 }
+
+_name = None
+# Stage name to [ high-water bytes, runs spilled, how it was held ].
+_stages = {}
+
+
+def parse_size(text):
+    """Bytes of a size such as 512M or 16G."""
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', text.upper())
+    if match is None:
+        raise ValueError('Bad memory size {}'.format(text))
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def setup(name, argv=None):
+    """Set the budget from `--memory-budget SIZE' and strip it from argv.
+
+    :returns: The budget in bytes, None without one.
+    """
+    global BUDGET, _name
+    if argv is None:
+        argv = sys.argv
+
+    for idx, arg in enumerate(list(argv)):
+        if arg == '--memory-budget' and idx + 1 < len(argv):
+            size = argv[idx + 1]
+            del argv[idx:idx + 2]
+            break
+        if arg.startswith('--memory-budget='):
+            size = arg.split('=', 1)[1]
+            del argv[idx]
+            break
+    else:
+        return None
+
+    BUDGET = parse_size(size)
+    _name = name
+    atexit.register(report)
+    return BUDGET
+
+
+def rss():
+    """Resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def available():
+    """Bytes of the budget not yet resident, None without a budget."""
+    if BUDGET is None:
+        return None
+    return max(BUDGET - rss(), 0)
+
+
+def chunk_size(default):
+    """Bytes a reader should read at a time, at most default."""
+    if BUDGET is None:
+        return default
+    return max(MIN_CHUNK_SIZE, min(default, int(BUDGET * CHUNK_FRACTION)))
+
+
+def spill_size():
+    """Bytes an accumulator may hold before spilling, None if unbounded."""
+    if BUDGET is None:
+        return None
+    return max(MIN_CHUNK_SIZE, int(BUDGET * SPILL_FRACTION))
+
+
+def file_estimate(fname, expansion):
+    """Estimated bytes of fname loaded in memory.
+
+    :expansion: Bytes in memory per byte of uncompressed text.
+    """
+    size = os.path.getsize(fname)
+    if fname.endswith(('.gz', '.bgz')):
+        size *= GZIP_RATIO
+    return int(size * expansion)
+
+
+def use(stage, nbytes, held='memory', runs=0):
+    """Record that stage held nbytes, keeping its high-water mark.
+
+    :held: 'memory', or 'disk' for data spilled or mapped to disk.
+    """
+    totals = _stages.setdefault(stage, [ 0, 0, held ])
+    totals[0] = max(totals[0], nbytes)
+    totals[1] += runs
+    totals[2] = held
+
+
+def fits(stage, nbytes):
+    """True if stage can hold nbytes in memory within the budget.
+
+    Always true without a budget. Otherwise the decision is recorded for
+    the report, a stage that does not fit is expected to stream or map
+    its data from disk instead.
+    """
+    if BUDGET is None:
+        return True
+    if nbytes <= available():
+        use(stage, nbytes)
+        return True
+    use(stage, nbytes, held='disk')
+    return False
+
+
+def map_npz(fname):
+    """Map the arrays of an uncompressed .npz, as written by np.savez(),
+    read-only from the file.
+
+    :returns: A dict from name to np.memmap.
+    """
+    import numpy as np
+    import struct
+    import zipfile
+
+    arrays = {}
+    with zipfile.ZipFile(fname) as npz, open(fname, 'rb') as raw:
+        for info in npz.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise Exception('Cannot map compressed member {} of {}'
+                                .format(info.filename, fname))
+            # The member's data follows its local header.
+            raw.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', raw.read(4))
+            raw.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(raw)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(raw)
+            else:
+                header = np.lib.format.read_array_header_2_0(raw)
+            shape, fortran_order, dtype = header
+            name = info.filename[:-len('.npy')]
+            if 0 in shape:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                fname, dtype=dtype, mode='r', offset=raw.tell(), shape=shape,
+                order='F' if fortran_order else 'C'
+            )
+    return arrays
+
+
+def load_npz(fname, stage):
+    """Read the arrays of an uncompressed .npz if they fit the budget, map
+    them with map_npz() otherwise.
+    """
+    if not fits(stage, os.path.getsize(fname)):
+        return map_npz(fname)
+    import numpy as np
+    with np.load(fname, allow_pickle=False) as data:
+        return { name: data[name] for name in data.files }
+
+
+class SortedSpill(object):
+
+    """Float values yielded back in sorted order.
+
+    Values are kept in an array of doubles until it holds spill_size()
+    bytes, then the array is sorted and written to a temporary file as a
+    run. Iterating merges the runs. NaNs sort last, as with numpy.
+
+    :stage:     Name of the accumulator in the report.
+    :spill_dir: Directory of the runs, the system default if None.
+    """
+
+    def __init__(self, stage, spill_dir=None):
+        self.stage = stage
+        self.spill_dir = spill_dir
+        self.values = array('d')
+        self.runs = []
+        self.n_nan = 0
+        self.n_values = 0
+        limit = spill_size()
+        self.max_values = None if limit is None else limit // 8
+
+    def __len__(self):
+        return self.n_values
+
+    @property
+    def spilled(self):
+        return len(self.runs) > 0
+
+    def append(self, value):
+        self.n_values += 1
+        if value != value:
+            self.n_nan += 1
+            return
+        self.values.append(value)
+        if self.max_values is not None and \
+           len(self.values) >= self.max_values:
+            self._spill()
+
+    def _spill(self):
+        use(self.stage, len(self.values) * 8, held='disk', runs=1)
+        run = tempfile.TemporaryFile(dir=self.spill_dir)
+        array('d', sorted(self.values)).tofile(run)
+        self.runs.append(run)
+        self.values = array('d')
+
+    def _read_run(self, run):
+        run.seek(0)
+        while True:
+            block = array('d')
+            try:
+                block.fromfile(run, READ_BLOCK)
+            except EOFError:
+                # The last block is shorter, fromfile() keeps what it read.
+                yield from block
+                return
+            yield from block
+
+    def __iter__(self):
+        """Yield the values in ascending order, NaNs last."""
+        use(self.stage, len(self.values) * 8,
+            held='disk' if self.runs else 'memory')
+        in_memory = sorted(self.values)
+        yield from heapq.merge(in_memory,
+                               *[ self._read_run(run) for run in self.runs ])
+        for _ in range(self.n_nan):
+            yield float('nan')
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.values = array('d')
+
+
+class SpillList(object):
+
+    """List of picklable items that can be iterated any number of times.
+
+    Items are pickled in batches, and batches are written to a temporary
+    file once the batches in memory reach spill_size() bytes. Without a
+    budget the items are kept as they are.
+
+    :stage:     Name of the accumulator in the report.
+    :batch:     Items pickled together.
+    :spill_dir: Directory of the spill file, the system default if None.
+    """
+
+    def __init__(self, stage, batch=1000, spill_dir=None):
+        self.stage = stage
+        self.batch = batch
+        self.spill_dir = spill_dir
+        self.limit = spill_size()
+        self.items = []
+        self.pickled = []
+        self.pickled_bytes = 0
+        self.spill = None
+        self.n_spilled = 0
+        self.n_items = 0
+
+    def __len__(self):
+        return self.n_items
+
+    def append(self, item):
+        self.items.append(item)
+        self.n_items += 1
+        if self.limit is not None and len(self.items) >= self.batch:
+            self._pack()
+
+    def _pack(self):
+        data = pickle.dumps(self.items, protocol=pickle.HIGHEST_PROTOCOL)
+        self.items = []
+        self.pickled.append(data)
+        self.pickled_bytes += len(data)
+        use(self.stage, self.pickled_bytes,
+            held='disk' if self.spill is not None else 'memory')
+        if self.pickled_bytes >= self.limit:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile(dir=self.spill_dir)
+            for data in self.pickled:
+                self.spill.write(data)
+            self.n_spilled += len(self.pickled)
+            use(self.stage, self.pickled_bytes, held='disk', runs=1)
+            self.pickled = []
+            self.pickled_bytes = 0
+
+    def __iter__(self):
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill.seek(0)
+            for _ in range(self.n_spilled):
+                yield from pickle.load(self.spill)
+            self.spill.seek(0, os.SEEK_END)
+        for data in self.pickled:
+            yield from pickle.loads(data)
+        yield from self.items
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.items = []
+        self.pickled = []
+
+
+def summary():
+    """Return the budget, peak memory and stages as a dict."""
+    peak = peak_rss()
+    mb = 1024. * 1024.
+    return {
+        'script': _name,
+        'budget_mb': round(BUDGET / mb, 2),
+        'peak_rss_mb': round(peak / mb, 2),
+        'peak_fraction': round(peak / float(BUDGET), 4),
+        'stages': {
+            stage: { 'high_water_mb': round(nbytes / mb, 2),
+                     'fraction': round(nbytes / float(BUDGET), 4),
+                     'held': held, 'runs': runs }
+            for stage, (nbytes, runs, held) in _stages.items()
+        },
+    }
+
+
+def report():
+    """Log how close the run and its stages came to the budget."""
+    if BUDGET is None:
+        return
+    import logme
+    result = summary()
+    level = 'warn' if result['peak_fraction'] > 1 else 'info'
+    logme.log('Memory of {}: peak {:.1f} MB of a {:.1f} MB budget ({:.0%})'
+              .format(_name, result['peak_rss_mb'], result['budget_mb'],
+                      result['peak_fraction']), level)
+    for stage, stats in sorted(result['stages'].items()):
+        logme.log('  {}: {:.1f} MB ({:.0%}) {}{}'.format(
+            stage, stats['high_water_mb'], stats['fraction'],
+            'in memory' if stats['held'] == 'memory' else 'on disk',
+            ', {} runs spilled'.format(stats['runs']) if stats['runs']
+            else ''
+        ), level)
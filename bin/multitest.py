@@ -0,0 +1,132 @@
+"""
+Multiple-testing correction over a stream of tests, without keeping the
+records of the tests in memory.
+
+Records are formatted and spilled to a temporary file as they are added,
+prefixed with their p-value. Bonferroni only needs the number of tests;
+Holm and Benjamini-Hochberg keep the p-values in a compact array of
+doubles, 8 bytes per test, to find the largest rejected p-value, or
+under a memory budget a membudget.SortedSpill that sorts them in runs on
+disk. A second pass over the spill file then streams every record with
+its decision.
+Decisions match statsmodels.stats.multitest.multipletests().
+
+Usage:
+    correction = StreamingCorrection('fdr_bh', alpha=0.05)
+    for ...:
+        correction.add(p, [ chrom, start, end, p ])
+    for line, p, reject in correction.results():
+        if reject:
+            sys.stdout.write(line)
+"""
+from array import array
+import numpy as np
+import tempfile
+
+import membudget
+
+METHODS = [ 'bonferroni', 'holm', 'fdr_bh' ]
+
+
+def format_record(record):
+    """Tab-separated line of a list of fields."""
+    return '\t'.join([ str(f) for f in record ]) + '\n'
+
+
+class StreamingCorrection(object):
+
+    """Collects (p-value, record) pairs and corrects them on a second pass.
+
+    :method:    One of METHODS, as in multipletests().
+    :alpha:     Family-wise error rate or false discovery rate.
+    :spill_dir: Directory of the spill file, the system default if None.
+    """
+
+    def __init__(self, method='fdr_bh', alpha=0.05, spill_dir=None):
+        if not method in METHODS:
+            raise ValueError('Unknown correction method {}'.format(method))
+        self.method = method
+        self.alpha = alpha
+        self.n_tests = 0
+        if method == 'bonferroni':
+            self.p_vals = None
+        elif membudget.BUDGET is None:
+            self.p_vals = array('d')
+        else:
+            self.p_vals = membudget.SortedSpill('p_values', spill_dir)
+        self.spill = tempfile.TemporaryFile(mode='w+', dir=spill_dir)
+
+    def __len__(self):
+        return self.n_tests
+
+    def add(self, p, record):
+        """Add a test, record is a list of fields or a formatted line."""
+        if not isinstance(record, str):
+            record = format_record(record)
+        p = float(p)
+        self.spill.write('{!r}\t{}'.format(p, record))
+        if self.p_vals is not None:
+            self.p_vals.append(p)
+        self.n_tests += 1
+
+    def threshold(self):
+        """Return the largest rejected p-value, -1 if none, inf if all."""
+        n_tests = self.n_tests
+        if n_tests == 0:
+            return -1.
+        if self.method == 'bonferroni':
+            return self.alpha / float(n_tests)
+        if isinstance(self.p_vals, membudget.SortedSpill):
+            return self._merged_threshold()
+
+        # Sorted in place, the insertion order is kept in the spill file.
+        p_sorted = np.frombuffer(self.p_vals, dtype=np.float64)
+        p_sorted.sort()
+        ranks = np.arange(1, n_tests + 1)
+        if self.method == 'holm':
+            notreject = np.nonzero(
+                p_sorted > self.alpha / (n_tests - ranks + 1)
+            )[0]
+            if len(notreject) == 0:
+                # Like multipletests(), even NaN p-values are rejected.
+                return np.inf
+            first = notreject[0]
+            return p_sorted[first - 1] if first > 0 else -1.
+
+        # fdr_bh
+        reject = np.nonzero(p_sorted <= ranks / float(n_tests) * self.alpha)[0]
+        return p_sorted[reject[-1]] if len(reject) else -1.
+
+    def _merged_threshold(self):
+        # Same as threshold(), over the p-values merged from their runs.
+        n_tests = self.n_tests
+        threshold = -1.
+        try:
+            for rank, p in enumerate(self.p_vals, 1):
+                if self.method == 'holm':
+                    if p > self.alpha / (n_tests - rank + 1):
+                        return threshold
+                    threshold = p
+                elif p <= rank / float(n_tests) * self.alpha:
+                    threshold = p
+        finally:
+            self.p_vals.close()
+        return np.inf if self.method == 'holm' else threshold
+
+    def results(self):
+        """Yield (formatted record, p-value, reject) in the order added.
+
+        The spill file is closed afterwards.
+        """
+        threshold = self.threshold()
+        reject_all = threshold == np.inf
+        self.p_vals = None
+
+        self.spill.seek(0)
+        try:
+            for line in self.spill:
+                p, record = line.split('\t', 1)
+                p = float(p)
+                yield record, p, reject_all or p <= threshold
+        finally:
+            self.spill.close()
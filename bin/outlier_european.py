@@ -1,48 +1,113 @@
+import argparse
+from contextlib import ExitStack
+from functools import partial
 from numpy import mean, std
-from scipy.stats import norm
-from statsmodels.stats.multitest import multipletests
-import sys
 
-from compare_pops import EURO_POPS, AFRO_POPS, iter_peaks
+from compare_pops import (EURO_POPS, AFRO_POPS, aligned_chrom,
+                          iter_aligned_lines, iter_peak_sets)
+import instrument
+import partition
+from multitest import StreamingCorrection, format_record
+import shard_exec
 
 P_VAL_CUTOFF = 0.05
 MULTI_TEST_METHOD = 'bonferroni'
 
+def test_peaks(line_sets, pop_name):
+    # Test a shard of aligned peak lines, returning a list of (p-value,
+    # record) pairs per signal file. test_peak() imports scipy.stats on
+    # first use rather than at startup.
+    signal_results = []
+    for (chrom, start, end), pop_to_vals in iter_peak_sets(line_sets):
+        if not signal_results:
+            signal_results = [ [] for _ in pop_to_vals ]
+        for pop_to_val, results in zip(pop_to_vals, signal_results):
+            test_peak(chrom, start, end, pop_to_val, pop_name, results)
+    return signal_results
+
+def test_peak(chrom, start, end, pop_to_val, pop_name, results):
+    # Append the (p-value, record) of a peak to results if it has signal.
+    from scipy.stats import norm
+    val_pop = pop_to_val[pop_name]
+    vals_eur = [
+        pop_to_val[p] for p in EURO_POPS
+    ]
+    # Demand some amount of ATAC peak signal.
+    if sum(vals_eur) == 0 or val_pop == 0:
+        return
+
+    with instrument.phase('stats'):
+        sigma = std(vals_eur)
+        # z-score will always be positive.
+        z = abs(val_pop - mean(vals_eur)) / sigma
+        # One-sided p-value.
+        p = 1 - norm.cdf(z)
+    instrument.count('scipy_calls')
+
+    record = [
+        chrom, start, end,
+        p, val_pop, mean(vals_eur), z,
+    ]
+    record += vals_eur
+    results.append((p, format_record(record)))
+
 if __name__ == '__main__':
-    infile_name = sys.argv[1]
-    pop_name = sys.argv[2].upper()
-
-    p_vals = []
-    records = []
-    with open(infile_name, 'r') as infile:
-        for (chrom, start, end), pop_to_val in iter_peaks(infile):
-            val_pop = pop_to_val[pop_name]
-            vals_eur = [
-                pop_to_val[p] for p in EURO_POPS
-            ]
-            # Demand some amount of ATAC peak signal.
-            if sum(vals_eur) == 0 or val_pop == 0:
-                continue
-
-            sigma = std(vals_eur)
-            # z-score will always be positive.
-            z = abs(val_pop - mean(vals_eur)) / sigma
-            # One-sided p-value.
-            p = 1 - norm.cdf(z)
-            p_vals.append(p)
-
-            record = [
-                chrom, start, end,
-                p, val_pop, mean(vals_eur), z,
-            ]
-            record += vals_eur
-            records.append(record)
-
-    reject, _, _, _ = multipletests(
-        p_vals, alpha=P_VAL_CUTOFF,
-        method=MULTI_TEST_METHOD
+    instrument.setup('outlier_european')
+    parser = argparse.ArgumentParser(
+        description=('Peaks where a population is an outlier against the '
+                     'European populations.')
     )
+    parser.add_argument('infile_names', nargs='+',
+                        help=('Population peak signal files with the same '
+                              'peaks, such as pop_peak_reads.txt and '
+                              'pop_peak_heights.txt.'))
+    parser.add_argument('pop_name', type=str.upper)
+    parser.add_argument('-o', '--output', action='append',
+                        help=('Output of each signal file, in order '
+                              '(default: stdout for a single file).'))
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Processes testing shards of the peaks.')
+    shard_exec.add_arguments(parser)
+    partition.add_arguments(parser)
+    args = parser.parse_args()
+    outputs = args.output or []
+    if outputs and len(outputs) != len(args.infile_names) or \
+       not outputs and len(args.infile_names) > 1:
+        parser.error('Give an -o output per signal file')
+    if args.partition and not outputs:
+        parser.error('--partition needs -o outputs')
+    if args.rsids and not args.partition:
+        parser.error('--rsids needs a --partition')
+
+    # Every signal type is corrected on its own, as in separate runs.
+    corrections = [ StreamingCorrection(MULTI_TEST_METHOD, alpha=P_VAL_CUTOFF)
+                    for _ in args.infile_names ]
+    with ExitStack() as stack, instrument.phase('scan'):
+        infiles = [ stack.enter_context(open(infile_name, 'r'))
+                    for infile_name in args.infile_names ]
+        shards = shard_exec.shard_items(iter_aligned_lines(infiles),
+                                        args.shard_by, args.block_size,
+                                        key=aligned_chrom)
+        shard_exec.correct_shard_sets(
+            shard_exec.map_shards(partial(test_peaks,
+                                          pop_name=args.pop_name),
+                                  shards, args.workers),
+            corrections
+        )
+
+    instrument.count('peaks_tested', sum(map(len, corrections)))
 
-    for p in range(len(p_vals)):
-        if reject[p]:
-            print('\t'.join([ str(f) for f in records[p] ]))
+    with instrument.phase('write'):
+        if args.rsids:
+            from peak_to_rsid import load_snps
+            snps = load_snps(args.rsids)
+        else:
+            snps = None
+        for s, correction in enumerate(corrections):
+            writer = partition.PartitionWriter(
+                outputs[s] if outputs else None, args.partition, snps
+            )
+            for record, p, reject in correction.results():
+                if reject:
+                    writer.write(record)
+            writer.close()
@@ -0,0 +1,170 @@
+"""
+Route the records of a scan to partition files as they are written, in
+place of re-reading the output with awk.
+
+A partition is NAME:EXPR, EXPR comparisons of 1-based columns with
+columns or numbers, like awk's, joined by `&&':
+
+    biased_afr:'$5 > $6'
+    strong:'$4 < 0.001 && $5 > 10'
+
+Columns that parse as numbers are compared as numbers, others as text. A
+record goes to every partition it matches, in <output>_<NAME>.txt next
+to the output. With --rsids, the peaks of each partition are also mapped
+to rsIDs as by peak_to_rsid.py, into <output>_<NAME>_rsids.txt.
+
+Usage:
+    python bin/continental_variance.py target/pop_peak_reads.txt \
+        -o target/continental_variance/reads.txt \
+        --partition biased_afr:'$5 > $6' --partition biased_eur:'$5 < $6' \
+        --rsids depict/data/trityper_CEU_hg19/SNPMappings.txt
+"""
+import operator
+import os
+import re
+import sys
+
+# Longer operators first, so that `>=' is not read as `>'.
+OPS = [
+    ('>=', operator.ge), ('<=', operator.le), ('==', operator.eq),
+    ('!=', operator.ne), ('>', operator.gt), ('<', operator.lt),
+]
+
+_COMPARISON = re.compile(r'^\s*(\S+?)\s*({})\s*(\S+?)\s*$'.format(
+    '|'.join([ re.escape(op) for op, _ in OPS ])
+))
+
+
+def _operand(token, expr):
+    # A function from the fields of a record to the value of token.
+    if token.startswith('$'):
+        try:
+            col = int(token[1:]) - 1
+        except ValueError:
+            col = -1
+        if col < 0:
+            raise ValueError('Bad column {} in {}'.format(token, expr))
+        return lambda fields: _value(fields[col])
+    value = _value(token)
+    return lambda fields: value
+
+
+def _value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _compare(op, left, right):
+    def compare(fields):
+        a, b = left(fields), right(fields)
+        if type(a) is not type(b):
+            a, b = str(a), str(b)
+        return op(a, b)
+    return compare
+
+
+def compile_predicate(expr):
+    """Return a function from the fields of a record to whether expr
+    holds.
+    """
+    comparisons = []
+    for term in expr.split('&&'):
+        match = _COMPARISON.match(term)
+        if match is None:
+            raise ValueError('Bad comparison {} in {}'.format(term, expr))
+        left, op_str, right = match.groups()
+        op = dict(OPS)[op_str]
+        comparisons.append(_compare(op, _operand(left, expr),
+                                    _operand(right, expr)))
+    return lambda fields: all([ compare(fields)
+                                for compare in comparisons ])
+
+
+def parse_partition(spec):
+    """Split NAME:EXPR into the name and the compiled predicate."""
+    name, sep, expr = spec.partition(':')
+    if not sep or not name or not expr:
+        raise ValueError('Partition {} is not NAME:EXPR'.format(spec))
+    return name, compile_predicate(expr)
+
+
+def partition_fname(out_fname, name, suffix=''):
+    stem, ext = os.path.splitext(out_fname)
+    return '{}_{}{}{}'.format(stem, name, suffix, ext or '.txt')
+
+
+class PartitionWriter(object):
+
+    """Writes records to an output and to the partitions they match.
+
+    :out_fname:  Output of every record, stdout if None.
+    :partitions: (name, predicate) pairs, written next to out_fname.
+    :snps:       Output of peak_to_rsid.load_snps() to map the peaks of
+                 every partition to rsIDs, or None.
+    """
+
+    def __init__(self, out_fname, partitions=(), snps=None):
+        if partitions and out_fname is None:
+            raise ValueError('Partitions need an output file')
+        self.out = sys.stdout if out_fname is None else open(out_fname, 'w')
+        self.partitions = []
+        for name, predicate in partitions:
+            part_out = open(partition_fname(out_fname, name), 'w')
+            if snps is None:
+                rsid_out, part_snps = None, None
+            else:
+                rsid_out = open(partition_fname(out_fname, name, '_rsids'),
+                                'w')
+                from peak_to_rsid import DrawnSnps
+                # SNPs are drawn without replacement per partition, as in
+                # a separate peak_to_rsid.py run.
+                part_snps = { chrom: DrawnSnps(chrom_snps)
+                              for chrom, chrom_snps in snps.items() }
+            self.partitions.append(
+                (predicate, part_out, rsid_out, part_snps)
+            )
+
+    def write(self, record):
+        """Write a formatted record line."""
+        self.out.write(record)
+        if not self.partitions:
+            return
+        fields = record.rstrip('\n').split('\t')
+        for predicate, part_out, rsid_out, part_snps in self.partitions:
+            if not predicate(fields):
+                continue
+            part_out.write(record)
+            if rsid_out is not None:
+                self._map(fields, rsid_out, part_snps)
+
+    def _map(self, fields, rsid_out, snps):
+        from peak_to_rsid import map_peaks
+        # Chromosomes without the leading 'chr', as read by read_bed().
+        chrom = fields[0]
+        if chrom.startswith('chr'):
+            chrom = chrom[len('chr'):]
+        peak = (chrom, int(fields[1]), int(fields[2]))
+        for rsid, chrom, start, end in map_peaks(snps, [ peak ]):
+            rsid_out.write('{}\t{}:{}-{}\n'.format(rsid, chrom, start, end))
+
+    def close(self):
+        if self.out is not sys.stdout:
+            self.out.close()
+        for _, part_out, rsid_out, _ in self.partitions:
+            part_out.close()
+            if rsid_out is not None:
+                rsid_out.close()
+
+
+def add_arguments(parser):
+    """Add --partition and --rsids to an argparse parser."""
+    parser.add_argument('--partition', action='append', default=[],
+                        type=parse_partition, metavar='NAME:EXPR',
+                        help=('Also write the records matching EXPR, such '
+                              'as \'$5 > $6\', to <output>_NAME.txt. May '
+                              'be repeated.'))
+    parser.add_argument('--rsids', metavar='DBSNP',
+                        help=('Map the peaks of every partition to the '
+                              'rsIDs of this peak_to_rsid.py SNP file.'))
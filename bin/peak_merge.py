@@ -40,18 +40,22 @@ from subprocess import check_output
 from collections import OrderedDict
 import numpy as np
 
-from tqdm import tqdm
+import instrument
 import logme
+import membudget
+from bed_reader import Column, read_bed
+from populations import ALL_POPS
+from threaded_gzip import ThreadedGzipFile
 
 logme.MIN_LEVEL = 'debug'
-ALL_POPS = sorted([
-    'ASW', 'CEU', 'CHB', 'ESN', 'FIN',
-    'GWD', 'IBS', 'LWK', 'TSI', 'YRI'
-])
 pop_to_total_reads = { pop: 0 for pop in ALL_POPS }
+pop_to_idx = { pop: i for i, pop in enumerate(ALL_POPS) }
+# Number of finished clusters buffered before a block is written.
+WRITE_BLOCK_SIZE = 4096
 
 def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
-               logfile=sys.stderr, reads_file=None, height_file=None):
+               logfile=sys.stderr, reads_file=None, height_file=None,
+               bundle_file=None):
     """Merge peaks.
 
     :peak_file: A file handle or sequence file, currently bed only. File
@@ -63,6 +67,9 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
     :overlap:   The amount a peak can overlap a prior peak before being moved
                 into a new cluster.
     :logfile:   A file to contain some summary stats.
+    :bundle_file: Optional .npz file to write a row-aligned columnar bundle
+                  of the clusters and their population reads and heights,
+                  see ClusterBundle.
     """
     # Make sure overlap is specified
     if not isinstance(overlap, float):
@@ -81,8 +88,9 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
 
     # Count number of reads for each population.
     # Used to normalize population-specific counts.
-    for peak in peak_file_parser(peak_file):
-        pop_to_total_reads[peak.pop] += peak.n_reads
+    with instrument.phase('parse'):
+        for peak in peak_file_parser(peak_file):
+            pop_to_total_reads[peak.pop] += peak.n_reads
     # Normalize by total reads just to get a less large normalization
     # factor.
     total_reads = sum([ pop_to_total_reads[p] for p in ALL_POPS ])
@@ -90,6 +98,7 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
         pop_to_total_reads[pop] /= total_reads
     logme.log('Pops to reads: {0}'.format(pop_to_total_reads), 'info')
         
+    bundle         = ClusterBundle() if bundle_file else None
     pfile          = peak_file_parser(peak_file)
     # Create objects to track stats
     lines          = 0
@@ -105,10 +114,14 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
     peak           = next(pfile)
     lines         += 1
     # Use progress bar if outfile not open already.
-    piter = pfile if not isinstance(outfile, str) or logme.MIN_LEVEL == 'debug'\
-        else tqdm(pfile, total=line_count, unit='lines')
+    if not isinstance(outfile, str) or logme.MIN_LEVEL == 'debug':
+        piter = pfile
+    else:
+        from tqdm import tqdm
+        piter = tqdm(pfile, total=line_count, unit='lines')
     # Open outfile and run algorithm
-    with open_zipped(outfile, 'w') as fout:
+    with open_zipped(outfile, 'w') as fout, instrument.phase('cluster'):
+        writer = ClusterWriter(fout, reads_file, height_file, bundle)
         # Loop through peaks
         for next_peak in piter:
             lines += 1
@@ -150,7 +163,7 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
                             extra_pops[diff]  = 1
                     clusters    += 1
                     # Write cluster and make new one
-                    cluster.write(fout, reads_file, height_file)
+                    writer.add(cluster)
                     cluster = Cluster(peak)
                     # Prep for next run
                     prior_peak = peak
@@ -178,7 +191,7 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
                         extra_pops[diff]  = 1
                 clusters    += 1
                 # Write cluster and make new one
-                cluster.write(fout, reads_file, height_file)
+                writer.add(cluster)
                 cluster      = Cluster(peak)
                 # Prep for next run
                 prior_peak = peak
@@ -212,7 +225,7 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
                     extra_pops[diff]  = 1
             clusters    += 1
             # Write cluster and make new one
-            cluster.write(fout, reads_file, height_file)
+            writer.add(cluster)
             cluster      = Cluster(peak)
         # This is the end so write the last cluster
         # Stats
@@ -227,13 +240,25 @@ def peak_merge(peak_file, outfile=sys.stdout, overlap=.75,
             else:
                 extra_pops[diff]  = 1
         # Write cluster and make new one
-        cluster.write(fout, reads_file, height_file)
+        writer.add(cluster)
+        writer.flush()
 
         # Done.
 
+    instrument.count('lines_parsed', lines)
+    instrument.count('clusters_emitted', clusters)
+    if bundle is not None:
+        with instrument.phase('write'):
+            bundle.save(bundle_file)
+        logme.log('Wrote {} clusters to bundle {}'
+                  .format(len(bundle), bundle_file), 'info')
+
     # Print stats
+    # Keep queued messages ahead of the stats written directly below.
+    logme.flush()
     logfile.write('\n')
     logme.log('Clustering complete,\nstats:', 'info')
+    logme.flush()
     logfile.write('Total lines:\t{}\n'.format(lines) +
                   'Total clusters:\t{}\n'.format(clusters) +
                   'Total clustered:{}\n'.format(
@@ -296,10 +321,11 @@ class Cluster(object):
         )
         self.pop_to_reads[peak.pop].append(peak.n_reads)
 
-    def write(self, outfile, reads_file=None, height_file=None):
+    def write(self, outfile, reads_file=None, height_file=None, bundle=None):
         """Write self as a line to outfile.
 
         :outfile: An open filehandle with write mode.
+        :bundle:  Optional ClusterBundle to also append self to.
         """
         outfile.write(
             '\t'.join(
@@ -318,6 +344,17 @@ class Cluster(object):
             self.write_pop_n_reads(reads_file)
         if height_file != None:
             self.write_pop_max_height(height_file)
+        if bundle != None:
+            bundle.add(self)
+
+    def pop_n_reads(self):
+        """Return the normalized median reads of each population."""
+        return [
+            np.median(self.pop_to_reads[pop]) / pop_to_total_reads[pop]
+            if len(self.pop_to_reads[pop]) > 0
+            else 0.
+            for pop in ALL_POPS
+        ]
 
     def write_pop_n_reads(self, outfile):
         """Write number of reads for each population to outfile.
@@ -357,7 +394,232 @@ class Cluster(object):
             )
         )
         outfile.write('\n')
-        
+
+
+class ClusterBundle(object):
+
+    """Row-aligned columnar store of clusters, saved as a single .npz.
+
+    Every array has one row per cluster, in output order, so coordinates,
+    cluster stats and the population reads and heights matrices can be
+    loaded together with load_bundle() without joining the text outputs.
+    """
+
+    def __init__(self):
+        """Create an empty bundle."""
+        self.chrom       = []
+        self.start       = []
+        self.end         = []
+        self.name        = []
+        self.count       = []
+        self.fold_change = []
+        self.log10p      = []
+        self.pops        = []
+        self.reads       = []
+        self.heights     = []
+
+    def __len__(self):
+        return len(self.chrom)
+
+    def add(self, cluster):
+        """Append a finished cluster.
+
+        :cluster: A Cluster object.
+        """
+        self.chrom.append(cluster.chrom)
+        self.start.append(cluster.start)
+        self.end.append(cluster.end)
+        self.name.append(cluster.name)
+        self.count.append(cluster.count)
+        self.fold_change.append(cluster.fold_change)
+        self.log10p.append(cluster.log10p)
+        self.pops.append(','.join(cluster.pops))
+        self.reads.append(cluster.pop_n_reads())
+        self.heights.append([
+            cluster.pop_to_max_height[pop] for pop in ALL_POPS
+        ])
+
+    def add_block(self, clusters, reads, heights):
+        """Append a block of finished clusters.
+
+        :clusters: A list of Cluster objects.
+        :reads:    Array of normalized reads, one row per cluster.
+        :heights:  Array of max heights, one row per cluster.
+        """
+        for cluster in clusters:
+            self.chrom.append(cluster.chrom)
+            self.start.append(cluster.start)
+            self.end.append(cluster.end)
+            self.name.append(cluster.name)
+            self.count.append(cluster.count)
+            self.fold_change.append(cluster.fold_change)
+            self.log10p.append(cluster.log10p)
+            self.pops.append(','.join(cluster.pops))
+        self.reads.extend(reads)
+        self.heights.extend(heights)
+
+    def save(self, fname):
+        """Write the bundle to fname as an uncompressed .npz."""
+        n_pops = len(ALL_POPS)
+        np.savez(
+            fname,
+            chrom=np.array(self.chrom, dtype=str),
+            start=np.array(self.start, dtype=np.int64),
+            end=np.array(self.end, dtype=np.int64),
+            name=np.array(self.name, dtype=str),
+            count=np.array(self.count, dtype=np.int64),
+            fold_change=np.array(self.fold_change, dtype=np.float64),
+            log10p=np.array(self.log10p, dtype=np.float64),
+            pops=np.array(self.pops, dtype=str),
+            reads=np.array(self.reads, dtype=np.float64)
+                    .reshape(-1, n_pops),
+            heights=np.array(self.heights, dtype=np.float64)
+                      .reshape(-1, n_pops),
+            pop_names=np.array(ALL_POPS, dtype=str),
+        )
+
+
+class ClusterWriter(object):
+
+    """Buffer finished clusters and write them out in blocks.
+
+    Population medians, normalizations and the text of every output file
+    are computed once per block of WRITE_BLOCK_SIZE clusters instead of
+    once per cluster. Output is identical to Cluster.write().
+    """
+
+    # chrom, start, end, name, count, fold_change, log10p, pops
+    cluster_fmt = '\t'.join(['{}'] * 8) + '\n'
+    # chrom, start, end, then one column per population
+    pop_fmt     = '\t'.join(['{}'] * (3 + len(ALL_POPS))) + '\n'
+
+    def __init__(self, outfile, reads_file=None, height_file=None,
+                 bundle=None, block_size=WRITE_BLOCK_SIZE):
+        """Create self.
+
+        :outfile:     An open filehandle with write mode.
+        :reads_file:  Optional open filehandle for population reads.
+        :height_file: Optional open filehandle for population heights.
+        :bundle:      Optional ClusterBundle to also append clusters to.
+        :block_size:  Number of clusters to buffer before writing.
+        """
+        self.outfile     = outfile
+        self.reads_file  = reads_file
+        self.height_file = height_file
+        self.bundle      = bundle
+        self.block_size  = block_size
+        self.block       = []
+
+    def add(self, cluster):
+        """Buffer a finished cluster, writing the block when full."""
+        self.block.append(cluster)
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered clusters."""
+        block = self.block
+        if not block:
+            return
+        self.block = []
+        with instrument.phase('write'):
+            self.write_block(block)
+
+    def write_block(self, block):
+        """Write a block of clusters to every output."""
+        self.outfile.write(''.join(map(
+            self.cluster_fmt.format,
+            *zip(*[
+                (c.chrom, c.start, c.end, c.name, c.count,
+                 c.fold_change, c.log10p, ','.join(c.pops))
+                for c in block
+            ])
+        )))
+
+        if self.reads_file is None and self.height_file is None and \
+           self.bundle is None:
+            return
+
+        with instrument.phase('stats'):
+            present, reads, heights = self.pop_stats(block)
+        chroms = [ c.chrom for c in block ]
+        starts = [ c.start for c in block ]
+        ends   = [ c.end for c in block ]
+        if self.reads_file is not None:
+            self.reads_file.write(self.format_pops(
+                chroms, starts, ends, present, reads
+            ))
+        if self.height_file is not None:
+            self.height_file.write(self.format_pops(
+                chroms, starts, ends, present, heights
+            ))
+        if self.bundle is not None:
+            self.bundle.add_block(block, np.where(present, reads, 0.),
+                                  np.where(present, heights, 0.))
+
+    @staticmethod
+    def pop_stats(block):
+        """Compute population reads and heights for a block of clusters.
+
+        :returns: (present, reads, heights) arrays of shape
+                  (len(block), len(ALL_POPS)), where present marks the
+                  populations with at least one peak in the cluster.
+        """
+        n_pops = len(ALL_POPS)
+        totals = np.array([ pop_to_total_reads[p] for p in ALL_POPS ])
+
+        # One entry per member peak, grouped by (cluster, population).
+        group, n_reads, height = [], [], []
+        for i, cluster in enumerate(block):
+            for peak in cluster.peaks:
+                group.append(i * n_pops + pop_to_idx[peak.pop])
+                n_reads.append(peak.n_reads)
+                height.append(peak.height)
+        group   = np.array(group, dtype=np.int64)
+        n_reads = np.array(n_reads, dtype=np.float64)
+        height  = np.array(height, dtype=np.float64)
+        n_cells = len(block) * n_pops
+
+        # Medians of every group from a single sort.
+        order   = np.lexsort((n_reads, group))
+        sorted_reads = n_reads[order]
+        counts  = np.bincount(group, minlength=n_cells)
+        present = counts > 0
+        starts  = np.cumsum(counts) - counts
+        lo = sorted_reads[(starts + (counts - 1) // 2)[present]]
+        hi = sorted_reads[(starts + counts // 2)[present]]
+        median = np.zeros(n_cells)
+        median[present] = (lo + hi) / 2.
+        reads = median.reshape(-1, n_pops) / totals
+
+        max_height = np.zeros(n_cells)
+        np.maximum.at(max_height, group, height / totals[group % n_pops])
+        heights = max_height.reshape(-1, n_pops)
+
+        return present.reshape(-1, n_pops), reads, heights
+
+    @classmethod
+    def format_pops(cls, chroms, starts, ends, present, values):
+        """Format a block of population values as lines of text."""
+        cells = values.astype(object)
+        cells[~present] = '0'
+        return ''.join(map(cls.pop_fmt.format, chroms, starts, ends,
+                           *cells.T))
+
+
+def load_bundle(fname, mmap=False):
+    """Load a bundle written by ClusterBundle.save().
+
+    :mmap:    Map the arrays from the file read-only instead of reading
+              them, the bundle is uncompressed so its members can be.
+    :returns: A dict of row-aligned arrays, see ClusterBundle.
+    """
+    if mmap:
+        return membudget.map_npz(fname)
+    with np.load(fname, allow_pickle=False) as data:
+        return { key: data[key] for key in data.files }
+
+
 ###############################################################################
 #                           File handling functions                           #
 ###############################################################################
@@ -412,6 +674,18 @@ def peak_file_parser(infile):
     return file_parser(pfile)
 
 
+BED_COLUMNS = [
+    Column('chrom',   0, str),
+    Column('start',   1, int),
+    Column('end',     2, int),
+    Column('pop',     3, str),
+    Column('n_reads', 4, int),
+    Column('fold',    6, float),
+    Column('l10p',    7, float),
+    Column('height',  8, float),
+]
+
+
 def bed_file(file_handle):
     """Parse an open bed file, use with peak_file().
 
@@ -419,12 +693,12 @@ def bed_file(file_handle):
     :yields:      Peak object
 
     """
-    for line in file_handle:
-        (
-            chrom, start, end, pop, n_reads, _, fold, l10p, height
-        ) = line.rstrip().split('\t')
-         
-        yield Peak(chrom, start, end, pop, fold, l10p, n_reads, height)
+    names = [ col.name for col in BED_COLUMNS ]
+    for batch in read_bed(file_handle, BED_COLUMNS, chrom=None):
+        for (
+            chrom, start, end, pop, n_reads, fold, l10p, height
+        ) in zip(*[ batch[name].tolist() for name in names ]):
+            yield Peak(chrom, start, end, pop, fold, l10p, n_reads, height)
 
 
 def in_name(file_handle, search_string):
@@ -453,7 +727,8 @@ def in_name(file_handle, search_string):
 def open_zipped(infile, mode='r'):
     """Return file handle of file regardless of zipped or not.
 
-    Text mode enforced for compatibility with python2.
+    Text mode enforced for compatibility with python2. Gzip files opened
+    for reading are decompressed in background threads.
     """
     mode   = mode[0] + 't'
     p2mode = mode
@@ -461,6 +736,8 @@ def open_zipped(infile, mode='r'):
         return infile
     if isinstance(infile, str):
         if infile.endswith('.gz'):
+            if mode == 'rt':
+                return ThreadedGzipFile(infile, mode)
             return gzip.open(infile, mode)
         if infile.endswith('.bz2'):
             if hasattr(bz2, 'open'):
@@ -479,6 +756,8 @@ def main(argv=None):
     """Command line parsing."""
     if not argv:
         argv = sys.argv[1:]
+    argv = list(argv)
+    instrument.setup('peak_merge', argv)
 
     parser  = argparse.ArgumentParser(
         description=__doc__,
@@ -491,6 +770,8 @@ def main(argv=None):
                               'percent.'))
     parser.add_argument('-v', '--verbose', action="store_true",
                         help="Verbose output")
+    parser.add_argument('-a', '--async-log', action="store_true",
+                        help="Write log messages from a background thread")
 
     # Files
     parser.add_argument('-i', '--infile', nargs='?', default=sys.stdin,
@@ -509,16 +790,23 @@ def main(argv=None):
                         default='target/pop_peak_heights.txt',
                         type=argparse.FileType('w'),
                         help="Log file (Default: STDERR)")
+    parser.add_argument('-b', '--bundle', metavar='',
+                        help=("Also write clusters, reads and heights as a "
+                              "single row-aligned .npz bundle"))
 
     args = parser.parse_args(argv)
 
     # Take care of logging
     logme.MIN_LEVEL = 'debug' if args.verbose else 'info'
     logme.LOGFILE   = args.logfile
+    if args.async_log:
+        logme.start_async()
+    instrument.set_output(args.outfile)
 
     peak_merge(peak_file=args.infile, outfile=args.outfile,
                overlap=args.percent_overlap, logfile=args.logfile,
-               reads_file=args.reads_file, height_file=args.height_file)
+               reads_file=args.reads_file, height_file=args.height_file,
+               bundle_file=args.bundle)
 
 if __name__ == '__main__' and '__file__' in globals():
     sys.exit(main())
@@ -1,7 +1,34 @@
+import argparse
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from itertools import chain
+import numpy as np
 import os.path
 import pickle
 import sys
 
+from bed_reader import Column, iter_chunks, read_bed
+import instrument
+import membudget
+import shard_exec
+
+# Maximum distance of a SNP outside a peak from the middle of the peak.
+MAX_DIST = 200
+
+# Bytes of load_snps() lists per byte of dbSNP text.
+SNP_EXPANSION = 8
+
+PEAK_COLUMNS = [
+    Column('chrom', 0, str),
+    Column('start', 1, int),
+    Column('end', 2, int),
+]
+SNP_COLUMNS = [
+    Column('chrom', 0, str),
+    Column('pos', 1, int),
+    Column('rsid', 2, str),
+]
+
 def closest_dist(snp_a, snp_b, distance):
     if abs(distance - snp_a[0]) < abs(distance - snp_b[0]):
         return snp_a, 0
@@ -81,67 +108,405 @@ def search_closest(distance, sorted_distances,
             )
         return closest, idx
 
-def load_snps(dbsnp_fname):
+class SnpArray(object):
+
+    """Sorted (position, rsID) SNPs of a chromosome held in two arrays,
+    read like a list of load_snps(). The arrays can be memory-mapped.
+    """
+
+    def __init__(self, pos, rsid):
+        self.pos = pos
+        self.rsid = rsid
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __getitem__(self, idx):
+        return int(self.pos[idx]), self.rsid[idx].decode()
+
+class DrawnSnps(object):
+
+    """SNPs of a chromosome, a list of load_snps() or a SnpArray, that
+    SNPs can be drawn from in map_peaks() without changing them.
+
+    Drawn SNPs are marked as removed instead of being deleted, and
+    indices skip them like list indices, so every copy draws on its own
+    while sharing the SNPs.
+    """
+
+    def __init__(self, snps, removed=None):
+        self.snps = snps
+        self.removed = [] if removed is None else removed
+
+    def __len__(self):
+        return len(self.snps) - len(self.removed)
+
+    def _physical(self, idx):
+        # Index in snps of the SNP at list index idx, the smallest index
+        # with idx SNPs left before it.
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('SNP index out of range')
+        phys = idx
+        while True:
+            shifted = idx + bisect_right(self.removed, phys)
+            if shifted == phys:
+                return phys
+            phys = shifted
+
+    def __getitem__(self, idx):
+        return self.snps[self._physical(idx)]
+
+    def pop(self, idx):
+        phys = self._physical(idx)
+        insort(self.removed, phys)
+        return self.snps[phys]
+
+    def copy(self):
+        """Copy sharing the SNPs, with its own drawn SNPs."""
+        return DrawnSnps(self.snps, list(self.removed))
+
+def load_snp_arrays(dbsnp_fname):
+    """Same SNPs as load_snps(), as a map from chromosome to the
+    DrawnSnps of a SnpArray.
+
+    The arrays are cached in <dbsnp>.npz, and mapped from there if they
+    do not fit the memory budget either.
+    """
+    cached_fname = dbsnp_fname + '.npz'
+    if os.path.isfile(cached_fname):
+        instrument.count('cache_hits')
+    else:
+        chrom_pos, chrom_rsid = {}, {}
+        for batch in read_bed(dbsnp_fname, SNP_COLUMNS):
+            chroms = batch['chrom']
+            for chrom in np.unique(chroms).tolist():
+                in_chrom = chroms == chrom
+                chrom_pos.setdefault(chrom, []).append(
+                    batch['pos'][in_chrom]
+                )
+                chrom_rsid.setdefault(chrom, []).append(
+                    batch['rsid'][in_chrom].astype(bytes)
+                )
+        arrays = {}
+        for chrom in list(chrom_pos):
+            pos = np.concatenate(chrom_pos.pop(chrom))
+            rsid = np.concatenate(chrom_rsid.pop(chrom))
+            # Same order as sorting the (position, rsID) tuples.
+            order = np.lexsort((rsid, pos))
+            arrays['pos_' + chrom] = pos[order]
+            arrays['rsid_' + chrom] = rsid[order]
+        with open(cached_fname, 'wb') as cached_file:
+            np.savez(cached_file, **arrays)
+
+    arrays = membudget.load_npz(cached_fname, 'snp_arrays')
+    chroms = [ name[len('pos_'):] for name in arrays
+               if name.startswith('pos_') ]
+    return { chrom: DrawnSnps(SnpArray(arrays['pos_' + chrom],
+                                       arrays['rsid_' + chrom]))
+             for chrom in chroms }
+
+def load_snps(dbsnp_fname, cache=True):
+    # Under a memory budget, SNPs whose lists do not fit are held in
+    # arrays instead. Without cache, the pickle cache is neither read nor
+    # written.
+    if not membudget.fits('snps', membudget.file_estimate(dbsnp_fname,
+                                                          SNP_EXPANSION)):
+        return load_snp_arrays(dbsnp_fname)
+
     cached_fname = dbsnp_fname + '.pickle'
     # Cache this file to speed up performance.
-    if os.path.isfile(cached_fname):
+    if cache and os.path.isfile(cached_fname):
         with open(cached_fname, 'rb') as cached_file:
             snps = pickle.load(cached_file)
+        instrument.count('cache_hits')
         return snps
 
     # Load a map from chromosomes to positions and rsIDs.
     snps = {}
-    with open(dbsnp_fname, 'r') as dbsnp:
-        for line in dbsnp:
-            fields = line.rstrip().split('\t')
-            chrom, pos, rsid = fields[0], int(fields[1]), fields[2]
-            if chrom.startswith('chr'):
-                chrom = chrom[len('chr'):]
+    for batch in read_bed(dbsnp_fname, SNP_COLUMNS):
+        chroms = batch['chrom']
+        for chrom in np.unique(chroms).tolist():
+            in_chrom = chroms == chrom
             if not chrom in snps:
                 snps[chrom] = []
-            snps[chrom].append((pos, rsid))
+            snps[chrom].extend(zip(batch['pos'][in_chrom].tolist(),
+                                   batch['rsid'][in_chrom].tolist()))
 
     # Sort list of SNPs to enable binary search.
     for chrom in snps:
         snps[chrom] = sorted(snps[chrom])
 
     # Cache the file.
-    with open(cached_fname, 'wb') as cached_file:
-        pickle.dump(snps, cached_file,
-                    protocol=pickle.HIGHEST_PROTOCOL)
+    if cache:
+        with open(cached_fname, 'wb') as cached_file:
+            pickle.dump(snps, cached_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
     return snps
 
 
+def iter_peak_coords(peak_fname):
+    for batch in read_bed(peak_fname, PEAK_COLUMNS):
+        yield from zip(batch['chrom'].tolist(), batch['start'].tolist(),
+                       batch['end'].tolist())
+
+def accept_snp(snp_pos, start, end, middle):
+    # Only allow SNPs within the peak or within MAX_DIST bp of the
+    # middle of the peak.
+    return start <= snp_pos <= end or abs(snp_pos - middle) <= MAX_DIST
+
+def map_peaks(snps, peaks):
+    # Iterate through (chrom, start, end) peaks, finding the closest SNP to
+    # the middle of the peak and reporting the rsID of that SNP.
+    for chrom, start, end in peaks:
+        middle = (start + end) / 2
+
+        # Search for SNP that is closest to the middle of the peak.
+        closest, closest_idx = search_closest(middle, snps[chrom])
+        assert(closest != None)
+        assert(closest == snps[chrom][closest_idx])
+        closest_pos = closest[0]
+        closest_rsid = closest[1]
+
+        if accept_snp(closest_pos, start, end, middle):
+            yield closest_rsid, chrom, start, end
+            # Draw without replacement.
+            snps[chrom].pop(closest_idx)
+
+def chrom_shards(peaks):
+    # Shards of whole chromosomes. A chromosome in two runs of the peak
+    # file would draw from two copies of its SNPs, so it is an error.
+    seen = set()
+    for shard in shard_exec.shard_items(peaks, by='chrom'):
+        chrom = shard[0][0]
+        if chrom in seen:
+            raise Exception('Peak file is not grouped by chromosome: {}'
+                            .format(chrom))
+        seen.add(chrom)
+        yield shard
+
+def map_shard(peaks):
+    # Map a shard of peaks of one chromosome with the SNPs of this process.
+    return list(map_peaks(shard_exec.STATE['snps'], peaks))
+
+def iter_snps(dbsnp_fname):
+    for batch in read_bed(dbsnp_fname, SNP_COLUMNS):
+        yield from zip(batch['chrom'].tolist(), batch['pos'].tolist(),
+                       batch['rsid'].tolist())
+
+def count_snps(dbsnp_fname):
+    # Map from chromosome, named as read_bed() names it, to its number of
+    # SNPs. Only the first field of each line is split off.
+    counts = Counter()
+    for buf in iter_chunks(dbsnp_fname):
+        counts.update(line.split(b'\t', 1)[0]
+                      for line in buf.split(b'\n') if line.rstrip(b'\r'))
+    chrom_counts = {}
+    for chrom, count in counts.items():
+        chrom = chrom.decode()
+        if chrom.startswith('chr'):
+            chrom = chrom[len('chr'):]
+        chrom_counts[chrom] = chrom_counts.get(chrom, 0) + count
+    return chrom_counts
+
+class SweepWindow(object):
+
+    """Remaining SNPs of a chromosome as seen by map_peaks_streaming().
+
+    Only the SNPs of the window are held, with the number of remaining
+    SNPs before it and on the whole chromosome, so that SNPs are indexed
+    like in the list map_peaks() searches. SNPs before the window count
+    as position -inf and SNPs after it as +inf: against the middle of the
+    current peak both compare as their true positions do, and neither can
+    be accepted.
+    """
+
+    def __init__(self, n_snps):
+        self.n_before = 0
+        self.n_snps = n_snps
+        self.pos = []
+        self.rsid = []
+
+    def append(self, pos, rsid):
+        self.pos.append(pos)
+        self.rsid.append(rsid)
+
+    def drop_before(self, pos):
+        """Move the SNPs before pos out of the window."""
+        drop = bisect_left(self.pos, pos)
+        if drop:
+            del self.pos[:drop]
+            del self.rsid[:drop]
+            self.n_before += drop
+
+    def closest(self, distance):
+        """Index of the SNP search_closest() returns on the whole list,
+        None if it lies outside the window or there are no SNPs.
+
+        Takes the same steps as search_closest(), including taking the
+        right SNP of a two-SNP range with distance between them.
+        """
+        def pos(idx):
+            idx -= self.n_before
+            if idx < 0:
+                return -inf
+            if idx >= n_window:
+                return inf
+            return window[idx]
+
+        window, n_window = self.pos, len(self.pos)
+        inf = float('inf')
+        first, last = self.n_before, self.n_before + n_window
+        base, length = 0, self.n_snps
+        while length > 2:
+            split = length // 2
+            # Both SNPs of the split before or after the window, where the
+            # search goes right or left.
+            if base + split < first:
+                base, length = base + split, length - split
+                continue
+            if base + split - 1 >= last:
+                length = split
+                continue
+            left, right = pos(base + split - 1), pos(base + split)
+            if left <= distance <= right:
+                idx = base + split - 1 if abs(distance - left) < \
+                      abs(distance - right) else base + split
+                break
+            if distance < left:
+                length = split
+            else:
+                base, length = base + split, length - split
+        else:
+            if length == 0:
+                return None
+            if length == 1:
+                idx = base
+            else:
+                left, right = pos(base), pos(base + 1)
+                if left <= distance and distance >= right:
+                    idx = base if abs(distance - left) < \
+                          abs(distance - right) else base + 1
+                elif distance < left:
+                    idx = base
+                else:
+                    idx = base + 1
+        idx -= self.n_before
+        if not 0 <= idx < len(self.pos):
+            return None
+        return idx
+
+    def pop(self, idx):
+        """Draw the SNP at window index idx."""
+        self.n_snps -= 1
+        return self.pos.pop(idx), self.rsid.pop(idx)
+
+def map_peaks_streaming(dbsnp_fname, peak_fname):
+    """Same mapping as map_peaks(), as a two-pointer sweep.
+
+    Both files must be sorted by chromosome then position, in the same
+    chromosome order as `sort -k1,1 -k2,2n'. Only the SNPs that can still
+    be accepted for the current or a later peak are held in memory, in a
+    SweepWindow searched the way search_closest() searches the whole
+    list. The SNPs of each chromosome are counted in a first pass over
+    dbsnp_fname, as the search depends on their number.
+    """
+    snp_counts = count_snps(dbsnp_fname)
+    snp_iter = iter_snps(dbsnp_fname)
+    next_snp = next(snp_iter, None)
+
+    chrom = None
+    done_chroms = set()
+    window = None
+    prior_start = None
+    for peak_chrom, start, end in iter_peak_coords(peak_fname):
+        if peak_chrom != chrom:
+            if peak_chrom in done_chroms:
+                raise Exception('Peak file is not sorted by chromosome: {}'
+                                .format(peak_chrom))
+            done_chroms.add(chrom)
+            chrom = peak_chrom
+            window = SweepWindow(snp_counts.get(chrom, 0))
+            prior_start = None
+            # Skip SNPs on chromosomes without peaks.
+            while next_snp is not None and next_snp[0] < chrom:
+                next_snp = next(snp_iter, None)
+
+        if prior_start is not None and start < prior_start:
+            raise Exception('Peak file is not sorted by position: {}:{}'
+                            .format(chrom, start))
+        prior_start = start
+        middle = (start + end) / 2
+
+        # Later peaks start at or after this one, so no SNP before
+        # start - MAX_DIST can be accepted for any of them.
+        window.drop_before(start - MAX_DIST)
+
+        # An accepted SNP lies within the peak or within MAX_DIST of the
+        # middle, so the window only needs to reach the larger of both.
+        reach = max(end, middle + MAX_DIST)
+        while next_snp is not None and next_snp[0] == chrom and \
+              next_snp[1] <= reach:
+            window.append(next_snp[1], next_snp[2])
+            next_snp = next(snp_iter, None)
+
+        # Search for SNP that is closest to the middle of the peak.
+        idx = window.closest(middle)
+        if idx is None:
+            continue
+
+        if accept_snp(window.pos[idx], start, end, middle):
+            yield window.rsid[idx], chrom, start, end
+            # Draw without replacement.
+            window.pop(idx)
+
 if __name__ == '__main__':
-    dbsnp_fname = sys.argv[1]
-    peak_fname = sys.argv[2]
+    instrument.setup('peak_to_rsid')
+    parser = argparse.ArgumentParser(
+        description='Map peaks to the rsID of the SNP closest to their middle.'
+    )
+    parser.add_argument('dbsnp_fname',
+                        help='Tab-separated chrom, position, rsID file.')
+    parser.add_argument('peak_fname',
+                        help='Peak file, chrom, start, end first.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stream', action='store_true',
+                      help=('Sweep both coordinate-sorted files together '
+                            'instead of loading every SNP into memory, with '
+                            'the same mapping. dbSNP is read twice.'))
+    mode.add_argument('--server', metavar='URL',
+                      help='Map the peaks on a running query_server.py.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help=('Processes mapping the peaks, a chromosome at '
+                              'a time.'))
+    args = parser.parse_args()
+    if args.workers > 1 and (args.stream or args.server):
+        parser.error('--workers is not supported with --stream or --server')
 
-    # Construct map from chromosome to a list of (position, rsID) tuples.
-    snps = load_snps(dbsnp_fname)
-    
-    # Iterate through peak file, finding the closest SNP to the middle of
-    # the peak and reporting the rsID of that SNP.
-    with open(peak_fname, 'r') as peak_file:
-        for line in peak_file:
-            fields = line.rstrip().split('\t')
-            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
-            if chrom.startswith('chr'):
-                chrom = chrom[len('chr'):]
-            middle = (start + end) / 2
-
-            # Search for SNP that is closest to the middle of the peak.
-            closest, closest_idx = search_closest(middle, snps[chrom])
-            assert(closest != None)
-            assert(closest == snps[chrom][closest_idx])
-            closest_pos = closest[0]
-            closest_rsid = closest[1]
-
-            # Only allow SNPs within the peak or within 200 bp of the
-            # middle of the peak.
-            if start <= closest_pos <= end or \
-               abs(closest_pos - middle) <= 200:
-                print('{}\t{}:{}-{}'
-                      .format(closest_rsid, chrom, start, end))
-                # Draw without replacement.
-                snps[chrom].pop(closest_idx)
+    if args.server:
+        from query_server import QueryClient
+        mapped = QueryClient(args.server).map_peaks(
+            args.dbsnp_fname, iter_peak_coords(args.peak_fname)
+        )
+    elif args.stream:
+        mapped = map_peaks_streaming(args.dbsnp_fname, args.peak_fname)
+    else:
+        # Construct map from chromosome to a list of (position, rsID)
+        # tuples.
+        with instrument.phase('parse'):
+            snps = load_snps(args.dbsnp_fname)
+        if args.workers > 1:
+            # SNPs are drawn without replacement along a chromosome, so
+            # only whole chromosomes can be mapped independently.
+            shards = chrom_shards(iter_peak_coords(args.peak_fname))
+            mapped = chain.from_iterable(shard_exec.map_shards(
+                map_shard, shards, args.workers, state={ 'snps': snps }
+            ))
+        else:
+            mapped = map_peaks(snps, iter_peak_coords(args.peak_fname))
 
+    with instrument.phase('map'):
+        for rsid, chrom, start, end in mapped:
+            print('{}\t{}:{}-{}'.format(rsid, chrom, start, end))
+            instrument.count('peaks_mapped')
@@ -0,0 +1,17 @@
+"""
+1000 Genomes populations of the ATAC-seq peaks, in the column order of
+the pop_peak_<type>.txt files.
+
+Kept free of other imports so that any script can use them without
+loading numpy or the pipeline modules.
+"""
+ALL_POPS = sorted([
+    'ASW', 'CEU', 'CHB', 'ESN', 'FIN',
+    'GWD', 'IBS', 'LWK', 'TSI', 'YRI'
+])
+
+AFRO_POPS = sorted([ 'ESN', 'GWD', 'LWK', 'YRI'])
+EURO_POPS = sorted([ 'CEU', 'FIN', 'IBS', 'TSI'])
+
+# Populations with GEUVADIS expression.
+GEUVADIS_POPS = [ 'CEU', 'FIN', 'TSI', 'YRI' ]
@@ -0,0 +1,309 @@
+"""
+Local query server keeping the expression, SNP, TSS and peak indexes in
+memory between runs of the analysis scripts.
+
+Only the files given with --serve are served, each loaded at startup
+with the same loader the scripts use and reloaded when it changes, so
+repeated queries skip parsing. Requests refer to a file by its name, the
+base name of its path, and never open any other file. The server only
+listens on localhost. Requests are JSON objects POSTed to:
+
+    /gene_expr    expr, genes[, samples]  -> { gene: { sample: value } }
+    /map_peaks    dbsnp, peaks            -> [ [ rsid, chrom, start, end ] ]
+    /tss_within   tss, peaks              -> [ [ [ pos, ensid, symbol ] ] ]
+    /peak_signal  pops, peaks             -> [ [ signal, ... ] or null ]
+
+where peaks is a list of [ chrom, start, end ] and expr, dbsnp, tss and
+pops are file names. GET /status lists the served indexes.
+
+Usage:
+    python bin/query_server.py [-p 8765] --serve expr=FILE [dbsnp=FILE ...] &
+    python bin/diff_expr.py --server http://127.0.0.1:8765 expr pops genes
+"""
+import argparse
+from functools import partial
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import logme
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Peaks sent per request by the clients.
+BATCH_SIZE = 10000
+
+KINDS = [ 'expr', 'dbsnp', 'tss', 'pops' ]
+
+
+def _loaders():
+    # Imported here so that clients do not pay for the server's imports.
+    from correlate_peak_expr import load_tsss
+    from diff_expr import load_expr
+    from ensid_to_pop_peaks import load_pops
+    from peak_to_rsid import load_snps
+    return {
+        'expr': load_expr,
+        # Without the pickle cache, the server never unpickles a file.
+        'dbsnp': partial(load_snps, cache=False),
+        'tss': load_tsss,
+        'pops': load_pops,
+    }
+
+
+class Indexes(object):
+
+    """Indexes of the served files, keyed by kind and file name.
+
+    :served: A dict from (kind, name) to the path of the file.
+    """
+
+    def __init__(self, served):
+        self.loaders = _loaders()
+        self.served = served
+        self.indexes = {}
+        # Guards indexes and load_locks, held only briefly.
+        self.lock = threading.Lock()
+        # One lock per index, held while it loads, so a slow load only
+        # blocks the requests for that index.
+        self.load_locks = {}
+
+    def _loaded(self, key, mtime):
+        with self.lock:
+            if key in self.indexes:
+                index, loaded_mtime = self.indexes[key]
+                if loaded_mtime == mtime:
+                    return index
+        return None
+
+    def get(self, kind, name):
+        """Return the index of the served file name, loading it if it is
+        new or changed.
+        """
+        key = (kind, name)
+        if not key in self.served:
+            raise KeyError('No {} file {} is served'.format(kind, name))
+        fname = self.served[key]
+        mtime = os.path.getmtime(fname)
+        index = self._loaded(key, mtime)
+        if index is not None:
+            return index
+
+        with self.lock:
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            # Another request may have loaded it meanwhile.
+            index = self._loaded(key, mtime)
+            if index is not None:
+                return index
+            logme.log('Loading {} index {}'.format(kind, fname), 'info')
+            index = self.loaders[kind](fname)
+            with self.lock:
+                self.indexes[key] = (index, mtime)
+            logme.log('Loaded {} index {}'.format(kind, fname), 'info')
+            return index
+
+    def status(self):
+        with self.lock:
+            return [ { 'kind': kind, 'name': name,
+                       'file': self.served[(kind, name)],
+                       'entries': len(index) }
+                     for (kind, name), (index, _)
+                     in sorted(self.indexes.items()) ]
+
+
+def gene_expr(indexes, query):
+    gene_to_expr = indexes.get('expr', query['expr'])
+    samples = query.get('samples')
+    result = {}
+    for gene in query['genes']:
+        if not gene in gene_to_expr:
+            continue
+        if samples is None:
+            result[gene] = gene_to_expr[gene]
+        else:
+            result[gene] = { sample: gene_to_expr[gene][sample]
+                             for sample in samples
+                             if sample in gene_to_expr[gene] }
+    return result
+
+
+def map_peaks(indexes, query):
+    from peak_to_rsid import DrawnSnps, map_peaks as map_snps
+
+    snps = indexes.get('dbsnp', query['dbsnp'])
+    # SNPs are drawn without replacement within one request only, so the
+    # SNPs drawn are tracked per request instead of changing the index.
+    chroms = set([ peak[0] for peak in query['peaks'] ])
+    drawn = { chrom: DrawnSnps(snps[chrom])
+              for chrom in chroms if chrom in snps }
+    return [ list(mapped) for mapped in map_snps(drawn, query['peaks']) ]
+
+
+def tss_within(indexes, query):
+    from correlate_peak_expr import tss_near
+
+    tsss = indexes.get('tss', query['tss'])
+    return [ [ list(tss) for tss in tss_near(tsss[chrom], (start + end) / 2) ]
+             for chrom, start, end in query['peaks'] ]
+
+
+def peak_signal(indexes, query):
+    peak_to_pops = indexes.get('pops', query['pops'])
+    return [ peak_to_pops.get((chrom, start, end))
+             for chrom, start, end in query['peaks'] ]
+
+
+ENDPOINTS = {
+    '/gene_expr': gene_expr,
+    '/map_peaks': map_peaks,
+    '/tss_within': tss_within,
+    '/peak_signal': peak_signal,
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(200, self.server.indexes.status())
+        else:
+            self.reply(404, { 'error': 'Unknown path ' + self.path })
+
+    def do_POST(self):
+        if not self.path in ENDPOINTS:
+            self.reply(404, { 'error': 'Unknown path ' + self.path })
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length).decode())
+            result = ENDPOINTS[self.path](self.server.indexes, query)
+        except Exception as e:
+            logme.log('Query {} failed: {!r}'.format(self.path, e), 'error')
+            self.reply(500, { 'error': repr(e) })
+            return
+        self.reply(200, result)
+
+    def reply(self, code, result):
+        body = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logme.log(fmt % args, 'debug')
+
+
+class QueryClient(object):
+
+    """Thin client of a running query server, used by the --server modes."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def query(self, path, **params):
+        request = Request(self.url + path, data=json.dumps(params).encode(),
+                          headers={ 'Content-Type': 'application/json' })
+        try:
+            with urlopen(request) as response:
+                return json.loads(response.read().decode())
+        except HTTPError as e:
+            raise Exception('Query server error on {}: {}'.format(
+                path, json.loads(e.read().decode())['error']
+            ))
+
+    # Files are sent by name, the server only opens the files it was
+    # started with.
+
+    def gene_expr(self, expr_fname, genes, samples=None):
+        """Return a gene_to_expr dict, as load_expr(), of genes only."""
+        return self.query('/gene_expr', expr=os.path.basename(expr_fname),
+                          genes=list(genes), samples=samples)
+
+    def map_peaks(self, dbsnp_fname, peaks):
+        """Yield rsid, chrom, start, end like peak_to_rsid.map_peaks()."""
+        # One request, as SNPs are drawn without replacement across peaks.
+        for rsid, chrom, start, end in self.query(
+                '/map_peaks', dbsnp=os.path.basename(dbsnp_fname),
+                peaks=[ list(peak) for peak in peaks ]):
+            yield rsid, chrom, start, end
+
+    def tss_within(self, tss_fname, peaks):
+        """Return the (pos, ensid, symbol) TSSs near each peak."""
+        return self.query('/tss_within', tss=os.path.basename(tss_fname),
+                          peaks=[ list(peak) for peak in peaks ])
+
+    def peak_signal(self, pops_fname, peaks):
+        """Return the population signal of each peak, None if missing."""
+        return self.query('/peak_signal', pops=os.path.basename(pops_fname),
+                          peaks=[ list(peak) for peak in peaks ])
+
+
+def server_arg(argv=None):
+    """Remove `--server URL' from argv and return URL, or None.
+
+    For the scripts that read sys.argv directly, like instrument.setup().
+    """
+    if argv is None:
+        argv = sys.argv
+    for i, arg in enumerate(argv):
+        if arg == '--server':
+            url = argv[i + 1]
+            del argv[i:i + 2]
+            return url
+        if arg.startswith('--server='):
+            del argv[i]
+            return arg.split('=', 1)[1]
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=PORT)
+    parser.add_argument('--serve', nargs='+', required=True,
+                        metavar='KIND=FILE',
+                        help=('Files to serve, KIND is one of expr, dbsnp, '
+                              'tss or pops. Requests name a file by the base '
+                              'name of its path.'))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request.')
+    args = parser.parse_args(argv)
+
+    served = {}
+    for serve in args.serve:
+        kind, _, fname = serve.partition('=')
+        if not kind in KINDS or not fname:
+            parser.error('Bad --serve {}, give KIND=FILE with KIND one of '
+                         '{}'.format(serve, ', '.join(KINDS)))
+        key = (kind, os.path.basename(fname))
+        if key in served:
+            parser.error('Two {} files named {}'.format(*key))
+        served[key] = os.path.abspath(fname)
+
+    server = ThreadingHTTPServer((HOST, args.port), QueryHandler)
+    server.daemon_threads = True
+    server.indexes = Indexes(served)
+    # After Indexes(), as importing peak_merge sets the level to debug.
+    logme.MIN_LEVEL = 'debug' if args.verbose else 'info'
+    for kind, name in sorted(served):
+        server.indexes.get(kind, name)
+
+    logme.log('Serving on http://{}:{}'.format(HOST, args.port), 'info')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
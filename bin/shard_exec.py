@@ -0,0 +1,123 @@
+"""
+Run a per-peak scan over shards of its peaks in a process pool.
+
+Shards are runs of consecutive peaks, one per chromosome or blocks of a
+fixed number of peaks. Every shard is handed to a scan function in a
+worker, at most a few shards per worker are in flight, and the results
+are yielded in shard order, so the output is the same as a serial run.
+Scans that test peaks return their p-values with the records and the
+caller corrects them all at once, see correct_shards().
+
+Large read-only inputs, such as the TSSs or the expression table, are
+passed once per worker as `state' and read by the scan function from
+STATE, like shared_arrays.ARRAYS.
+
+Usage:
+    from shard_exec import map_shards, shard_items
+    shards = shard_items(infile, by='chrom', key=line_chrom)
+    for results in map_shards(test_peaks, shards, n_workers=4):
+        ...
+"""
+from collections import deque
+from itertools import groupby, islice
+from multiprocessing import Pool
+
+SHARD_MODES = [ 'chrom', 'block' ]
+
+# Peaks per shard when sharding by block.
+BLOCK_SIZE = 5000
+
+# Shards in flight per worker, bounding the memory of queued shards.
+SHARDS_PER_WORKER = 2
+
+# State of the scan in this process, set by init_worker().
+STATE = {}
+
+
+def line_chrom(line):
+    """Chromosome of a tab-separated peak line."""
+    return line.split('\t', 1)[0]
+
+
+def item_chrom(item):
+    """Chromosome of a (chrom, start, end, ...) peak."""
+    return item[0]
+
+
+def shard_items(items, by='chrom', block_size=BLOCK_SIZE, key=item_chrom):
+    """Yield lists of consecutive items, per chromosome or per block.
+
+    :by:  'chrom' for a shard per run of items with the same key(item),
+          'block' for shards of block_size items.
+    """
+    if by == 'chrom':
+        for _, shard in groupby(items, key=key):
+            yield list(shard)
+    elif by == 'block':
+        items = iter(items)
+        while True:
+            shard = list(islice(items, block_size))
+            if not shard:
+                break
+            yield shard
+    else:
+        raise ValueError('Unknown shard mode {}'.format(by))
+
+
+def init_worker(state):
+    STATE.clear()
+    STATE.update(state)
+
+
+def map_shards(func, shards, n_workers=1, state=None):
+    """Yield func(shard) for every shard, in order.
+
+    :n_workers: Processes running func, in this process if 1.
+    :state:     Dict copied into STATE of every process running func.
+    """
+    state = {} if state is None else state
+    if n_workers <= 1:
+        init_worker(state)
+        yield from map(func, shards)
+        return
+
+    with Pool(n_workers, initializer=init_worker,
+              initargs=(state,)) as pool:
+        pending = deque()
+        for shard in shards:
+            pending.append(pool.apply_async(func, (shard,)))
+            if len(pending) >= n_workers * SHARDS_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def correct_shards(results, correction):
+    """Add the (p-value, record) pairs of every shard to correction, in
+    order, so it is corrected over all shards as in a serial run.
+    """
+    for shard_results in results:
+        for p, record in shard_results:
+            correction.add(p, record)
+    return correction
+
+
+def correct_shard_sets(results, corrections):
+    """Same as correct_shards() for scans of several aligned signals,
+    whose shard results are a list of (p-value, record) pairs per signal.
+    """
+    for shard_results in results:
+        for correction, signal_results in zip(corrections, shard_results):
+            for p, record in signal_results:
+                correction.add(p, record)
+    return corrections
+
+
+def add_arguments(parser):
+    """Add --shard-by and --block-size to an argparse parser."""
+    parser.add_argument('--shard-by', choices=SHARD_MODES, default='chrom',
+                        help=('Split the peaks per chromosome or in blocks '
+                              'between the workers (default: chrom).'))
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='Peaks per block (default: {}).'
+                        .format(BLOCK_SIZE))
@@ -0,0 +1,102 @@
+"""
+Publish NumPy arrays once in shared memory for worker processes to attach
+to without copying.
+
+The publishing process keeps the blocks alive and unlinks them when done.
+Only the small, picklable spec (block names, shapes and dtypes) is sent to
+the workers, so memory use does not grow with the number of workers.
+
+Usage:
+    import shared_arrays
+    with shared_arrays.publish({ 'expr': matrix }) as shared:
+        with Pool(n_workers, initializer=shared_arrays.init_worker,
+                  initargs=(shared.spec,)) as pool:
+            pool.map(work, tasks)
+
+    def work(task):
+        expr = shared_arrays.ARRAYS['expr']
+"""
+from multiprocessing import shared_memory
+import numpy as np
+
+# Arrays attached by init_worker(), by name.
+ARRAYS = {}
+
+# Shared memory blocks backing ARRAYS, kept open while they are in use.
+_blocks = []
+
+
+class SharedArrays(object):
+
+    """Arrays copied into shared memory blocks owned by this process."""
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.arrays = {}
+        self.spec = {}
+        try:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                if array.dtype.hasobject:
+                    raise ValueError('Cannot share object array {}'
+                                     .format(name))
+                # Zero-size blocks are not allowed.
+                block = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1)
+                )
+                self.blocks.append(block)
+                shared = np.ndarray(array.shape, dtype=array.dtype,
+                                    buffer=block.buf)
+                shared[...] = array
+                self.arrays[name] = shared
+                self.spec[name] = (block.name, array.shape, array.dtype.str)
+        except:
+            self.close()
+            raise
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def close(self):
+        """Release and unlink the blocks, invalidating self.arrays."""
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def publish(arrays):
+    """Copy a dict of arrays into shared memory.
+
+    :arrays:  A dict from name to NumPy array, object arrays are not
+              supported.
+    :returns: A SharedArrays, whose spec is passed to attach().
+    """
+    return SharedArrays(arrays)
+
+
+def attach(spec):
+    """Return a dict of read-only arrays viewing the blocks of spec."""
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        # Pool workers share the publisher's resource tracker, so the
+        # block is not unlinked when a worker exits.
+        block = shared_memory.SharedMemory(name=block_name)
+        _blocks.append(block)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
+
+
+def init_worker(spec):
+    """Pool initializer attaching the arrays of spec to ARRAYS."""
+    ARRAYS.update(attach(spec))
@@ -0,0 +1,253 @@
+"""
+Read gzip files with decompression moved off the main thread.
+
+BGZF files (bgzip/tabix output) are split into their independent blocks,
+which are inflated in a thread pool; zlib releases the GIL, so blocks
+decompress in parallel while the caller parses. Ordinary gzip files are
+inflated by a single background thread that feeds a bounded queue, so
+decompression of the next chunk overlaps with parsing of the current one.
+
+Usage:
+    from threaded_gzip import open_threaded
+    with open_threaded('expr.txt.gz') as f:
+        for line in f:
+            ...
+        # or, to get lists of lines:
+        for lines in f.iter_batches():
+            ...
+"""
+import bz2
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import membudget
+
+# Decompressed bytes handed to the consumer at a time for plain gzip,
+# less under a memory budget.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Chunks decompressed ahead of the consumer before the reader blocks.
+QUEUE_SIZE = 8
+# Threads used to inflate BGZF blocks.
+N_THREADS = min(4, os.cpu_count() or 1)
+# Compressed bytes of BGZF blocks submitted to the pool per task.
+BGZF_BATCH_SIZE = 1024 * 1024
+
+_BGZF_HEADER = struct.Struct('<4BI2BH')
+
+
+def is_bgzf(fname):
+    """Return True if fname starts with a BGZF block header."""
+    with open(fname, 'rb') as f:
+        header = f.read(18)
+    if len(header) < 18:
+        return False
+    magic1, magic2, method, flags, _, _, _, xlen = \
+        _BGZF_HEADER.unpack(header[:12])
+    return (magic1 == 31 and magic2 == 139 and method == 8 and
+            bool(flags & 4) and xlen >= 6 and header[12:14] == b'BC')
+
+
+def read_bgzf_block(raw, offset=0):
+    """Parse the BGZF block starting at offset of an open binary file.
+
+    :returns: (compressed deflate payload, total block size), or
+              (None, 0) at end of file.
+    """
+    raw.seek(offset)
+    header = raw.read(12)
+    if len(header) < 12:
+        return None, 0
+    _, _, _, _, _, _, _, xlen = _BGZF_HEADER.unpack(header)
+    extra = raw.read(xlen)
+    bsize = None
+    pos = 0
+    while pos < xlen:
+        si1, si2, slen = extra[pos], extra[pos + 1], \
+            struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if si1 == 66 and si2 == 67:
+            bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+        pos += 4 + slen
+    if bsize is None:
+        raise Exception('Not a BGZF block at offset {}'.format(offset))
+    # Block size excludes the 8-byte CRC32/ISIZE trailer inside bsize + 1.
+    block_size = bsize + 1
+    payload = raw.read(block_size - 12 - xlen - 8)
+    raw.read(8)
+    return payload, block_size
+
+
+def inflate(payload):
+    """Inflate a raw deflate payload."""
+    return zlib.decompress(payload, -15)
+
+
+def _iter_bgzf_batches(fname):
+    """Yield lists of compressed BGZF block payloads."""
+    with open(fname, 'rb') as raw:
+        offset = 0
+        batch, batch_bytes = [], 0
+        while True:
+            payload, block_size = read_bgzf_block(raw, offset)
+            if payload is None:
+                break
+            offset += block_size
+            batch.append(payload)
+            batch_bytes += block_size
+            if batch_bytes >= BGZF_BATCH_SIZE:
+                yield batch
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch
+
+
+def _inflate_batch(batch):
+    return b''.join([ inflate(payload) for payload in batch ])
+
+
+def bgzf_chunks(fname, n_threads=N_THREADS):
+    """Yield decompressed chunks of a BGZF file, in order.
+
+    Batches of blocks are inflated in a thread pool, keeping a bounded
+    number of batches in flight ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = deque()
+        for batch in _iter_bgzf_batches(fname):
+            pending.append(pool.submit(_inflate_batch, batch))
+            if len(pending) >= n_threads * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def gzip_chunks(fname, chunk_size=CHUNK_SIZE, queue_size=QUEUE_SIZE):
+    """Yield decompressed chunks of a gzip file.
+
+    A background thread decompresses into a bounded queue.
+    """
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decompress():
+        try:
+            with gzip.open(fname, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk or not put(chunk):
+                        break
+        except Exception as e:
+            put(e)
+        put(done)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ThreadedGzipFile(object):
+
+    """Read-only, iterable file object over a gzip or BGZF file.
+
+    Iteration yields lines, including their trailing newline, like a file
+    opened with open(). Text mode ('rt') decodes UTF-8.
+    """
+
+    def __init__(self, fname, mode='rt', n_threads=N_THREADS):
+        """Open fname for reading.
+
+        :fname:     Path of a gzip or BGZF compressed file.
+        :mode:      'rt' to yield str lines, 'rb' to yield bytes lines.
+        :n_threads: Number of threads to inflate BGZF blocks with.
+        """
+        if mode not in ('r', 'rt', 'rb'):
+            raise Exception('Unsupported mode {}'.format(mode))
+        self.name      = fname
+        self.mode      = mode
+        self.text      = not mode.endswith('b')
+        self.closed    = False
+        self.n_threads = n_threads
+        self._chunks   = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+        self.closed = True
+
+    def chunks(self):
+        """Yield decompressed chunks that end on a line boundary."""
+        if is_bgzf(self.name):
+            chunks = bgzf_chunks(self.name, self.n_threads)
+        else:
+            chunks = gzip_chunks(self.name,
+                                 membudget.chunk_size(CHUNK_SIZE))
+        self._chunks = chunks
+
+        rest = b''
+        for chunk in chunks:
+            if rest:
+                chunk = rest + chunk
+            split = chunk.rfind(b'\n') + 1
+            if split == 0:
+                rest = chunk
+                continue
+            rest = chunk[split:]
+            yield chunk[:split]
+        if rest:
+            yield rest
+
+    def iter_batches(self):
+        """Yield lists of lines, one list per decompressed chunk."""
+        for chunk in self.chunks():
+            if self.text:
+                yield io.StringIO(chunk.decode('utf-8')).readlines()
+            else:
+                yield io.BytesIO(chunk).readlines()
+
+    def __iter__(self):
+        for lines in self.iter_batches():
+            yield from lines
+
+
+def open_threaded(fname, mode='rt', n_threads=N_THREADS):
+    """Open fname for reading, decompressing gzip files in the background.
+
+    Falls back to bz2.open() and open() for other files.
+    """
+    if fname.endswith(('.gz', '.bgz')):
+        return ThreadedGzipFile(fname, mode, n_threads)
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, mode if mode != 'r' else 'rt')
+    return open(fname, mode)